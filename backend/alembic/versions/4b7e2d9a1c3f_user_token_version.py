@@ -0,0 +1,30 @@
+"""Add users.token_version
+
+Revision ID: 4b7e2d9a1c3f
+Revises: c0581a029088
+Create Date: 2026-10-16 21:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4b7e2d9a1c3f'
+down_revision: Union[str, None] = 'c0581a029088'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('token_version', sa.Integer(), server_default='0', nullable=False))
+    # Only revoked users are loaded at startup (token_version > 0)
+    op.create_index('ix_users_revoked_token_version', 'users', ['id', 'token_version'],
+                    unique=False, postgresql_where=sa.text('token_version > 0'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_revoked_token_version', table_name='users')
+    op.drop_column('users', 'token_version')
@@ -0,0 +1,38 @@
+"""Sharded usage counters: usage_record_slots and subscription_plans.counter_slots
+
+Revision ID: 9d2c6a4f8e1b
+Revises: 4b7e2d9a1c3f
+Create Date: 2026-10-16 21:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d2c6a4f8e1b'
+down_revision: Union[str, None] = '4b7e2d9a1c3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('subscription_plans', sa.Column('counter_slots', sa.Integer(), server_default='1', nullable=False))
+    op.create_table('usage_record_slots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('organization_id', sa.Integer(), nullable=False),
+    sa.Column('period_start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('slot', sa.Integer(), nullable=False),
+    sa.Column('request_count', sa.Integer(), nullable=False),
+    sa.Column('last_updated', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['organization_id'], ['organizations.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('organization_id', 'period_start', 'slot', name='uq_usage_slot_org_period_slot')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('usage_record_slots')
+    op.drop_column('subscription_plans', 'counter_slots')
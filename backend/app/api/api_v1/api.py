@@ -1,9 +1,11 @@
 from fastapi import APIRouter
 from app.api import health
-from app.api.api_v1.endpoints import login, users, widgets
+from app.api.api_v1.endpoints import admin, login, usage, users, widgets
 
 api_router = APIRouter()
 api_router.include_router(health.router, tags=["health"])
 api_router.include_router(login.router, tags=["login"])
 api_router.include_router(users.router, prefix="/users", tags=["users"])
 api_router.include_router(widgets.router, prefix="/widgets", tags=["widgets"])
+api_router.include_router(usage.router, prefix="/usage", tags=["usage"])
+api_router.include_router(admin.router, prefix="/admin", tags=["admin"])
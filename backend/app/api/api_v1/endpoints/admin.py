@@ -0,0 +1,25 @@
+from typing import Any, List, Literal
+from fastapi import APIRouter, Depends, Query
+from app.api import deps
+from app.core import query_trace
+from app.schemas import admin as admin_schema
+
+router = APIRouter(dependencies=[Depends(deps.admit_priority), Depends(deps.get_current_active_superuser)])
+
+@router.get("/queries", response_model=List[admin_schema.QueryStat])
+async def read_query_stats(
+    limit: int = Query(20, ge=1, le=500),
+    order_by: Literal["total_ms", "mean_ms", "max_ms", "calls", "rows"] = "total_ms",
+) -> Any:
+    """
+    Top statements seen by this worker since start (or the last reset),
+    aggregated by fingerprint. Platform admins only.
+    """
+    return [stat._asdict() for stat in query_trace.tracer.top(limit, order_by)]
+
+@router.delete("/queries", status_code=204)
+async def reset_query_stats() -> None:
+    """
+    Start a fresh aggregation window.
+    """
+    query_trace.tracer.reset()
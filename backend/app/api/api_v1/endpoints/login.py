@@ -26,16 +26,21 @@ async def login_access_token(
     result = await db.execute(select(all_models.User).where(all_models.User.email == form_data.username))
     user = result.scalars().first()
     
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+    if not user or not await security.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
         
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
+
+    # Argon2 cost settings changed since this hash was made: upgrade it now that we know the password
+    if security.password_needs_rehash(user.hashed_password):
+        user.hashed_password = await security.get_password_hash_async(form_data.password)
+        await db.commit()
         
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     return {
         "access_token": security.create_access_token(
-            user.id, expires_delta=access_token_expires
+            user.id, expires_delta=access_token_expires, claims=security.access_token_claims(user)
         ),
         "token_type": "bearer",
     }
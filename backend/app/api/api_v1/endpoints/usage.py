@@ -0,0 +1,33 @@
+from typing import Any
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api import deps
+from app.core import ingest
+from app.core.config import settings
+from app.core.db import get_db
+from app.schemas import usage as usage_schema
+
+router = APIRouter(dependencies=[Depends(deps.get_current_active_superuser)])
+
+@router.post(
+    "/events",
+    response_model=usage_schema.UsageIngestResult,
+    openapi_extra={"requestBody": {"required": True, "content": {"application/x-ndjson": {"schema": ingest.UsageEvent.model_json_schema()}}}},
+)
+async def ingest_usage_events(request: Request, db: AsyncSession = Depends(get_db)) -> Any:
+    """
+    Record usage reported by other services: one JSON event per line,
+    `{"org_id": 1, "units": 3, "timestamp": "2026-01-31T12:00:00Z"}`.
+    Units past an org's monthly_quota are not recorded and come back as
+    rejected. Platform admins only.
+    """
+    aggregate = await ingest.read_events(
+        request.stream(), settings.USAGE_INGEST_MAX_EVENTS, settings.USAGE_INGEST_MAX_LINE_BYTES
+    )
+    organizations = await ingest.apply_usage(db, aggregate.totals)
+    return {
+        "events": aggregate.events,
+        "accepted": sum(org.accepted for org in organizations),
+        "rejected": sum(org.rejected for org in organizations),
+        "organizations": [org._asdict() for org in organizations],
+    }
@@ -5,7 +5,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.api import deps
-from app.core import security
+from app.core import invalidation, principals, security
 from app.core.db import get_db
 from app.models import all_models
 from app.schemas import user as user_schema
@@ -39,6 +39,9 @@ async def create_user(
             detail="The organization name is already taken.",
         )
 
+    # Hash before touching the database, so a saturated hasher (503) costs no writes
+    hashed_password = await security.get_password_hash_async(user_in.password)
+
     # Create Org
     new_org = all_models.Organization(name=user_in.organization_name)
     db.add(new_org)
@@ -47,7 +50,7 @@ async def create_user(
     # Create User
     new_user = all_models.User(
         email=user_in.email,
-        hashed_password=security.get_password_hash(user_in.password),
+        hashed_password=hashed_password,
         full_name=user_in.full_name,
         organization_id=new_org.id,
         role=all_models.UserRole.ORG_ADMIN # First user is Admin
@@ -70,6 +73,9 @@ async def create_user(
         is_active=True
     )
     db.add(new_sub)
+
+    # Drop any cached "no active subscription" answer for this org, here and in other workers
+    await invalidation.publish(db, "organization", new_org.id)
     
     await db.commit()
     await db.refresh(new_user)
@@ -83,3 +89,14 @@ async def read_user_me(
     Get current user.
     """
     return current_user
+
+@router.post("/me/revoke-tokens", status_code=204)
+async def revoke_my_tokens(
+    db: AsyncSession = Depends(get_db),
+    principal: principals.Principal = Depends(deps.get_current_principal),
+) -> None:
+    """
+    Sign out everywhere: every access token issued so far stops working.
+    """
+    await principals.revoke_tokens(db, principal.id)
+    await db.commit()
@@ -1,11 +1,15 @@
-from typing import Generator, Optional
-from fastapi import Depends, HTTPException, Response, status
+import asyncio
+import inspect
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Generator, Optional, Union
+from fastapi import Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from app.core import security, metering
+from sqlalchemy import exc as sa_exc, select
+from app.core import admission, security, metering, metrics, prepared, principals, rate_limit
+from app.core.principals import Principal
 from app.core.config import settings
 from app.core.db import get_db
 from app.models import all_models
@@ -16,10 +20,20 @@ reusable_oauth2 = OAuth2PasswordBearer(
 )
 
 
-async def get_current_user(
+async def get_current_principal(
     db: AsyncSession = Depends(get_db),
     token: str = Depends(reusable_oauth2)
-) -> all_models.User:
+) -> Principal:
+    """
+    Resolve the bearer token to a compact Principal.
+    Served from the principal cache when possible: no JWT decode, no SELECT.
+    Stateless tokens (with `role`/`org` claims) never need the SELECT either.
+    """
+    principal = principals.get(token)
+    if principal is not None:
+        return principal
+
+    started = time.perf_counter()
     try:
         payload = jwt.decode(
             token, settings.SECRET_KEY, algorithms=[security.ALGORITHM]
@@ -30,11 +44,61 @@ async def get_current_user(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials",
         )
+    finally:
+        metrics.JWT_DECODE.observe(time.perf_counter() - started)
+
+    user_id = int(token_data.sub)
+    if not principals.token_version_ok(user_id, token_data.ver):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Token has been revoked",
+        )
+
+    if token_data.role is not None:
+        # Only active users are issued tokens, and deactivating one must revoke them
+        principal = Principal(user_id, token_data.org, token_data.role, True)
+        principals.put(token, principal, token_data.exp)
+        return principal
+
+    started = time.perf_counter()
+    if prepared.enabled():
+        row = await prepared.fetchrow(db, prepared.USER_PRINCIPAL, user_id)
+    else:
+        result = await db.execute(
+            select(
+                all_models.User.id,
+                all_models.User.organization_id,
+                all_models.User.role,
+                all_models.User.is_active,
+            ).where(all_models.User.id == user_id)
+        )
+        row = result.first()
+    metrics.USER_LOOKUP.observe(time.perf_counter() - started)
+
+    if not row:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    principal = Principal(*row)
+    principals.put(token, principal, token_data.exp)
+    return principal
 
-    result = await db.execute(
-        select(all_models.User).where(all_models.User.id == int(token_data.sub))
-    )
-    user = result.scalars().first()
+
+async def get_current_active_principal(
+    principal: Principal = Depends(get_current_principal),
+) -> Principal:
+    if not principal.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return principal
+
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_db),
+    principal: Principal = Depends(get_current_principal),
+) -> all_models.User:
+    """Full User row, for endpoints that actually need more than the Principal."""
+    started = time.perf_counter()
+    user = await db.get(all_models.User, principal.id)
+    metrics.USER_LOOKUP.observe(time.perf_counter() - started)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -50,33 +114,140 @@ async def get_current_active_user(
 
 
 async def get_current_active_superuser(
-    current_user: all_models.User = Depends(get_current_user),
-) -> all_models.User:
-    if current_user.role != all_models.UserRole.PLATFORM_ADMIN:
+    principal: Principal = Depends(get_current_principal),
+) -> Principal:
+    if principal.role != all_models.UserRole.PLATFORM_ADMIN:
         raise HTTPException(
             status_code=400, detail="The user doesn't have enough privileges"
         )
-    return current_user
+    return principal
 
 
-async def check_usage_limits(
-    response: Response,
-    current_user: all_models.User = Depends(get_current_active_user),
-    db: AsyncSession = Depends(get_db),
-) -> None:
+# Failures that mean the database is not keeping up: they shrink the admission limit like slow requests
+OVERLOAD_ERRORS = (sa_exc.TimeoutError, sa_exc.OperationalError, asyncio.TimeoutError)
+
+
+def _admission(priority: bool) -> Callable:
+    shed = metrics.SHED_PRIORITY if priority else metrics.SHED_NORMAL
+
+    async def admit() -> AsyncGenerator[None, None]:
+        if not settings.ADMISSION_CONTROL_ENABLED:
+            yield
+            return
+        if not admission.limiter.try_acquire(priority):
+            shed.inc()
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy. Retry shortly.",
+                headers={"Retry-After": rate_limit.retry_after_header(settings.ADMISSION_RETRY_AFTER_SECONDS)},
+            )
+        started = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+        except OVERLOAD_ERRORS:
+            overloaded = True
+            raise
+        finally:
+            admission.limiter.release(time.perf_counter() - started, overloaded)
+
+    return admit
+
+
+# Admission control (app.core.admission): declare it before any dependency that
+# uses the database, so a refused request never waits for a pool connection.
+admit = _admission(priority=False)
+admit_priority = _admission(priority=True)  # admin routes: may exceed the limit by the headroom
+
+
+async def enforce_usage(response: Response, principal: Principal, db: AsyncSession, units: int = 1) -> None:
     """
-    FastAPI dependency that intercepts every metered request.
-    Admins bypass limits. All other users have usage tracked atomically.
+    Charge `units` to the principal's organization and set the X-RateLimit-*
+    headers. Admins bypass limits. All other users have usage tracked atomically.
     """
-    if current_user.role == all_models.UserRole.PLATFORM_ADMIN:
+    if principal.role == all_models.UserRole.PLATFORM_ADMIN:
         return  # Admins bypass limits
 
-    if not current_user.organization_id:
+    if not principal.organization_id:
         raise HTTPException(status_code=400, detail="User not part of an organization")
 
-    used, limit = await metering.track_and_enforce_usage(db, current_user.organization_id)
+    org_id = principal.organization_id
+    limits = await metering.get_plan_limits(db, org_id)
 
-    # Inject standard rate-limit headers for client visibility
+    # Short-window burst control: in memory, before any usage_records write
+    if settings.RATE_LIMIT_ENABLED and limits and limits.rate_limit_per_minute:
+        decision = rate_limit.limiter.check(org_id, limits.rate_limit_per_minute)
+        minute_headers = {
+            "X-RateLimit-Minute-Limit": str(decision.limit),
+            "X-RateLimit-Minute-Remaining": str(decision.remaining),
+        }
+        if not decision.allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests per minute for this organization's plan.",
+                headers={**minute_headers, "Retry-After": rate_limit.retry_after_header(decision.retry_after)},
+            )
+        response.headers.update(minute_headers)
+
+    used, limit = await metering.track_and_enforce_usage(db, org_id, units)
+
+    # Inject standard rate-limit headers for client visibility (in cost units)
     response.headers["X-RateLimit-Limit"] = str(limit)
     response.headers["X-RateLimit-Used"] = str(used)
     response.headers["X-RateLimit-Remaining"] = str(limit - used)
+    response.headers["X-RateLimit-Cost"] = str(units)
+
+
+async def check_usage_limits(
+    response: Response,
+    _admitted: None = Depends(admit),
+    principal: Principal = Depends(get_current_active_principal),
+    db: AsyncSession = Depends(get_db),
+) -> None:
+    """
+    FastAPI dependency that intercepts every metered request, at one unit each,
+    once admission control has let it in. Use `metered(cost)` for routes that cost more.
+    """
+    await enforce_usage(response, principal, db)
+
+
+Cost = Union[int, Callable[[Request], Union[int, Awaitable[int]]]]
+
+
+def metered(cost: Cost) -> Callable:
+    """
+    Like check_usage_limits, but each request costs `cost` units: a fixed
+    weight, or a (possibly async) function of the request for costs that
+    depend on its size. Every metered request costs at least one unit; a
+    cost function validates its input and raises HTTPException on bad values.
+
+        @router.post("/export", dependencies=[Depends(deps.metered(5))])
+
+        def batch_cost(request: Request) -> int:
+            n = request.query_params.get("n", "1")
+            if not n.isdigit() or not 1 <= int(n) <= 1000:
+                raise HTTPException(status_code=422, detail="n must be an integer from 1 to 1000")
+            return int(n)
+
+        @router.post("/batch", dependencies=[Depends(deps.metered(batch_cost))])
+    """
+    if isinstance(cost, int) and cost < 1:
+        raise ValueError("A metered route costs at least one unit")
+
+    async def check_weighted_usage(
+        request: Request,
+        response: Response,
+        _admitted: None = Depends(admit),
+        principal: Principal = Depends(get_current_active_principal),
+        db: AsyncSession = Depends(get_db),
+    ) -> None:
+        if isinstance(cost, int):
+            units = cost
+        else:
+            units = cost(request)
+            if inspect.isawaitable(units):
+                units = await units
+            units = max(units, 1)
+        await enforce_usage(response, principal, db, units)
+
+    return check_weighted_usage
@@ -1,24 +1,57 @@
 from typing import Any
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
-from app.core.db import get_db
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from app.core import health, metrics
 
 router = APIRouter()
 
-@router.get("/health")
-async def health_check(
-    db: AsyncSession = Depends(get_db),
-) -> Any:
+
+def _checkout_latency() -> dict:
+    checkouts = metrics.POOL_CHECKOUT
+    count = sum(checkouts.counts)
+    p99 = checkouts.quantile(0.99)
+    return {
+        "count": count,
+        "mean_ms": round(checkouts.sum / count * 1000, 3) if count else None,
+        # Bucket upper bound, so an over-estimate by at most one bucket
+        "p99_ms": None if p99 is None or p99 == float("inf") else p99 * 1000,
+    }
+
+
+@router.get("/health/live")
+async def liveness() -> Any:
     """
-    Health check endpoint to verify service and database connectivity.
+    Liveness: the worker's event loop is serving requests. Touches nothing
+    else, so a busy database never gets a healthy process restarted.
     """
-    try:
-        # Check database connection
-        await db.execute(text("SELECT 1"))
-        return {"status": "ok", "database": "connected"}
-    except Exception as e:
-        raise HTTPException(
-            status_code=503,
-            detail=f"Service unavailable: Database connection failed. {str(e)}"
-        )
+    return {"status": "ok"}
+
+
+@router.get("/health/ready")
+async def readiness() -> JSONResponse:
+    """
+    Readiness, from the background probe's last result (see app.core.health):
+    503 while the database is unreachable or slow, the event loop lags, or
+    the connection pool is saturated, so the load balancer routes around
+    this instance. Serving it takes no pool connection.
+    """
+    result = await health.current()
+    return JSONResponse(
+        status_code=200 if result.ready else 503,
+        content={
+            "status": "ok" if result.ready else "unavailable",
+            "reasons": result.reasons,
+            "database": {
+                "connected": result.db_latency_ms is not None,
+                "latency_ms": None if result.db_latency_ms is None else round(result.db_latency_ms, 3),
+            },
+            "event_loop_lag_ms": round(result.loop_lag_ms, 3),
+            "pool": {**result.pool, "checkout": _checkout_latency()},
+        },
+    )
+
+
+@router.get("/health")
+async def health_check() -> JSONResponse:
+    """Same as /health/ready; kept for existing probes."""
+    return await readiness()
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.core import metrics
+
+router = APIRouter()
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def prometheus_metrics() -> PlainTextResponse:
+    """
+    Prometheus scrape endpoint (text exposition format 0.0.4).
+    Counters are per worker process; Prometheus sums them across targets.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
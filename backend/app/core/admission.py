@@ -0,0 +1,76 @@
+"""
+Admission control: an adaptive cap on the metered requests in flight.
+
+When PostgreSQL slows down, requests pile up in the pool checkout and wait
+past their clients' timeouts, and the metering writes done for them are
+wasted. The limiter caps how many requests this worker has in flight,
+and refuses the rest at once (503 + Retry-After) instead of queueing them.
+
+The cap adapts to latency by AIMD (additive increase, multiplicative
+decrease). A request that finishes within ADMISSION_LATENCY_TARGET_MS while
+the cap is at least half used raises it by 1/limit, i.e. by about one per
+round of requests. One that runs slower, or fails with a pool or connection
+timeout, cuts it by ADMISSION_BACKOFF, at most once per target latency, so
+one burst of slow requests is a single cut. Priority requests (admin routes)
+may go ADMISSION_PRIORITY_HEADROOM over the cap.
+"""
+import time
+from typing import Callable
+
+from app.core.config import settings
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial_limit: int = 50,
+        min_limit: int = 5,
+        max_limit: int = 500,
+        latency_target: float = 0.25,
+        backoff: float = 0.9,
+        priority_headroom: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.priority_headroom = priority_headroom
+        self.in_flight = 0
+        self._clock = clock
+        self._last_decrease = float("-inf")
+
+    def try_acquire(self, priority: bool = False) -> bool:
+        """Take a slot if one is free; the caller must `release` it when done."""
+        cap = int(self.limit) + (self.priority_headroom if priority else 0)
+        if self.in_flight >= cap:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, latency: float, overloaded: bool = False) -> None:
+        """Give back a slot, adapting the limit to how long the request held it."""
+        self.in_flight -= 1
+        if overloaded or latency > self.latency_target:
+            now = self._clock()
+            if now - self._last_decrease >= self.latency_target:
+                self.limit = max(self.limit * self.backoff, self.min_limit)
+                self._last_decrease = now
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Only grow a limit that is being used: an idle worker learns nothing about capacity
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+
+def create_limiter() -> AdaptiveLimiter:
+    return AdaptiveLimiter(
+        initial_limit=settings.ADMISSION_INITIAL_LIMIT,
+        min_limit=settings.ADMISSION_MIN_LIMIT,
+        max_limit=settings.ADMISSION_MAX_LIMIT,
+        latency_target=settings.ADMISSION_LATENCY_TARGET_MS / 1000,
+        backoff=settings.ADMISSION_BACKOFF,
+        priority_headroom=settings.ADMISSION_PRIORITY_HEADROOM,
+    )
+
+
+limiter = create_limiter()
@@ -0,0 +1,61 @@
+"""
+Where usage counters live. `get_backend()` returns the process-wide backend
+chosen by Settings.METERING_BACKEND; tests swap it with `set_backend()`.
+"""
+from app.core.backends.base import BatchItem, MeteringBackend, Reservation
+from app.core.config import settings
+
+_backend: MeteringBackend | None = None
+
+
+def create_backend(name: str) -> MeteringBackend:
+    if name == "postgres":
+        from app.core.backends.postgres import PostgresMeteringBackend
+        return PostgresMeteringBackend()
+    if name == "postgres_sharded":
+        from app.core.backends.sharded import ShardedPostgresMeteringBackend
+        return ShardedPostgresMeteringBackend()
+    if name == "memory":
+        from app.core.backends.memory import MemoryMeteringBackend
+        return MemoryMeteringBackend(shards=settings.MEMORY_BACKEND_SHARDS)
+    if name == "redis":
+        from redis import asyncio as aioredis
+        from app.core.backends.postgres import PostgresMeteringBackend
+        from app.core.backends.redis_store import RedisMeteringBackend
+        return RedisMeteringBackend(
+            aioredis.Redis.from_url(settings.REDIS_URL),
+            PostgresMeteringBackend(),
+            prefix=settings.REDIS_KEY_PREFIX,
+            sync_interval=settings.REDIS_SYNC_INTERVAL_SECONDS,
+            grace_seconds=settings.REDIS_COUNTER_GRACE_SECONDS,
+        )
+    if name == "shared_memory":
+        from app.core.backends import shared
+        from app.core.backends.shared import SharedCounterTable, SharedMemoryMeteringBackend
+        return SharedMemoryMeteringBackend(
+            create_backend(settings.SHARED_COUNTER_INNER_BACKEND),
+            # Layout and capacity are part of the name: a resized or upgraded table never attaches to an old block
+            SharedCounterTable(
+                f"{settings.SHARED_COUNTER_NAME}_v{shared.LAYOUT_VERSION}_{settings.SHARED_COUNTER_CAPACITY}",
+                settings.SHARED_COUNTER_CAPACITY,
+            ),
+            flush_interval=settings.SHARED_COUNTER_FLUSH_INTERVAL_MS / 1000,
+            flush_threshold=settings.SHARED_COUNTER_FLUSH_THRESHOLD,
+        )
+    raise ValueError(f"Unknown metering backend: {name!r}")
+
+
+def get_backend() -> MeteringBackend:
+    global _backend
+    if _backend is None:
+        _backend = create_backend(settings.METERING_BACKEND)
+    return _backend
+
+
+def set_backend(backend: MeteringBackend | None) -> None:
+    """Replace the process-wide backend; None goes back to the configured one on next use."""
+    global _backend
+    _backend = backend
+
+
+__all__ = ["BatchItem", "MeteringBackend", "Reservation", "create_backend", "get_backend", "set_backend"]
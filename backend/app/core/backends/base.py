@@ -0,0 +1,68 @@
+import abc
+from datetime import datetime
+from typing import NamedTuple, Sequence
+
+
+class Reservation(NamedTuple):
+    granted: int  # units actually taken (0 when refused)
+    count: int | None  # counter after the reservation; None when refused and the backend did not read it
+
+
+class BatchItem(NamedTuple):
+    org_id: int
+    period_start: datetime
+    units: int
+    limit: int
+    slots: int = 1
+
+
+class MeteringBackend(abc.ABC):
+    """
+    Storage for per-(organization, period) usage counters.
+
+    `reserve` is the only operation on the request path and must be atomic with
+    respect to every other caller: the counter never ends up above `limit`.
+    """
+
+    @abc.abstractmethod
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        """
+        Take `units` from the quota. All-or-nothing by default; with partial=True
+        grant as many as are left (leases, coalesced batches). `slots` is the
+        plan's counter_slots, a layout hint only sharded backends use.
+        """
+
+    async def reserve_batch(self, items: Sequence[BatchItem]) -> list[Reservation]:
+        """
+        Partial reservations for many (organization, period) counters at once,
+        at most one item per counter, one Reservation per item in the same
+        order. Each item is atomic on its own; backends that can should apply
+        the whole batch in one round trip.
+        """
+        return [
+            await self.reserve(item.org_id, item.period_start, item.units, item.limit, partial=True, slots=item.slots)
+            for item in items
+        ]
+
+    async def prepare_period(self, period_start: datetime, orgs: Sequence[tuple[int, int]]) -> None:
+        """
+        Create the counters of `orgs`, (org_id, slots) pairs, for a period
+        before its first request. Optional: reserve() creates missing ones.
+        """
+
+    @abc.abstractmethod
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        """Give back units that were reserved but not used."""
+
+    @abc.abstractmethod
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        """Current counter value, without changing it."""
+
+    @abc.abstractmethod
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        """Set the counter back to zero."""
+
+    async def close(self) -> None:
+        """Flush and release resources on shutdown."""
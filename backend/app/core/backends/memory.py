@@ -0,0 +1,98 @@
+import threading
+from array import array
+from datetime import datetime
+
+from app.core.backends.base import MeteringBackend, Reservation
+
+
+class _Shard:
+    """
+    Counters for the orgs hashed to one shard. Each org owns a fixed slot in
+    two parallel int64 arrays (period start as epoch seconds, count), so a
+    tenant costs 16 bytes of counter storage plus its dict entry, and a new
+    period simply overwrites the slot instead of allocating a new key.
+    """
+
+    __slots__ = ("lock", "slots", "periods", "counts")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots: dict[int, int] = {}  # org_id -> index into periods/counts
+        self.periods = array("q")
+        self.counts = array("q")
+
+    def slot(self, org_id: int, period: int) -> int:
+        index = self.slots.get(org_id)
+        if index is None:
+            index = self.slots[org_id] = len(self.counts)
+            self.periods.append(period)
+            self.counts.append(0)
+        elif self.periods[index] != period:
+            # Window rollover: the previous period's count is no longer needed
+            self.periods[index] = period
+            self.counts[index] = 0
+        return index
+
+
+class MemoryMeteringBackend(MeteringBackend):
+    """
+    Process-local counters for single-node deployments, load tests and unit
+    tests. Nothing is persisted and only the current period of each org is
+    kept: asking about an older period reads as 0, reservations against it
+    are refused and releases against it are dropped.
+
+    Every operation runs under its shard's lock without awaiting, so it is
+    atomic on the event loop and also safe to call from worker threads.
+    """
+
+    def __init__(self, shards: int = 64):
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, org_id: int) -> _Shard:
+        return self._shards[org_id % len(self._shards)]
+
+    @staticmethod
+    def _period_key(period_start: datetime) -> int:
+        return int(period_start.timestamp())
+
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        shard = self._shard(org_id)
+        with shard.lock:
+            period = self._period_key(period_start)
+            index = shard.slots.get(org_id)
+            if index is not None and shard.periods[index] > period:
+                return Reservation(0, None)  # only the current period is kept: late usage is refused
+            index = shard.slot(org_id, period)
+            count = shard.counts[index]
+            available = max(limit - count, 0)
+            granted = min(units, available) if partial else (units if units <= available else 0)
+            count += granted
+            shard.counts[index] = count
+        return Reservation(granted, count)
+
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        shard = self._shard(org_id)
+        with shard.lock:
+            index = shard.slots.get(org_id)
+            if index is not None and shard.periods[index] == self._period_key(period_start):
+                shard.counts[index] = max(shard.counts[index] - units, 0)
+
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        shard = self._shard(org_id)
+        with shard.lock:
+            index = shard.slots.get(org_id)
+            if index is None or shard.periods[index] != self._period_key(period_start):
+                return 0
+            return shard.counts[index]
+
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        shard = self._shard(org_id)
+        with shard.lock:
+            index = shard.slots.get(org_id)
+            if index is not None and shard.periods[index] == self._period_key(period_start):
+                shard.counts[index] = 0
+
+    def __len__(self) -> int:
+        return sum(len(shard.slots) for shard in self._shards)
@@ -0,0 +1,369 @@
+import time
+from datetime import datetime
+from typing import Sequence
+from sqlalchemy import DateTime, Integer, and_, column, select, update, true, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.sql import func
+from fastapi import HTTPException
+from app.models import all_models
+from app.core import metrics, prepared
+from app.core.backends.base import BatchItem, MeteringBackend, Reservation
+from app.core.db import AsyncSessionLocal
+
+
+def build_metering_statement(org_id: int, period_start: datetime, units: int, plan_limit: int):
+    """
+    All-or-nothing check-and-increment in one round trip:
+
+        INSERT INTO usage_records (organization_id, period_start, request_count)
+        VALUES (:org_id, :period_start, :units)
+        ON CONFLICT (organization_id, period_start) DO UPDATE
+        SET request_count = usage_records.request_count + :units
+        WHERE usage_records.request_count + :units <= :limit
+        RETURNING request_count
+
+    ON CONFLICT DO UPDATE locks the conflicting row and re-checks the WHERE
+    clause against its latest committed version, so concurrent requests are
+    serialized exactly like the previous UPDATE ... WHERE count < limit.
+    No row back means the limit was reached. Callers must not pass units > limit.
+    """
+    return (
+        pg_insert(all_models.UsageRecord)
+        .values(organization_id=org_id, period_start=period_start, request_count=units)
+        .on_conflict_do_update(
+            index_elements=["organization_id", "period_start"],
+            set_={
+                "request_count": all_models.UsageRecord.request_count + units,
+                # onupdate= defaults are not applied to ON CONFLICT DO UPDATE
+                "last_updated": func.now(),
+            },
+            where=all_models.UsageRecord.request_count + units <= plan_limit,
+        )
+        .returning(all_models.UsageRecord.request_count)
+    )
+
+
+def build_update_statement(org_id: int, period_start: datetime, units: int, plan_limit: int):
+    """
+    build_metering_statement for a row that is known to exist: a plain guarded
+    UPDATE, which skips the INSERT attempt and its unique-index probe.
+
+        UPDATE usage_records SET request_count = request_count + :units
+        WHERE organization_id = :org_id AND period_start = :period_start
+          AND request_count + :units <= :limit
+        RETURNING request_count
+
+    No row back means the limit was reached, or the row is gone after all.
+    """
+    return (
+        update(all_models.UsageRecord)
+        .where(all_models.UsageRecord.organization_id == org_id)
+        .where(all_models.UsageRecord.period_start == period_start)
+        .where(all_models.UsageRecord.request_count + units <= plan_limit)
+        .values(request_count=all_models.UsageRecord.request_count + units, last_updated=func.now())
+        .returning(all_models.UsageRecord.request_count)
+    )
+
+
+def build_reserve_statement(org_id: int, period_start: datetime, units: int, plan_limit: int):
+    """
+    Take up to `units` from what is left of the quota, in one statement:
+
+        WITH cur AS (SELECT id, request_count FROM usage_records
+                     WHERE organization_id = :org_id AND period_start = :period_start FOR UPDATE),
+             upd AS (UPDATE usage_records SET request_count = request_count + LEAST(:units, :limit - cur.request_count)
+                     FROM cur WHERE usage_records.id = cur.id AND cur.request_count < :limit
+                     RETURNING usage_records.request_count)
+        SELECT cur.request_count, upd.request_count FROM cur LEFT OUTER JOIN upd ON true
+
+    FOR UPDATE re-reads the latest committed count after waiting for the row
+    lock, so `before` is exactly what the UPDATE starts from. No row at all
+    means the period row does not exist yet; `after` NULL means nothing is left.
+    """
+    cur = (
+        select(all_models.UsageRecord.id, all_models.UsageRecord.request_count)
+        .where(all_models.UsageRecord.organization_id == org_id)
+        .where(all_models.UsageRecord.period_start == period_start)
+        .with_for_update()
+        .cte("cur")
+    )
+    upd = (
+        update(all_models.UsageRecord)
+        .where(all_models.UsageRecord.id == cur.c.id)
+        .where(cur.c.request_count < plan_limit)
+        .values(
+            request_count=all_models.UsageRecord.request_count + func.least(units, plan_limit - cur.c.request_count),
+            last_updated=func.now(),
+        )
+        .returning(all_models.UsageRecord.request_count)
+        .cte("upd")
+    )
+    return select(cur.c.request_count.label("before"), upd.c.request_count.label("after")).select_from(
+        cur.outerjoin(upd, true())
+    )
+
+
+def build_batch_reserve_statement(items: Sequence[BatchItem]):
+    """
+    Partial reservations for many existing usage_records rows in one statement:
+
+        WITH cur AS (SELECT usage_records.id, organization_id, period_start, request_count, v.units, v.quota
+                     FROM usage_records JOIN (VALUES ...) AS v ON org, period
+                     ORDER BY usage_records.id FOR UPDATE OF usage_records),
+             upd AS (UPDATE usage_records SET request_count = request_count + LEAST(cur.units, cur.quota - cur.request_count)
+                     FROM cur WHERE usage_records.id = cur.id AND cur.request_count < cur.quota
+                     RETURNING usage_records.id, usage_records.request_count)
+        SELECT cur.organization_id, cur.period_start, cur.request_count, upd.request_count
+        FROM cur LEFT OUTER JOIN upd ON upd.id = cur.id
+
+    The same guarded `request_count + delta` as build_reserve_statement, row by
+    row. Rows are locked in id order so that concurrent batches cannot deadlock.
+    """
+    record = all_models.UsageRecord
+    batch = values(
+        column("organization_id", Integer),
+        column("period_start", DateTime(timezone=True)),
+        column("units", Integer),
+        column("quota", Integer),
+        name="v",
+    ).data([(item.org_id, item.period_start, item.units, item.limit) for item in items])
+    cur = (
+        select(record.id, record.organization_id, record.period_start, record.request_count, batch.c.units, batch.c.quota)
+        .join(batch, and_(
+            record.organization_id == batch.c.organization_id,
+            record.period_start == batch.c.period_start,
+        ))
+        .order_by(record.id)
+        .with_for_update(of=record)
+        .cte("cur")
+    )
+    upd = (
+        update(record)
+        .where(record.id == cur.c.id)
+        .where(cur.c.request_count < cur.c.quota)
+        .values(
+            request_count=record.request_count + func.least(cur.c.units, cur.c.quota - cur.c.request_count),
+            last_updated=func.now(),
+        )
+        .returning(record.id, record.request_count)
+        .cte("upd")
+    )
+    return select(
+        cur.c.organization_id, cur.c.period_start, cur.c.request_count.label("before"), upd.c.request_count.label("after")
+    ).select_from(cur.outerjoin(upd, upd.c.id == cur.c.id))
+
+
+async def reserve_units(
+    db: AsyncSession, org_id: int, period_start: datetime, units: int, plan_limit: int
+) -> tuple[int, int]:
+    """
+    Atomically reserve up to `units`, never going past `plan_limit`.
+    Returns (request_count before the reservation, units granted); granted is
+    smaller than `units` when the reservation straddles the limit, 0 once it is reached.
+    """
+    stmt = build_reserve_statement(org_id, period_start, units, plan_limit)
+    for _ in range(2):
+        started = time.perf_counter()
+        row = (await db.execute(stmt)).first()
+        metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+        if row is not None:
+            before, after = row
+            return before, (0 if after is None else after - before)
+        # First reservation of the period: create the row, then retry
+        await db.execute(
+            pg_insert(all_models.UsageRecord)
+            .values(organization_id=org_id, period_start=period_start, request_count=0)
+            .on_conflict_do_nothing(index_elements=["organization_id", "period_start"])
+        )
+    raise HTTPException(status_code=500, detail="Metering error.")
+
+
+class PostgresMeteringBackend(MeteringBackend):
+    """Counters in usage_records, one row per (organization, period). Each call runs in its own short transaction."""
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+        # organization_id -> the (at most two) latest period_starts whose rows this
+        # process has seen: the current window's and, once prepared, the next one's
+        self._known_rows: dict[int, tuple[datetime, ...]] = {}
+
+    def _knows_row(self, org_id: int, period_start: datetime) -> bool:
+        return period_start in self._known_rows.get(org_id, ())
+
+    def _saw_row(self, org_id: int, period_start: datetime) -> None:
+        known = self._known_rows.get(org_id, ())
+        if period_start not in known:
+            self._known_rows[org_id] = tuple(sorted((*known, period_start))[-2:])
+
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        async with self.session_factory() as db:
+            if partial:
+                before, granted = await reserve_units(db, org_id, period_start, units, limit)
+                await self._commit(db)
+                return Reservation(granted, before + granted)
+
+            if units > limit:
+                return Reservation(0, None)
+            if prepared.enabled():
+                return await self._reserve_prepared(db, org_id, period_start, units, limit)
+            if self._knows_row(org_id, period_start):
+                started = time.perf_counter()
+                result = await db.execute(build_update_statement(org_id, period_start, units, limit))
+                new_count = result.scalar_one_or_none()
+                metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+                if new_count is not None:
+                    await self._commit(db)
+                    return Reservation(units, new_count)
+                # Over the limit, or the row was removed: the upsert tells which
+
+            started = time.perf_counter()
+            result = await db.execute(build_metering_statement(org_id, period_start, units, limit))
+            new_count = result.scalar_one_or_none()
+            metrics.UPSERT.observe(time.perf_counter() - started)
+            if new_count is None:
+                # ON CONFLICT DO UPDATE holds the row lock even when its WHERE
+                # clause rejects the update: end the transaction right away.
+                await db.rollback()
+                self._saw_row(org_id, period_start)
+                return Reservation(0, None)
+            await self._commit(db)
+            self._saw_row(org_id, period_start)
+            return Reservation(units, new_count)
+
+    # Rows per statement: keeps the bind parameters well under asyncpg's 32767
+    BATCH_ROWS = 1000
+
+    async def _reserve_prepared(
+        self, db: AsyncSession, org_id: int, period_start: datetime, units: int, limit: int
+    ) -> Reservation:
+        """The all-or-nothing path on prepared statements; each runs in its own implicit transaction."""
+        if self._knows_row(org_id, period_start):
+            started = time.perf_counter()
+            new_count = await prepared.fetchval(db, prepared.METER_UPDATE, org_id, period_start, units, limit)
+            metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+            if new_count is not None:
+                return Reservation(units, new_count)
+
+        started = time.perf_counter()
+        new_count = await prepared.fetchval(db, prepared.METER_UPSERT, org_id, period_start, units, limit)
+        metrics.UPSERT.observe(time.perf_counter() - started)
+        self._saw_row(org_id, period_start)  # refused or not, the row exists now
+        return Reservation(0, None) if new_count is None else Reservation(units, new_count)
+
+    async def reserve_batch(self, items: Sequence[BatchItem]) -> list[Reservation]:
+        results: dict[tuple[int, datetime], Reservation] = {}
+        # Sorted, so that concurrent batches create and lock rows in the same order
+        ordered = sorted(items, key=lambda item: (item.org_id, item.period_start))
+        async with self.session_factory() as db:
+            for start in range(0, len(ordered), self.BATCH_ROWS):
+                chunk = [item for item in ordered[start:start + self.BATCH_ROWS] if item.units > 0]
+                if not chunk:
+                    continue
+                # First usage of a period: create its rows, then reserve on all of them at once
+                await db.execute(
+                    pg_insert(all_models.UsageRecord)
+                    .values([
+                        {"organization_id": item.org_id, "period_start": item.period_start, "request_count": 0}
+                        for item in chunk
+                    ])
+                    .on_conflict_do_nothing(index_elements=["organization_id", "period_start"])
+                )
+                started = time.perf_counter()
+                rows = (await db.execute(build_batch_reserve_statement(chunk))).all()
+                metrics.BATCH_UPDATE.observe(time.perf_counter() - started)
+                await self._commit(db)
+                for org_id, period_start, before, after in rows:
+                    results[(org_id, period_start)] = (
+                        Reservation(0, before) if after is None else Reservation(after - before, after)
+                    )
+        return [results.get((item.org_id, item.period_start), Reservation(0, None)) for item in items]
+
+    async def prepare_period(self, period_start: datetime, orgs: Sequence[tuple[int, int]]) -> None:
+        if not orgs:
+            return
+        async with self.session_factory() as db:
+            await db.execute(
+                pg_insert(all_models.UsageRecord)
+                .values([
+                    {"organization_id": org_id, "period_start": period_start, "request_count": 0}
+                    for org_id, _ in sorted(orgs)
+                ])
+                .on_conflict_do_nothing(index_elements=["organization_id", "period_start"])
+            )
+            await self._commit(db)
+        for org_id, _ in orgs:
+            self._saw_row(org_id, period_start)
+
+    async def store_counts(
+        self, counts: Sequence[tuple[int, datetime, int]], released: Sequence[tuple[int, datetime, int]] = ()
+    ) -> None:
+        """
+        Raise the counters of (org_id, period_start, count) triples to values
+        kept elsewhere (a cache in front of this backend), creating missing
+        rows, with one multi-row upsert per BATCH_ROWS counters. Never lowers a
+        counter: a writer holding a stale value cannot move it backwards. The
+        cache's own decreases come as (org_id, period_start, units) `released`
+        and are taken off first, in the same transaction, so they land exactly
+        once and together with the values they were read with.
+        """
+        record = all_models.UsageRecord
+        ordered = sorted(counts)
+        async with self.session_factory() as db:
+            for org_id, period_start, units in sorted(released):
+                await db.execute(
+                    update(record)
+                    .where(record.organization_id == org_id)
+                    .where(record.period_start == period_start)
+                    .values(request_count=func.greatest(record.request_count - units, 0))
+                )
+            for start in range(0, len(ordered), self.BATCH_ROWS):
+                stmt = pg_insert(record).values([
+                    {"organization_id": org_id, "period_start": period_start, "request_count": count}
+                    for org_id, period_start, count in ordered[start:start + self.BATCH_ROWS]
+                ])
+                await db.execute(stmt.on_conflict_do_update(
+                    index_elements=["organization_id", "period_start"],
+                    set_={
+                        "request_count": func.greatest(record.request_count, stmt.excluded.request_count),
+                        "last_updated": func.now(),
+                    },
+                ))
+            await self._commit(db)
+
+    @staticmethod
+    async def _commit(db: AsyncSession) -> None:
+        started = time.perf_counter()
+        await db.commit()
+        metrics.COMMIT.observe(time.perf_counter() - started)
+
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        async with self.session_factory() as db:
+            await db.execute(
+                update(all_models.UsageRecord)
+                .where(all_models.UsageRecord.organization_id == org_id)
+                .where(all_models.UsageRecord.period_start == period_start)
+                .values(request_count=func.greatest(all_models.UsageRecord.request_count - units, 0))
+            )
+            await db.commit()
+
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(all_models.UsageRecord.request_count)
+                .where(all_models.UsageRecord.organization_id == org_id)
+                .where(all_models.UsageRecord.period_start == period_start)
+            )
+            return result.scalar_one_or_none() or 0
+
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        async with self.session_factory() as db:
+            await db.execute(
+                update(all_models.UsageRecord)
+                .where(all_models.UsageRecord.organization_id == org_id)
+                .where(all_models.UsageRecord.period_start == period_start)
+                .values(request_count=0)
+            )
+            await db.commit()
@@ -0,0 +1,251 @@
+"""
+Counters in a Redis-protocol store, synced to usage_records for billing.
+
+Each (organization, period) counter is one string key. Check-and-increment
+is a single Lua script, so it is as atomic as the guarded UPDATE it replaces
+without any row lock; the same script keeps the key's expiry at the end of
+the window (get_next_window) plus REDIS_COUNTER_GRACE_SECONDS, long enough for
+the last sync to see it.
+
+Keys that change are added to a "dirty" set. Every worker periodically tries
+to take the sync lock; the holder pops batches of it and writes the current
+values to usage_records with one multi-row upsert
+(PostgresMeteringBackend.store_counts). That upsert only ever raises a
+counter, so a sync that outlived its lock cannot write an older value over a
+newer one. Releases therefore also add their units to a "released" hash; a
+sync reads each counter and takes its released units in one script, and
+subtracts them in the same transaction as the upsert, so a release racing
+a sync lands in usage_records exactly once.
+
+Whatever Redis loses before a sync, at most REDIS_SYNC_INTERVAL_SECONDS of
+usage, is lost for billing and for enforcement alike. A counter missing
+from Redis is seeded from usage_records before its next reservation, so a
+restarted or flushed store resumes from the last sync rather than from
+zero, but the units admitted since that sync are admitted again: a tenant
+can go over its quota by up to one sync interval of its traffic.
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Sequence
+
+import structlog
+from redis import asyncio as aioredis
+
+from app.core import metering
+from app.core.backends.base import MeteringBackend, Reservation
+from app.core.backends.postgres import PostgresMeteringBackend
+
+logger = structlog.get_logger()
+
+# KEYS: counter, dirty set. ARGV: units, limit, partial (0/1), expire_at.
+# Returns {granted, count}, or {-1, 0} when the counter is not in the store.
+RESERVE_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if not count then
+    return {-1, 0}
+end
+count = tonumber(count)
+local units, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+local available = math.max(limit - count, 0)
+local granted = 0
+if ARGV[3] == '1' then
+    granted = math.min(units, available)
+elseif units <= available then
+    granted = units
+end
+if granted > 0 then
+    count = redis.call('INCRBY', KEYS[1], granted)
+    redis.call('SADD', KEYS[2], KEYS[1])
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[4])
+return {granted, count}
+"""
+
+# KEYS: counter. ARGV: count, expire_at. Never overwrites a live counter.
+SEED_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX') then
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+return tonumber(redis.call('GET', KEYS[1]))
+"""
+
+# KEYS: counter, dirty set, released hash. ARGV: units.
+# Returns the units released, or -1 when the counter is not in the store.
+RELEASE_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if not count then
+    return -1
+end
+local released = math.min(tonumber(ARGV[1]), tonumber(count))
+if released > 0 then
+    redis.call('DECRBY', KEYS[1], released)
+    redis.call('HINCRBY', KEYS[3], KEYS[1], released)
+    redis.call('SADD', KEYS[2], KEYS[1])
+end
+return released
+"""
+
+# KEYS: released hash, then counters. Returns {count, released} per counter
+# (count -1 when it expired) and clears their released units, atomically.
+TAKE_SCRIPT = """
+local result = {}
+for i = 2, #KEYS do
+    local count = redis.call('GET', KEYS[i])
+    local released = redis.call('HGET', KEYS[1], KEYS[i])
+    redis.call('HDEL', KEYS[1], KEYS[i])
+    table.insert(result, tonumber(count or -1))
+    table.insert(result, tonumber(released or 0))
+end
+return result
+"""
+
+# KEYS: sync lock. ARGV: holder's token. Never deletes a lock that expired and was taken by another worker.
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisMeteringBackend(MeteringBackend):
+    def __init__(
+        self,
+        client: aioredis.Redis,
+        durable: PostgresMeteringBackend,
+        prefix: str = "metering",
+        sync_interval: float = 5.0,
+        grace_seconds: int = 3600,
+        sync_batch: int = 1000,
+    ):
+        self.client = client
+        self.durable = durable
+        self.prefix = prefix
+        self.sync_interval = sync_interval
+        self.grace_seconds = grace_seconds
+        self.sync_batch = sync_batch
+        self.dirty_key = f"{prefix}:dirty"
+        self.released_key = f"{prefix}:released"
+        self.lock_key = f"{prefix}:sync-lock"
+        # Long enough for a slow sync; a worker that dies holding it only delays the next one
+        self.lock_ms = int(max(sync_interval * 10, 30) * 1000)
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+        self._seed = client.register_script(SEED_SCRIPT)
+        self._release = client.register_script(RELEASE_SCRIPT)
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._unlock = client.register_script(UNLOCK_SCRIPT)
+        self._sync_task: asyncio.Task | None = None
+
+    def _key(self, org_id: int, period_start: datetime) -> str:
+        return f"{self.prefix}:{org_id}:{int(period_start.timestamp())}"
+
+    def _parse_key(self, key: str) -> tuple[int, datetime]:
+        _, org_id, period = key.rsplit(":", 2)
+        return int(org_id), datetime.fromtimestamp(int(period), timezone.utc)
+
+    def _expire_at(self, period_start: datetime) -> int:
+        return int(metering.get_next_window(period_start).timestamp()) + self.grace_seconds
+
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        self._start_sync()
+        expire_at = self._expire_at(period_start)
+        if expire_at <= time.time():
+            # Late usage for a closed window: its key would expire before the next sync
+            return await self.durable.reserve(org_id, period_start, units, limit, partial=partial, slots=slots)
+        key = self._key(org_id, period_start)
+        args = [units, limit, int(partial), expire_at]
+        granted, count = await self._reserve(keys=[key, self.dirty_key], args=args)
+        if granted < 0:
+            # Not in the store (new window, eviction or a restart): start from the last synced count
+            await self._seed(keys=[key], args=[await self.durable.peek(org_id, period_start), expire_at])
+            granted, count = await self._reserve(keys=[key, self.dirty_key], args=args)
+        if not granted and not partial:
+            return Reservation(0, None)
+        return Reservation(granted, count)
+
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        key = self._key(org_id, period_start)
+        released = await self._release(keys=[key, self.dirty_key, self.released_key], args=[units])
+        if released < 0:
+            # Not in the store: usage_records is the counter
+            await self.durable.release(org_id, period_start, units)
+
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        count = await self.client.get(self._key(org_id, period_start))
+        if count is None:
+            return await self.durable.peek(org_id, period_start)
+        return int(count)
+
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        key = self._key(org_id, period_start)
+        await self.durable.reset(org_id, period_start)
+        await self.client.delete(key)
+        await self.client.hdel(self.released_key, key)
+
+    async def prepare_period(self, period_start: datetime, orgs: Sequence[tuple[int, int]]) -> None:
+        await self.durable.prepare_period(period_start, orgs)
+
+    async def sync(self) -> int:
+        """
+        Write every counter changed since the last sync to usage_records.
+        Returns how many; 0 when another worker holds the sync lock.
+        """
+        token = uuid.uuid4().hex
+        if not await self.client.set(self.lock_key, token, nx=True, px=self.lock_ms):
+            return 0
+        synced = 0
+        try:
+            while True:
+                keys = await self.client.spop(self.dirty_key, self.sync_batch)
+                if not keys:
+                    return synced
+                keys = [key.decode() if isinstance(key, bytes) else key for key in keys]
+                taken = await self._take(keys=[self.released_key, *keys])
+                pairs = list(zip(keys, taken[::2], taken[1::2]))
+                # An expired counter was synced before it expired: nothing left to write
+                counts = [(*self._parse_key(key), count) for key, count, _ in pairs if count >= 0]
+                released = [(*self._parse_key(key), units) for key, _, units in pairs if units > 0]
+                try:
+                    await self.durable.store_counts(counts, released)
+                except BaseException:
+                    if released:
+                        async with self.client.pipeline(transaction=True) as pipe:
+                            for key, _, units in pairs:
+                                if units > 0:
+                                    pipe.hincrby(self.released_key, key, units)
+                            await pipe.execute()
+                    await self.client.sadd(self.dirty_key, *keys)
+                    raise
+                synced += len(keys)
+        finally:
+            await self._unlock(keys=[self.lock_key], args=[token])
+
+    async def _sync_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("redis_counter_sync_error", error=str(exc))
+
+    def _start_sync(self) -> None:
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_forever())
+
+    async def close(self) -> None:
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        await self.sync()
+        await self.client.aclose()
+        await self.durable.close()
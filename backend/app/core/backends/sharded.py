@@ -0,0 +1,240 @@
+"""
+PostgreSQL counters split over K slot rows per (organization, period).
+
+With a single usage_records row every request for a hot tenant queues on one
+row lock. Here the period's quota is divided between K rows in
+usage_record_slots; slot i may hold `limit // K` units, plus one for the
+first `limit % K` slots, so the shares add up to exactly the limit and no
+interleaving of slot updates can over-admit.
+
+A reservation prefers a random slot and moves on to the next one with room
+(SKIP LOCKED, so it never queues behind another request while a free slot
+exists). Near exhaustion this is how a request "borrows" the share of other
+slots. An all-or-nothing request that fits in no single slot locks all of
+them, in slot order, and takes its units across them in one transaction, or
+nothing: no other request ever sees units it is about to give back. K is the
+plan's counter_slots when the period's rows are created; changes to it apply
+from the next window, quota changes apply immediately.
+"""
+import random
+import time
+from datetime import datetime
+from typing import Sequence
+from sqlalchemy import case, delete, literal, select, true, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.sql import func
+from app.core import metrics
+from app.core.backends.base import MeteringBackend, Reservation
+from app.core.db import AsyncSessionLocal
+from app.models import all_models
+
+Slot = all_models.UsageRecordSlot
+
+
+def _period_slots(org_id: int, period_start: datetime):
+    return (Slot.organization_id == org_id, Slot.period_start == period_start)
+
+
+def build_slot_reserve_statement(
+    org_id: int, period_start: datetime, units: int, plan_limit: int, need: int, preferred: int, skip_locked: bool
+):
+    """
+    Take up to `units` from one slot that has room for at least `need`:
+
+        WITH k AS (SELECT count(*) AS n FROM usage_record_slots WHERE org, period),
+             pick AS (SELECT id, request_count, :limit / k.n + (slot < :limit % k.n)::int AS share
+                      FROM usage_record_slots, k WHERE org, period AND request_count + :need <= share
+                      ORDER BY (slot - :preferred + k.n) % k.n
+                      LIMIT 1 FOR UPDATE OF usage_record_slots SKIP LOCKED),
+             upd AS (UPDATE usage_record_slots SET request_count = request_count + LEAST(:units, share - pick.request_count)
+                     FROM pick WHERE id = pick.id RETURNING request_count - pick.request_count AS granted)
+        SELECT k.n, upd.granted, (SELECT sum(request_count) FROM usage_record_slots WHERE org, period)
+        FROM k LEFT OUTER JOIN upd ON true
+
+    n = 0 means the period's slots do not exist yet. The sum is read from the
+    statement's snapshot, i.e. without this reservation.
+    """
+    k = select(func.count().label("n")).where(*_period_slots(org_id, period_start)).cte("k")
+    share = literal(plan_limit) // k.c.n + case((Slot.slot < func.mod(plan_limit, k.c.n), 1), else_=0)
+    pick = (
+        select(Slot.id, Slot.request_count, share.label("share"))
+        .select_from(Slot)
+        .join(k, true())
+        .where(*_period_slots(org_id, period_start))
+        .where(Slot.request_count + need <= share)
+        .order_by(func.mod(Slot.slot - preferred + k.c.n, k.c.n))
+        .limit(1)
+        .with_for_update(of=Slot, skip_locked=skip_locked)
+        .cte("pick")
+    )
+    upd = (
+        update(Slot)
+        .where(Slot.id == pick.c.id)
+        .values(
+            request_count=Slot.request_count + func.least(units, pick.c.share - pick.c.request_count),
+            last_updated=func.now(),
+        )
+        .returning((Slot.request_count - pick.c.request_count).label("granted"))
+        .cte("upd")
+    )
+    total = select(func.coalesce(func.sum(Slot.request_count), 0)).where(*_period_slots(org_id, period_start))
+    return select(k.c.n, upd.c.granted, total.scalar_subquery().label("total")).select_from(
+        k.outerjoin(upd, true())
+    )
+
+
+class ShardedPostgresMeteringBackend(MeteringBackend):
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    async def _create_slots(self, db: AsyncSession, org_id: int, period_start: datetime, slots: int) -> None:
+        await db.execute(
+            pg_insert(Slot)
+            .values([
+                {"organization_id": org_id, "period_start": period_start, "slot": slot, "request_count": 0}
+                for slot in range(max(slots, 1))
+            ])
+            .on_conflict_do_nothing(index_elements=["organization_id", "period_start", "slot"])
+        )
+        await db.commit()
+
+    async def prepare_period(self, period_start: datetime, orgs: Sequence[tuple[int, int]]) -> None:
+        rows = [
+            {"organization_id": org_id, "period_start": period_start, "slot": slot, "request_count": 0}
+            for org_id, slots in sorted(orgs)
+            for slot in range(max(slots, 1))
+        ]
+        async with self.session_factory() as db:
+            # K rows per org: keep each statement's bind parameters under asyncpg's 32767
+            for start in range(0, len(rows), 5000):
+                await db.execute(
+                    pg_insert(Slot)
+                    .values(rows[start:start + 5000])
+                    .on_conflict_do_nothing(index_elements=["organization_id", "period_start", "slot"])
+                )
+                await db.commit()
+
+    async def _reserve_across_slots(
+        self, db: AsyncSession, org_id: int, period_start: datetime, units: int, limit: int, preferred: int
+    ) -> Reservation:
+        """All of `units` from as many slots as it takes, in one transaction, or nothing."""
+        started = time.perf_counter()
+        rows = (await db.execute(
+            select(Slot.id, Slot.slot, Slot.request_count)
+            .where(*_period_slots(org_id, period_start))
+            .order_by(Slot.slot)  # the same lock order as release(): no deadlock
+            .with_for_update()
+        )).all()
+        n = len(rows)
+        rooms = [
+            (slot_id, count, max(limit // n + (slot < limit % n) - count, 0))
+            for slot_id, slot, count in rows
+        ] if n else []
+        if sum(room for _, _, room in rooms) < units:
+            await db.rollback()
+            metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+            return Reservation(0, None)
+
+        remaining = units
+        for slot_id, count, room in rooms[preferred % n:] + rooms[:preferred % n]:
+            if remaining == 0:
+                break
+            taken = min(room, remaining)
+            if taken:
+                await db.execute(
+                    update(Slot).where(Slot.id == slot_id).values(request_count=count + taken, last_updated=func.now())
+                )
+                remaining -= taken
+        metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+        await self._commit(db)
+        return Reservation(units, sum(count for _, count, _ in rooms) + units)
+
+    @staticmethod
+    async def _commit(db: AsyncSession) -> None:
+        started = time.perf_counter()
+        await db.commit()
+        metrics.COMMIT.observe(time.perf_counter() - started)
+
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        """
+        Slot by slot, the returned count is approximate under concurrency: the
+        slots' sum as of the last slot statement's snapshot plus what that
+        statement took, so it misses units other requests committed meanwhile
+        and X-RateLimit-Used may lag. Enforcement does not depend on it; across
+        all slots (everything locked) it is exact.
+        """
+        preferred = random.randrange(max(slots, 1))
+        granted = 0
+        total = None
+        # All-or-nothing asks one slot for everything first, then falls back
+        # to _reserve_across_slots; `split` gathers slot by slot, committing each.
+        split = partial or units == 1
+        skip_locked = True
+        created = False
+
+        async with self.session_factory() as db:
+            while granted < units:
+                remaining = units - granted
+                stmt = build_slot_reserve_statement(
+                    org_id, period_start, remaining, limit,
+                    need=1 if split else remaining, preferred=preferred, skip_locked=skip_locked,
+                )
+                started = time.perf_counter()
+                n, taken, before = (await db.execute(stmt)).one()
+                metrics.GUARDED_UPDATE.observe(time.perf_counter() - started)
+
+                if n == 0 and not created:
+                    await db.rollback()
+                    await self._create_slots(db, org_id, period_start, slots)
+                    created = True
+                    continue
+                if taken:
+                    # Commit each slot on its own: never hold two slot locks at once
+                    await db.commit()
+                    granted += taken
+                    total = before + taken
+                    skip_locked = True
+                    continue
+                await db.rollback()
+                if skip_locked:
+                    skip_locked = False  # every slot with room may just be locked: wait for one
+                elif not split:
+                    return await self._reserve_across_slots(db, org_id, period_start, units, limit, preferred)
+                else:
+                    break
+
+        if granted < units and not partial:
+            return Reservation(0, None)  # a single unit: nothing was taken
+        return Reservation(granted, total if total is not None else await self.peek(org_id, period_start))
+
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        async with self.session_factory() as db:
+            rows = await db.execute(
+                select(Slot.id, Slot.request_count)
+                .where(*_period_slots(org_id, period_start))
+                .where(Slot.request_count > 0)
+                .order_by(Slot.slot)
+                .with_for_update()
+            )
+            for slot_id, count in rows.all():
+                if units <= 0:
+                    break
+                taken = min(count, units)
+                await db.execute(update(Slot).where(Slot.id == slot_id).values(request_count=count - taken))
+                units -= taken
+            await db.commit()
+
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(func.coalesce(func.sum(Slot.request_count), 0)).where(*_period_slots(org_id, period_start))
+            )
+            return result.scalar_one()
+
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        async with self.session_factory() as db:
+            await db.execute(delete(Slot).where(*_period_slots(org_id, period_start)))
+            await db.commit()
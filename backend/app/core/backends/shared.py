@@ -0,0 +1,374 @@
+"""
+Host-local counter tier shared by every worker process on one machine.
+
+Counters live in a `multiprocessing.shared_memory` block laid out as a fixed
+open-addressed table of int64 rows keyed by (organization, period). Each row
+holds what the database had at the last flush (`base`), the delta being
+flushed right now (`inflight`) and the delta admitted since (`pending`).
+Requests are admitted against base + inflight + pending, under one fcntl
+lock on a file next to the block, so the workers of a host together never
+admit more than the quota left at the last flush. Deltas go to the inner
+backend (usage_records) every SHARED_COUNTER_FLUSH_INTERVAL_MS, or as soon as
+a row's pending delta reaches SHARED_COUNTER_FLUSH_THRESHOLD, as one partial
+reservation per row.
+
+Only this host's requests are seen between flushes: writes to the same
+counter from elsewhere (another host, bulk ingestion) can be over-admitted by
+at most one pending delta, and the flush never takes the database counter
+past the limit. A worker that dies leaves its admissions in the block, where
+the next flush picks them up. Each row records which worker is flushing it:
+a delta left in flight by a worker that has since died is reclaimed, and
+flushed again unless the inner backend's count shows it had landed.
+"""
+import asyncio
+import fcntl
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker, shared_memory
+from typing import Sequence
+
+import structlog
+
+from app.core.backends.base import MeteringBackend, Reservation
+
+logger = structlog.get_logger()
+
+# Row layout, in int64 words. FLUSHER: pid of the worker whose flush of INFLIGHT is under way
+ORG, PERIOD, LIMIT, SLOTS, BASE, INFLIGHT, PENDING, FLUSHER = range(8)
+FIELDS = 8
+LAYOUT_VERSION = 2  # part of the block name: workers on different layouts never share a block
+
+EMPTY = 0  # never used: organization ids start at 1
+TOMBSTONE = -1  # evicted row; probing continues past it
+MAX_PROBES = 32  # a key is never stored further than this from its home row
+
+
+class SharedCounterTable:
+    """The shared block and its lock. Every method except `scan` must run under `locked()`."""
+
+    def __init__(self, name: str, capacity: int):
+        self.capacity = capacity
+        size = capacity * FIELDS * 8
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # The block outlives any one worker: don't let this process' tracker unlink it at exit
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        self.words = self._shm.buf.cast("q")
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        # fcntl locks are per process: threads of one worker also need to exclude each other
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._thread_lock:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, 0)
+
+    def try_lock_flusher(self) -> bool:
+        """One worker per host sweeps the table at a time; the others skip their turn."""
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, 1)
+            return True
+        except OSError:
+            return False
+
+    def unlock_flusher(self) -> None:
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, 1)
+
+    def find(self, org_id: int, period: int, insert: bool = False) -> int:
+        """Row index of (org_id, period), claiming a free row if `insert`; -1 if absent or no room."""
+        words = self.words
+        home = (org_id * 2654435761 + period) % self.capacity
+        free = -1
+        for probe in range(MAX_PROBES):
+            index = (home + probe) % self.capacity
+            org = words[index * FIELDS + ORG]
+            if org == EMPTY:
+                if free < 0:
+                    free = index
+                break
+            if org == TOMBSTONE:
+                if free < 0:
+                    free = index
+            elif org == org_id and words[index * FIELDS + PERIOD] == period:
+                return index
+        if not insert or free < 0:
+            return -1
+        row = free * FIELDS
+        for field in range(FIELDS):
+            words[row + field] = 0
+        words[row + PERIOD] = period
+        words[row + ORG] = org_id
+        return free
+
+    def get(self, index: int, field: int) -> int:
+        return self.words[index * FIELDS + field]
+
+    def set(self, index: int, field: int, value: int) -> None:
+        self.words[index * FIELDS + field] = value
+
+    def add(self, index: int, field: int, amount: int) -> None:
+        self.words[index * FIELDS + field] += amount
+
+    def used(self, index: int) -> int:
+        row = index * FIELDS
+        return self.words[row + BASE] + self.words[row + INFLIGHT] + self.words[row + PENDING]
+
+    def evict(self, index: int) -> None:
+        self.words[index * FIELDS + ORG] = TOMBSTONE
+
+    def scan(self) -> list[tuple[int, int, int]]:
+        """(index, org_id, period) of every live row. Lock-free snapshot: re-check under the lock before use."""
+        words = self.words
+        return [
+            (index, words[index * FIELDS + ORG], words[index * FIELDS + PERIOD])
+            for index in range(self.capacity)
+            if words[index * FIELDS + ORG] > 0
+        ]
+
+    def close(self, unlink: bool = False) -> None:
+        self.words.release()
+        self._shm.close()
+        os.close(self._lock_fd)
+        if unlink:
+            resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
+            os.unlink(self._lock_path)
+
+
+def _period_key(period_start: datetime) -> int:
+    return int(period_start.timestamp())
+
+
+def _period_start(period: int) -> datetime:
+    return datetime.fromtimestamp(period, timezone.utc)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by someone else
+    return True
+
+
+class SharedMemoryMeteringBackend(MeteringBackend):
+    """
+    Admits from the host's shared table and writes through to `inner` in
+    aggregated deltas. Falls back to `inner` directly for a counter the
+    table has no room for.
+    """
+
+    def __init__(
+        self,
+        inner: MeteringBackend,
+        table: SharedCounterTable,
+        flush_interval: float = 0.25,
+        flush_threshold: int = 100,
+    ):
+        self.inner = inner
+        self.table = table
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._flush_task: asyncio.Task | None = None
+        self._threshold_flushes: set[asyncio.Task] = set()
+
+    def _admit(self, index: int, units: int, limit: int, slots: int, partial: bool) -> tuple[Reservation, bool]:
+        table = self.table
+        table.set(index, LIMIT, limit)
+        table.set(index, SLOTS, slots)
+        used = table.used(index)
+        available = max(limit - used, 0)
+        granted = min(units, available) if partial else (units if units <= available else 0)
+        table.add(index, PENDING, granted)
+        return Reservation(granted, used + granted), table.get(index, PENDING) >= self.flush_threshold
+
+    async def reserve(
+        self, org_id: int, period_start: datetime, units: int, limit: int, *, partial: bool = False, slots: int = 1
+    ) -> Reservation:
+        self._start_flusher()
+        period = _period_key(period_start)
+        with self.table.locked():
+            index = self.table.find(org_id, period)
+            if index >= 0:
+                reservation, due = self._admit(index, units, limit, slots, partial)
+
+        if index < 0:
+            # First request of the window on this host: start from the database's count
+            base = await self.inner.peek(org_id, period_start)
+            with self.table.locked():
+                index = self.table.find(org_id, period)
+                if index < 0:
+                    index = self.table.find(org_id, period, insert=True)
+                    if index >= 0:
+                        self.table.set(index, BASE, base)
+                if index >= 0:
+                    reservation, due = self._admit(index, units, limit, slots, partial)
+            if index < 0:
+                return await self.inner.reserve(org_id, period_start, units, limit, partial=partial, slots=slots)
+
+        if due:
+            task = asyncio.create_task(self._flush(index, org_id, period))
+            self._threshold_flushes.add(task)
+            task.add_done_callback(self._threshold_flushes.discard)
+        return reservation
+
+    async def _reclaim(self, index: int, org_id: int, period: int) -> bool:
+        """
+        Take over a delta left in flight by a worker that died mid-flush. It
+        goes back to pending, unless the inner count already includes it (the
+        worker died after its write). Returns False if the row is not stale.
+        """
+        table = self.table
+        me = os.getpid()
+        with table.locked():
+            if table.get(index, ORG) != org_id or table.get(index, PERIOD) != period:
+                return False
+            flusher = table.get(index, FLUSHER)
+            if flusher == me or _alive(flusher):
+                return False
+            table.set(index, FLUSHER, me)  # only one worker reclaims it
+            base, inflight = table.get(index, BASE), table.get(index, INFLIGHT)
+
+        count = await self.inner.peek(org_id, _period_start(period))
+        # Exact when this host is the counter's only writer; writes from elsewhere
+        # in the meantime can make a lost delta look landed (under-, never over-billing)
+        landed = count - base >= inflight if inflight > 0 else count <= base + inflight
+        with table.locked():
+            if table.get(index, ORG) != org_id or table.get(index, PERIOD) != period or table.get(index, FLUSHER) != me:
+                return False
+            if landed:
+                table.set(index, BASE, count)
+            else:
+                table.add(index, PENDING, inflight)
+            table.set(index, INFLIGHT, 0)
+        logger.warning("shared_counter_reclaimed", org_id=org_id, units=inflight, dead_pid=flusher, landed=landed)
+        return True
+
+    async def _flush(self, index: int, org_id: int, period: int) -> None:
+        """Move a row's pending delta to the inner backend and refresh its base."""
+        table = self.table
+        with table.locked():
+            if table.get(index, ORG) != org_id or table.get(index, PERIOD) != period:
+                return  # evicted or reused
+            stale = table.get(index, INFLIGHT) != 0
+        if stale and not await self._reclaim(index, org_id, period):
+            return  # another worker is flushing it
+
+        with table.locked():
+            if table.get(index, ORG) != org_id or table.get(index, PERIOD) != period or table.get(index, INFLIGHT):
+                return  # evicted, reused, or another worker is flushing it
+            delta = table.get(index, PENDING)
+            if delta == 0:
+                return
+            table.set(index, INFLIGHT, delta)
+            table.set(index, FLUSHER, os.getpid())
+            table.set(index, PENDING, 0)
+            limit, slots = table.get(index, LIMIT), table.get(index, SLOTS)
+
+        period_start = _period_start(period)
+        try:
+            if delta > 0:
+                granted, count = await self.inner.reserve(org_id, period_start, delta, limit, partial=True, slots=slots)
+            else:
+                granted = delta
+                await self.inner.release(org_id, period_start, -delta)
+                count = None
+            if count is None:
+                count = await self.inner.peek(org_id, period_start)
+        except BaseException:
+            with table.locked():
+                if table.get(index, ORG) == org_id and table.get(index, PERIOD) == period:
+                    table.add(index, PENDING, table.get(index, INFLIGHT))
+                    table.set(index, INFLIGHT, 0)
+            raise
+
+        with table.locked():
+            if table.get(index, ORG) == org_id and table.get(index, PERIOD) == period:
+                table.set(index, BASE, count)
+                table.set(index, INFLIGHT, 0)
+        if granted < delta:
+            logger.warning("shared_counter_overadmitted", org_id=org_id, units=delta - granted)
+
+    async def flush(self, evict_before: int | None = None) -> None:
+        """Flush every row with a pending delta; evict idle rows of periods before `evict_before`."""
+        for index, org_id, period in self.table.scan():
+            await self._flush(index, org_id, period)
+            if evict_before is not None and period < evict_before:
+                with self.table.locked():
+                    if (
+                        self.table.get(index, ORG) == org_id
+                        and self.table.get(index, PERIOD) == period
+                        and not self.table.get(index, INFLIGHT)
+                        and not self.table.get(index, PENDING)
+                    ):
+                        self.table.evict(index)
+
+    async def _flush_forever(self) -> None:
+        from app.core.metering import get_period_start
+
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self.table.try_lock_flusher():
+                continue
+            try:
+                await self.flush(evict_before=_period_key(get_period_start()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("shared_counter_flush_error", error=str(exc))
+            finally:
+                self.table.unlock_flusher()
+
+    def _start_flusher(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_forever())
+
+    async def release(self, org_id: int, period_start: datetime, units: int) -> None:
+        with self.table.locked():
+            index = self.table.find(org_id, _period_key(period_start))
+            if index >= 0:
+                self.table.add(index, PENDING, -units)
+        if index < 0:
+            await self.inner.release(org_id, period_start, units)
+
+    async def peek(self, org_id: int, period_start: datetime) -> int:
+        with self.table.locked():
+            index = self.table.find(org_id, _period_key(period_start))
+            if index >= 0:
+                return self.table.used(index)
+        return await self.inner.peek(org_id, period_start)
+
+    async def reset(self, org_id: int, period_start: datetime) -> None:
+        await self.inner.reset(org_id, period_start)
+        with self.table.locked():
+            index = self.table.find(org_id, _period_key(period_start))
+            if index >= 0:
+                self.table.set(index, BASE, 0)
+                self.table.set(index, PENDING, 0)
+
+    async def prepare_period(self, period_start: datetime, orgs: Sequence[tuple[int, int]]) -> None:
+        await self.inner.prepare_period(period_start, orgs)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self.inner.close()
+        self.table.close()
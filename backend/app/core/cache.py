@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterator
+
+# Returned by TTLCache.get() on a miss, so that None can be cached as a value
+# (negative caching: "we looked, there is nothing").
+MISSING: Any = object()
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache with per-entry expiry.
+
+    Not thread-safe by design: every caller runs on the event loop, where a
+    plain OrderedDict needs no locking.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        entry = self._data.pop(key, None)
+        return MISSING if entry is None else entry[1]
+
+    def evict_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Drop every entry for which predicate(key, value) is true. Returns the number evicted."""
+        doomed = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+        for key in doomed:
+            del self._data[key]
+        return len(doomed)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._data))
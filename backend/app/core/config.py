@@ -1,3 +1,4 @@
+from typing import Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -17,11 +18,128 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # Sign organization and role into access tokens so metered requests never read the
+    # users table. Role or organization changes then apply at the next login; use
+    # principals.revoke_tokens() to cut existing tokens off immediately.
+    STATELESS_AUTH: bool = False
+
+    # Password hashing (Argon2id). Changing the costs re-hashes on next login.
+    ARGON2_TIME_COST: int = 3
+    ARGON2_MEMORY_COST: int = 65536 # KiB
+    ARGON2_PARALLELISM: int = 4
+    PASSWORD_HASH_WORKERS: int = 2 # Threads dedicated to hashing, off the event loop
+    PASSWORD_HASH_MAX_PENDING: int = 32 # Running + queued hashes before logins get 503
     
     # CORS
     BACKEND_CORS_ORIGINS: list[str] = ["http://localhost:8000", "http://localhost:3000"]
 
-    
+
+    # Where usage counters are stored
+    # "postgres": usage_records (durable, shared by every worker).
+    # "postgres_sharded": usage_record_slots, SubscriptionPlan.counter_slots rows per
+    # org and period, for hot tenants. "memory": process-local counters, for
+    # single-node deployments and tests. "shared_memory": a counter table shared by
+    # the workers of one host, flushed to SHARED_COUNTER_INNER_BACKEND in deltas.
+    # "redis": counters in REDIS_URL, synced to usage_records every REDIS_SYNC_INTERVAL_SECONDS.
+    METERING_BACKEND: Literal["postgres", "postgres_sharded", "memory", "shared_memory", "redis"] = "postgres"
+    MEMORY_BACKEND_SHARDS: int = 64 # Lock stripes of the memory backend
+    SHARED_COUNTER_INNER_BACKEND: Literal["postgres", "postgres_sharded"] = "postgres"
+    SHARED_COUNTER_NAME: str = "saas_metering_counters" # Shared memory block (and lock file) name, per host
+    SHARED_COUNTER_CAPACITY: int = 16384 # (org, period) rows; counters that find no room go straight to the database
+    SHARED_COUNTER_FLUSH_INTERVAL_MS: float = 250.0
+    SHARED_COUNTER_FLUSH_THRESHOLD: int = 100 # Flush a row early once this many units are pending
+    REDIS_URL: str = "redis://localhost:6379/0"
+    REDIS_KEY_PREFIX: str = "metering"
+    REDIS_SYNC_INTERVAL_SECONDS: float = 5.0 # Usage Redis can lose on a crash: unbilled, and admitted again over the quota
+    REDIS_COUNTER_GRACE_SECONDS: int = 3600 # Counters expire this long after their window ends
+
+    # Create next window's usage rows ahead of the boundary (postgres backends)
+    PERIOD_ROLLOVER_ENABLED: bool = True
+    PERIOD_ROLLOVER_LEAD_SECONDS: float = 600.0 # Capped at half a window
+    PERIOD_ROLLOVER_BATCH_SIZE: int = 1000 # Orgs per multi-row insert
+    PERIOD_ROLLOVER_RETRY_SECONDS: float = 30.0
+
+    # Metering strategy
+    # "direct": one guarded upsert per request. "leased": each worker reserves a
+    # chunk of the remaining quota and admits requests from it in memory.
+    # "coalesced": concurrent requests for one org share a single `+ k` update.
+    METERING_MODE: Literal["direct", "leased", "coalesced"] = "direct"
+    QUOTA_LEASE_MAX_CHUNK: int = 50
+    QUOTA_LEASE_PLAN_FRACTION: float = 0.01 # Chunk is at most this share of monthly_quota
+    QUOTA_LEASE_SHARE_DIVISOR: int = 4 # ...and at most remaining quota / divisor
+    QUOTA_LEASE_EXHAUSTED_TTL_SECONDS: float = 5.0 # How long a worker refuses an org after a lease refill got nothing
+    QUOTA_LEASE_SWEEP_INTERVAL_SECONDS: float = 60.0 # How often leases of closed windows are handed back
+    COALESCE_WINDOW_MS: float = 2.0 # How long a batch stays open for more requests
+    COALESCE_MAX_BATCH: int = 64 # ...or until this many have joined
+
+    # Bulk usage ingestion (POST /api/v1/usage/events, NDJSON)
+    USAGE_INGEST_MAX_EVENTS: int = 50000 # Per request; larger bodies get 413
+    USAGE_INGEST_MAX_LINE_BYTES: int = 4096
+    USAGE_INGEST_MAX_CLOCK_SKEW_SECONDS: float = 300.0 # Events further in the future are refused
+
+    # Enforce SubscriptionPlan.rate_limit_per_minute (in-memory GCRA, per worker)
+    RATE_LIMIT_ENABLED: bool = True
+
+    # Admission control: an adaptive (AIMD) cap on metered requests in flight per worker.
+    # Requests over it get an immediate 503; admin routes may exceed it by the headroom.
+    ADMISSION_CONTROL_ENABLED: bool = True
+    ADMISSION_INITIAL_LIMIT: int = 50
+    ADMISSION_MIN_LIMIT: int = 5
+    ADMISSION_MAX_LIMIT: int = 500
+    ADMISSION_LATENCY_TARGET_MS: float = 250.0 # Slower requests (or pool timeouts) shrink the cap
+    ADMISSION_BACKOFF: float = 0.9 # Multiplier applied to the cap on each decrease
+    ADMISSION_PRIORITY_HEADROOM: int = 5
+    ADMISSION_RETRY_AFTER_SECONDS: float = 1.0
+
+    # Plan cache: per-organization plan limits, evicted on plan/subscription writes
+    PLAN_CACHE_MAXSIZE: int = 10000
+    PLAN_CACHE_TTL_SECONDS: float = 60.0
+    PLAN_CACHE_NEGATIVE_TTL_SECONDS: float = 5.0 # "No active subscription" answers
+    EXHAUSTED_CACHE_MAXSIZE: int = 10000 # Orgs over quota, refused without a database round trip until the window ends
+    PRINCIPAL_CACHE_MAXSIZE: int = 10000 # Authenticated tokens kept without re-reading the users table
+    PRINCIPAL_CACHE_TTL_SECONDS: float = 60.0 # Capped by each token's own exp
+    CACHE_INVALIDATION_LISTENER: bool = True # LISTEN for invalidations published by other processes
+    CACHE_INVALIDATION_RETRY_SECONDS: float = 5.0
+    CACHE_INVALIDATION_DATABASE_URL: str | None = None # Listener connection; defaults to the app database
+
+    # Connection pool (per worker process)
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10 # Extra connections opened under bursts, closed when returned
+    DB_POOL_TIMEOUT: float = 10.0 # Seconds to wait for a connection before failing the request
+    DB_POOL_RECYCLE: int = 1800 # Replace connections older than this (seconds); -1 disables
+    DB_POOL_PRE_PING: bool = False # Test each connection on checkout: one extra round trip
+    # pgbouncer transaction pooling: no cached or reused prepared statement names.
+    # LISTEN does not work through it: set CACHE_INVALIDATION_DATABASE_URL to Postgres itself.
+    DB_PGBOUNCER_MODE: bool = False
+    # Run the per-request metering and auth statements as asyncpg prepared statements,
+    # prepared on each connection when it opens (off in pgbouncer mode)
+    PREPARED_STATEMENTS_ENABLED: bool = True
+
+    # SQL logging. Echo formats and logs every statement on the event loop: development only.
+    # The tracer times every statement, logs the slow ones plus a sample of the rest,
+    # and keeps per-fingerprint totals for GET /api/v1/admin/queries.
+    SQL_ECHO: bool = False
+    QUERY_TRACING_ENABLED: bool = True
+    SLOW_QUERY_THRESHOLD_MS: float = 100.0
+    QUERY_SAMPLE_RATE: float = 0.001
+    QUERY_STATS_MAX_FINGERPRINTS: int = 500
+
+    # Request logging: written off the event loop by a background thread
+    REQUEST_LOG_SAMPLE_RATE: float = 1.0 # Share of successful requests logged; errors and 429s always are
+    LOG_QUEUE_MAXSIZE: int = 10000 # Records beyond this are dropped rather than blocking requests
+
+    # Prometheus /metrics endpoint and event-loop lag sampling
+    METRICS_ENABLED: bool = True
+    LOOP_LAG_INTERVAL_SECONDS: float = 0.5
+
+    # Readiness (GET /api/v1/health/ready): a background probe every HEALTH_PROBE_INTERVAL_SECONDS,
+    # on its own connection; the instance reports not ready past any of these limits
+    HEALTH_PROBE_INTERVAL_SECONDS: float = 2.0
+    HEALTH_DB_TIMEOUT_SECONDS: float = 2.0
+    HEALTH_MAX_DB_LATENCY_MS: float = 500.0
+    HEALTH_MAX_LOOP_LAG_MS: float = 500.0
+    HEALTH_MAX_POOL_SATURATION: float = 1.0 # Share of pool_size + max_overflow checked out
+
     # Portfolio / Demo Configuration
     DEMO_MODE: bool = False # If True, uses 5-minute windows for easy testing. If False, uses Monthly windows.
 
@@ -1,8 +1,55 @@
+import time
+from uuid import uuid4
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.core import metrics, prepared, query_trace
 from app.core.config import settings
 
-engine = create_async_engine(settings.get_database_url(), echo=True)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """The default async pool, recording how long each checkout waited (including connects)."""
+
+    waiting = 0  # checkouts in progress right now, i.e. callers blocked on the pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        TimedQueuePool.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            TimedQueuePool.waiting -= 1
+            metrics.POOL_CHECKOUT.observe(time.perf_counter() - started)
+
+
+def _connect_args() -> dict:
+    if not settings.DB_PGBOUNCER_MODE:
+        return {}
+    # pgbouncer in transaction mode hands each transaction to whichever server
+    # connection is free: a statement prepared on one is unknown (or, worse,
+    # named the same as a different one) on the next.
+    return {
+        "statement_cache_size": 0,  # asyncpg's own cache
+        "prepared_statement_cache_size": 0,  # SQLAlchemy's asyncpg dialect cache
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    }
+
+
+engine = create_async_engine(
+    settings.get_database_url(),
+    echo=settings.SQL_ECHO,
+    poolclass=TimedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    connect_args=_connect_args(),
+)
+if settings.QUERY_TRACING_ENABLED:
+    query_trace.install(engine.sync_engine)
+if prepared.enabled():
+    prepared.install(engine.sync_engine)
 
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
@@ -17,3 +64,16 @@ class Base(DeclarativeBase):
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
+
+
+def pool_stats() -> dict:
+    """Live state of the application pool, for /metrics and the health check."""
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "waiting": TimedQueuePool.waiting,
+    }
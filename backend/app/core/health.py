@@ -0,0 +1,161 @@
+"""
+Readiness from a background probe, so health checks cost no pool connections.
+
+Every HEALTH_PROBE_INTERVAL_SECONDS a task runs `SELECT 1` on its own
+connection (outside the application pool) and records the result together
+with the pool's state and how late the event loop woke the task. Readiness
+endpoints only read that record. An instance is not ready while the
+database is unreachable or slower than HEALTH_MAX_DB_LATENCY_MS, the loop
+lags more than HEALTH_MAX_LOOP_LAG_MS, or HEALTH_MAX_POOL_SATURATION of
+pool_size + max_overflow is checked out. The load balancer then sends
+traffic elsewhere until this instance catches up. A record older than three
+intervals means the probe itself is stuck, which also counts as not ready.
+"""
+import asyncio
+import time
+from typing import NamedTuple
+
+import asyncpg
+import structlog
+from sqlalchemy.engine import make_url
+
+from app.core.config import settings
+from app.core.db import pool_stats
+
+logger = structlog.get_logger()
+
+
+class Readiness(NamedTuple):
+    ready: bool
+    reasons: list[str]  # why not ready; empty when ready
+    checked_at: float  # time.monotonic() of the probe
+    db_latency_ms: float | None  # None when the database did not answer
+    loop_lag_ms: float
+    pool: dict  # pool_stats() plus "saturation"
+
+
+_latest: Readiness | None = None
+_loop_lag_ms = 0.0
+_connection: asyncpg.Connection | None = None
+_probe_lock = asyncio.Lock()
+_probe_task: asyncio.Task | None = None
+
+
+def _probe_dsn() -> str:
+    # asyncpg wants a plain libpq URL, not SQLAlchemy's "postgresql+asyncpg://"
+    return make_url(settings.get_database_url()).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+def pool_saturation(stats: dict) -> float:
+    """Share of the pool's capacity (pool_size + max_overflow) checked out."""
+    capacity = stats["size"] + stats["max_overflow"]
+    return stats["checked_out"] / capacity if capacity else 0.0
+
+
+def evaluate(db_latency_ms: float | None, loop_lag_ms: float, stats: dict, checked_at: float) -> Readiness:
+    pool = {**stats, "saturation": round(pool_saturation(stats), 3)}
+    reasons = []
+    if db_latency_ms is None:
+        reasons.append("database unreachable")
+    elif db_latency_ms > settings.HEALTH_MAX_DB_LATENCY_MS:
+        reasons.append(f"database latency {db_latency_ms:.0f}ms")
+    if loop_lag_ms > settings.HEALTH_MAX_LOOP_LAG_MS:
+        reasons.append(f"event loop lag {loop_lag_ms:.0f}ms")
+    if pool["saturation"] >= settings.HEALTH_MAX_POOL_SATURATION:
+        reasons.append(f"connection pool saturated ({stats['checked_out']} checked out, {stats['waiting']} waiting)")
+    return Readiness(not reasons, reasons, checked_at, db_latency_ms, loop_lag_ms, pool)
+
+
+async def _ping(keep_connection: bool) -> float | None:
+    """Milliseconds `SELECT 1` took outside the application pool, or None if it failed."""
+    global _connection
+    started = time.perf_counter()
+    connection = _connection if keep_connection else None
+    try:
+        if connection is None or connection.is_closed():
+            connection = await asyncio.wait_for(asyncpg.connect(_probe_dsn()), settings.HEALTH_DB_TIMEOUT_SECONDS)
+        # Simple query protocol: no prepared statement, so it also works through pgbouncer
+        await asyncio.wait_for(connection.execute("SELECT 1"), settings.HEALTH_DB_TIMEOUT_SECONDS)
+        return (time.perf_counter() - started) * 1000
+    except Exception as exc:
+        logger.warning("health_probe_db_error", error=str(exc) or type(exc).__name__)
+        if connection is not None:
+            connection.terminate()
+        connection = None
+        return None
+    finally:
+        if keep_connection:
+            _connection = connection
+        elif connection is not None:
+            await connection.close()
+
+
+async def probe(keep_connection: bool = False) -> Readiness:
+    """
+    Check the database, the pool and the last loop-lag sample now, and cache
+    the result. Only the background probe keeps its connection open.
+    """
+    global _latest
+    db_latency_ms = await _ping(keep_connection)
+    _latest = evaluate(db_latency_ms, _loop_lag_ms, pool_stats(), time.monotonic())
+    return _latest
+
+
+def _age(readiness: Readiness) -> float:
+    return time.monotonic() - readiness.checked_at
+
+
+async def current() -> Readiness:
+    """
+    The cached result. Probes inline only when the background probe is not
+    running (e.g. in tests) and nothing recent is cached, once for all callers.
+    """
+    interval = settings.HEALTH_PROBE_INTERVAL_SECONDS
+    latest = _latest
+    if _probe_task is not None and latest is not None:
+        if _age(latest) > 3 * interval:
+            return latest._replace(ready=False, reasons=[*latest.reasons, "health probe stalled"])
+        return latest
+    async with _probe_lock:
+        if _latest is not None and _age(_latest) <= interval:
+            return _latest
+        return await probe()
+
+
+async def _probe_forever() -> None:
+    global _loop_lag_ms
+    interval = settings.HEALTH_PROBE_INTERVAL_SECONDS
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        # How late the loop woke us: time other tasks held it
+        _loop_lag_ms = max(time.perf_counter() - started - interval, 0.0) * 1000
+        try:
+            readiness = await probe(keep_connection=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("health_probe_error", error=str(exc))
+            continue
+        if not readiness.ready:
+            logger.warning("instance_not_ready", reasons=readiness.reasons)
+
+
+def start() -> None:
+    global _probe_task
+    if _probe_task is None:
+        _probe_task = asyncio.create_task(_probe_forever())
+
+
+async def stop() -> None:
+    global _probe_task, _connection
+    if _probe_task is not None:
+        _probe_task.cancel()
+        try:
+            await _probe_task
+        except asyncio.CancelledError:
+            pass
+        _probe_task = None
+    if _connection is not None:
+        await _connection.close()
+        _connection = None
@@ -0,0 +1,116 @@
+"""
+Bulk usage ingestion for server-to-server reporting.
+
+Services that meter calls themselves POST their events as newline-delimited
+JSON, one `{"org_id": ..., "units": ..., "timestamp": ...}` object per line.
+The body is parsed as it streams in and folded into one total per
+(organization, period), so memory grows with the number of distinct
+counters, not with the number of events. The totals are then applied with a
+single backend batch (see MeteringBackend.reserve_batch): each counter takes
+what is left of its plan's monthly_quota and the rest is reported back as
+rejected.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterable, NamedTuple
+from fastapi import HTTPException
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core import metering, metrics
+from app.core.backends import BatchItem, get_backend
+from app.core.config import settings
+
+
+class UsageEvent(BaseModel):
+    org_id: int = Field(gt=0)
+    units: int = Field(default=1, ge=1)
+    timestamp: datetime  # naive timestamps are taken as UTC
+
+
+class OrgUsage(NamedTuple):
+    org_id: int
+    period_start: datetime
+    reported: int
+    accepted: int
+    rejected: int
+    used: int | None  # counter after the batch; None when it was not read (no active plan, ...)
+    monthly_quota: int | None
+
+
+class UsageAggregate:
+    """Per-(organization, period) unit totals of a stream of events."""
+
+    def __init__(self, max_events: int, now: datetime | None = None):
+        self.max_events = max_events
+        self.latest = (now or datetime.now(timezone.utc)) + timedelta(seconds=settings.USAGE_INGEST_MAX_CLOCK_SKEW_SECONDS)
+        self.events = 0
+        self.totals: dict[tuple[int, datetime], int] = {}
+
+    def add_line(self, line: bytes, line_number: int) -> None:
+        line = line.strip()
+        if not line:
+            return
+        if self.events >= self.max_events:
+            raise HTTPException(status_code=413, detail=f"At most {self.max_events} events per request.")
+        try:
+            event = UsageEvent.model_validate_json(line)
+        except ValidationError as exc:
+            raise HTTPException(status_code=422, detail=f"Line {line_number}: {exc.errors()[0]['msg']}")
+
+        timestamp = event.timestamp
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        if timestamp > self.latest:
+            raise HTTPException(status_code=422, detail=f"Line {line_number}: timestamp is in the future")
+
+        key = (event.org_id, metering.get_period_start(timestamp.astimezone(timezone.utc)))
+        self.totals[key] = self.totals.get(key, 0) + event.units
+        self.events += 1
+
+
+async def read_events(chunks: AsyncIterable[bytes], max_events: int, max_line_bytes: int) -> UsageAggregate:
+    """Aggregate an NDJSON body chunk by chunk, without holding it in memory."""
+    aggregate = UsageAggregate(max_events)
+    pending = bytearray()
+    line_number = 0
+    async for chunk in chunks:
+        pending += chunk
+        *lines, rest = pending.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if len(line) > max_line_bytes:
+                raise HTTPException(status_code=413, detail=f"Line {line_number}: longer than {max_line_bytes} bytes")
+            aggregate.add_line(line, line_number)
+        if len(rest) > max_line_bytes:
+            raise HTTPException(status_code=413, detail=f"Line {line_number + 1}: longer than {max_line_bytes} bytes")
+        pending = rest
+    aggregate.add_line(bytes(pending), line_number + 1)
+    return aggregate
+
+
+async def apply_usage(db: AsyncSession, totals: dict[tuple[int, datetime], int]) -> list[OrgUsage]:
+    """Charge every total against its org's plan in one backend batch."""
+    limits = await metering.get_plan_limits_many(db, {org_id for org_id, _ in totals})
+    # The backend uses its own connections: don't pin ours while it runs
+    if db.in_transaction():
+        await db.commit()
+
+    keys = [key for key in totals if limits[key[0]] is not None]
+    items = [
+        BatchItem(org_id, period_start, totals[org_id, period_start], limits[org_id].monthly_quota, limits[org_id].counter_slots)
+        for org_id, period_start in keys
+    ]
+    reservations = dict(zip(keys, await get_backend().reserve_batch(items))) if items else {}
+
+    results = []
+    for (org_id, period_start), reported in totals.items():
+        plan = limits[org_id]
+        granted, count = reservations.get((org_id, period_start), (0, None))
+        if plan is not None and count is not None and count >= plan.monthly_quota:
+            metering.mark_exhausted(org_id, period_start, plan.monthly_quota)
+        metrics.INGEST_ACCEPTED.inc(granted)
+        metrics.INGEST_REJECTED.inc(reported - granted)
+        results.append(OrgUsage(
+            org_id, period_start, reported, granted, reported - granted,
+            count, plan.monthly_quota if plan is not None else None,
+        ))
+    return results
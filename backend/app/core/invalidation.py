@@ -0,0 +1,101 @@
+"""
+Cross-process cache invalidation over PostgreSQL LISTEN/NOTIFY.
+
+In-process caches (plan limits, principals, ...) register a handler per
+"kind". Writers call `publish()` inside their transaction: the local handler
+runs immediately, and the NOTIFY is delivered to every other worker (and to
+separate processes such as scripts/update_quota.py) when the transaction
+commits. If the listener connection drops, every handler is asked to flush
+everything, since notifications may have been missed.
+"""
+import asyncio
+from typing import Callable
+
+import asyncpg
+import structlog
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+
+logger = structlog.get_logger()
+
+CHANNEL = "metering_invalidation"
+ALL = "*"  # key meaning "everything of this kind"
+
+_handlers: dict[str, list[Callable[[str], None]]] = {}
+_listener_task: asyncio.Task | None = None
+
+
+def register(kind: str, handler: Callable[[str], None]) -> None:
+    """Call handler(key) whenever an invalidation of `kind` is published."""
+    _handlers.setdefault(kind, []).append(handler)
+
+
+def dispatch(kind: str, key: str) -> None:
+    for handler in _handlers.get(kind, ()):
+        handler(key)
+
+
+def dispatch_all() -> None:
+    for kind in _handlers:
+        dispatch(kind, ALL)
+
+
+async def publish(db: AsyncSession, kind: str, key: int | str) -> None:
+    """Invalidate `kind:key` here now, and in every other process once `db` commits."""
+    dispatch(kind, str(key))
+    await db.execute(select(func.pg_notify(CHANNEL, f"{kind}:{key}")))
+
+
+def _on_notification(connection, pid, channel, payload: str) -> None:
+    kind, _, key = payload.partition(":")
+    dispatch(kind, key)
+
+
+def _listener_dsn() -> str:
+    # asyncpg wants a plain libpq URL, not SQLAlchemy's "postgresql+asyncpg://"
+    url = settings.CACHE_INVALIDATION_DATABASE_URL or settings.get_database_url()
+    return make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+async def _listen_forever() -> None:
+    while True:
+        try:
+            connection = await asyncpg.connect(_listener_dsn())
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            await connection.add_listener(CHANNEL, _on_notification)
+            # Anything published while we were not listening is unknown
+            dispatch_all()
+            logger.info("cache_invalidation_listener_started", channel=CHANNEL)
+            try:
+                await lost.wait()
+            finally:
+                if not connection.is_closed():
+                    await connection.close()
+            logger.warning("cache_invalidation_listener_lost")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("cache_invalidation_listener_error", error=str(exc))
+        dispatch_all()
+        await asyncio.sleep(settings.CACHE_INVALIDATION_RETRY_SECONDS)
+
+
+def start_listener() -> None:
+    global _listener_task
+    if _listener_task is None:
+        _listener_task = asyncio.create_task(_listen_forever())
+
+
+async def stop_listener() -> None:
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
@@ -1,7 +1,21 @@
+import atexit
 import logging
+import random
 import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
 import structlog
 
+from app.core import metrics
+from app.core.config import settings
+
+
+# "GET /api/v1/widgets/" while a request is being handled, set by RequestLoggingMiddleware
+current_route: ContextVar[str | None] = ContextVar("current_route", default=None)
+
 
 def setup_logging():
     shared_processors = [
@@ -29,3 +43,112 @@ def setup_logging():
         logger_factory=structlog.PrintLoggerFactory(),
         cache_logger_on_first_use=True,
     )
+    log_writer.start()
+
+
+class BackgroundLogWriter:
+    """
+    Bounded queue of log records, rendered and written by a daemon thread.
+
+    The event loop only appends a tuple to a deque (atomic, no lock); structlog
+    processing, JSON rendering and the blocking stdout write all happen on the
+    writer thread. When the queue is full new records are dropped and counted
+    rather than letting a slow stdout back-pressure request handling.
+    """
+
+    def __init__(self, maxsize: int, flush_interval: float = 0.05):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self._records: deque[tuple[str, str, dict]] = deque()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def submit(self, level: str, event: str, fields: dict) -> bool:
+        if len(self._records) >= self.maxsize:
+            metrics.LOG_RECORDS_DROPPED.inc()
+            return False
+        self._records.append((level, event, fields))
+        return True
+
+    def drain(self) -> int:
+        logger = structlog.get_logger()
+        written = 0
+        while self._records:
+            level, event, fields = self._records.popleft()
+            getattr(logger, level)(event, **fields)
+            written += 1
+        return written
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.drain()
+        self.drain()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Write out everything still queued and stop the thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+log_writer = BackgroundLogWriter(maxsize=settings.LOG_QUEUE_MAXSIZE)
+
+
+class RequestLoggingMiddleware:
+    """
+    Raw ASGI middleware: adds X-Process-Time, counts the outcome in /metrics and
+    queues a `request_processed` record. Successful requests are sampled at
+    REQUEST_LOG_SAMPLE_RATE; errors (including 429s) are always logged.
+
+    Unlike @app.middleware("http") it does not run the endpoint in a separate
+    task or re-stream the response body, it only looks at http.response.start.
+    """
+
+    def __init__(self, app, writer: BackgroundLogWriter | None = None, sample_rate: float | None = None):
+        self.app = app
+        self.writer = writer or log_writer
+        self.sample_rate = settings.REQUEST_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        route_token = current_route.set(f"{scope['method']} {scope['path']}")
+        status_code = 500  # if the app raises before starting a response
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                process_time_ms = round((time.perf_counter() - start_time) * 1000, 2)
+                headers = list(message.get("headers", ()))
+                headers.append((b"x-process-time", str(process_time_ms).encode("latin-1")))
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_route.reset(route_token)
+            metrics.record_response(status_code)
+            if status_code >= 400 or random.random() < self.sample_rate:
+                self.writer.submit(
+                    "error" if status_code >= 500 else "info",
+                    "request_processed",
+                    {
+                        "path": scope["path"],
+                        "method": scope["method"],
+                        "status_code": status_code,
+                        "process_time_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                    },
+                )
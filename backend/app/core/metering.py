@@ -1,106 +1,460 @@
+import asyncio
+import time
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import select, update, insert
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Iterable, NamedTuple
+import structlog
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException
 from app.models import all_models
+from app.core import invalidation, metrics, prepared
+from app.core.backends import get_backend
+from app.core.cache import MISSING, TTLCache
 from app.core.config import settings
 
-from sqlalchemy.orm import selectinload
+logger = structlog.get_logger()
 
-async def get_current_subscription(db: AsyncSession, org_id: int) -> all_models.Subscription:
-    # Get active subscription and its plan
+
+class PlanLimits(NamedTuple):
+    plan_id: int
+    monthly_quota: int
+    rate_limit_per_minute: int | None
+    counter_slots: int = 1
+
+
+# organization_id -> PlanLimits, or None for "no active subscription"
+plan_cache = TTLCache(maxsize=settings.PLAN_CACHE_MAXSIZE, ttl=settings.PLAN_CACHE_TTL_SECONDS)
+# Bumped on every invalidation so that a lookup which raced with a plan or
+# subscription write never re-populates the cache with what it read before.
+_plan_cache_generation = 0
+
+
+# organization_id -> (period_start, plan_limit) of a window whose quota is used
+# up. Lets the org's next requests be refused without a backend call until the
+# window rolls over; an entry only matches while both are unchanged.
+exhausted_cache = TTLCache(maxsize=settings.EXHAUSTED_CACHE_MAXSIZE, ttl=0)
+
+
+def invalidate_organization(org_id: int | str) -> None:
+    global _plan_cache_generation
+    _plan_cache_generation += 1
+    if org_id == invalidation.ALL:
+        plan_cache.clear()
+        exhausted_cache.clear()
+    else:
+        plan_cache.pop(int(org_id))
+        exhausted_cache.pop(int(org_id))
+
+
+def invalidate_plan(plan_id: int | str) -> None:
+    global _plan_cache_generation
+    _plan_cache_generation += 1
+    if plan_id == invalidation.ALL:
+        plan_cache.clear()
+    else:
+        plan_id = int(plan_id)
+        plan_cache.evict_where(lambda _, limits: limits is not None and limits.plan_id == plan_id)
+    # Entries don't record their plan; plan edits are rare enough to just start over
+    exhausted_cache.clear()
+
+
+invalidation.register("organization", invalidate_organization)
+invalidation.register("plan", invalidate_plan)
+
+
+async def get_plan_limits(db: AsyncSession, org_id: int) -> PlanLimits | None:
+    """Active plan limits for an organization, served from plan_cache when possible."""
+    limits = plan_cache.get(org_id)
+    if limits is not MISSING:
+        return limits
+
+    generation = _plan_cache_generation
+    started = time.perf_counter()
+    if prepared.enabled():
+        row = await prepared.fetchrow(db, prepared.PLAN_LIMITS, org_id)
+    else:
+        stmt = (
+            select(
+                all_models.SubscriptionPlan.id,
+                all_models.SubscriptionPlan.monthly_quota,
+                all_models.SubscriptionPlan.rate_limit_per_minute,
+                all_models.SubscriptionPlan.counter_slots,
+            )
+            .join(all_models.Subscription, all_models.Subscription.plan_id == all_models.SubscriptionPlan.id)
+            .where(all_models.Subscription.organization_id == org_id)
+            .where(all_models.Subscription.is_active == True)
+            .limit(1)
+        )
+        row = (await db.execute(stmt)).first()
+    metrics.PLAN_LOOKUP.observe(time.perf_counter() - started)
+    limits = PlanLimits(*row) if row else None
+
+    if generation == _plan_cache_generation:
+        ttl = settings.PLAN_CACHE_NEGATIVE_TTL_SECONDS if limits is None else None
+        plan_cache.set(org_id, limits, ttl=ttl)
+    return limits
+
+
+async def get_plan_limits_many(db: AsyncSession, org_ids: Iterable[int]) -> dict[int, PlanLimits | None]:
+    """get_plan_limits for many organizations, with one SELECT for all the cache misses."""
+    found: dict[int, PlanLimits | None] = {}
+    missing = []
+    for org_id in org_ids:
+        limits = plan_cache.get(org_id)
+        if limits is MISSING:
+            missing.append(org_id)
+        else:
+            found[org_id] = limits
+    if not missing:
+        return found
+
+    generation = _plan_cache_generation
     stmt = (
-        select(all_models.Subscription)
-        .options(selectinload(all_models.Subscription.plan))
-        .where(all_models.Subscription.organization_id == org_id)
+        select(
+            all_models.Subscription.organization_id,
+            all_models.SubscriptionPlan.id,
+            all_models.SubscriptionPlan.monthly_quota,
+            all_models.SubscriptionPlan.rate_limit_per_minute,
+            all_models.SubscriptionPlan.counter_slots,
+        )
+        .join(all_models.Subscription, all_models.Subscription.plan_id == all_models.SubscriptionPlan.id)
+        .where(all_models.Subscription.organization_id.in_(missing))
         .where(all_models.Subscription.is_active == True)
     )
-    result = await db.execute(stmt)
-    return result.scalars().first()
-
-async def track_and_enforce_usage(db: AsyncSession, org_id: int) -> tuple[int, int]:
-    # 1. Get Limits
-    subscription = await get_current_subscription(db, org_id)
-    
-    if not subscription:
-        # Default policy: No active sub -> Block or Free Tier? 
-        # Assuming we need a plan to operate.
-        raise HTTPException(status_code=403, detail="No active subscription found.")
+    started = time.perf_counter()
+    rows = (await db.execute(stmt)).all()
+    metrics.PLAN_LOOKUP.observe(time.perf_counter() - started)
+    loaded = {}
+    for org_id, *row in rows:
+        loaded.setdefault(org_id, PlanLimits(*row))
+
+    for org_id in missing:
+        limits = found[org_id] = loaded.get(org_id)
+        if generation == _plan_cache_generation:
+            ttl = settings.PLAN_CACHE_NEGATIVE_TTL_SECONDS if limits is None else None
+            plan_cache.set(org_id, limits, ttl=ttl)
+    return found
+
+
+def get_period_start(now: datetime | None = None) -> datetime:
+    """Start of the metering window containing `now` (defaults to the current UTC time)."""
+    now = now or datetime.now(timezone.utc)
 
-    plan_limit = subscription.plan.monthly_quota
-    
-    # 2. Determine Period
-    now = datetime.now(timezone.utc)
-    
     if settings.DEMO_MODE:
         # DEMO MODE: 5-minute rolling windows (as per original portfolio design)
         minute_window = (now.minute // 5) * 5
-        period_start = now.replace(minute=minute_window, second=0, microsecond=0)
-    else:
-        # PRODUCTION MODE: Monthly windows (Standard SaaS behavior)
-        # Resets at 00:00 UTC on the 1st of every month
-        period_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    # 3. Atomic Check-and-Increment
-    # Strategy: Ensure record exists safely, then Atomic Update.
-    
-    # 3a. Ensure record exists (Atomic Insert)
-    
-    insert_stmt = (
-        pg_insert(all_models.UsageRecord)
-        .values(
-            organization_id=org_id,
-            period_start=period_start,
-            request_count=0
-        )
-        .on_conflict_do_nothing(
-            index_elements=['organization_id', 'period_start']
-        )
-    )
-    await db.execute(insert_stmt)
-    
-    # 3b. Atomic Update
-    stmt = (
-        update(all_models.UsageRecord)
-        .where(all_models.UsageRecord.organization_id == org_id)
-        .where(all_models.UsageRecord.period_start == period_start)
-        .where(all_models.UsageRecord.request_count < plan_limit)
-        .values(request_count=all_models.UsageRecord.request_count + 1)
-        .returning(all_models.UsageRecord.request_count)
-        .execution_options(synchronize_session=False)
+        return now.replace(minute=minute_window, second=0, microsecond=0)
+
+    # PRODUCTION MODE: Monthly windows (Standard SaaS behavior)
+    # Resets at 00:00 UTC on the 1st of every month
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_next_window(period_start: datetime) -> datetime:
+    """Start of the window that follows `period_start`."""
+    if settings.DEMO_MODE:
+        return period_start + timedelta(minutes=5)
+    if period_start.month == 12:
+        return period_start.replace(year=period_start.year + 1, month=1)
+    return period_start.replace(month=period_start.month + 1)
+
+
+def raise_limit_exceeded(period_start: datetime) -> None:
+    seconds_left = max(int((get_next_window(period_start) - datetime.now(timezone.utc)).total_seconds()), 0)
+    raise HTTPException(
+        status_code=429,
+        detail=f"Rate limit exceeded. Try again in {seconds_left} seconds.",
+        headers={"Retry-After": str(seconds_left)},
     )
-    
-    result = await db.execute(stmt)
-    new_count = result.scalars().first()
-    
-    if new_count is None:
-        # Update failed. 2 Possibilities: 
-        # 1. Record missing (Impossible due to 3a, unless deleted concurrently)
-        # 2. Condition (count < limit) failed -> Limit Exceeded
-        
-        # Read current count to confirm validity
-        check_stmt = select(all_models.UsageRecord).where(
-            all_models.UsageRecord.organization_id == org_id,
-            all_models.UsageRecord.period_start == period_start
+
+
+def mark_exhausted(org_id: int, period_start: datetime, plan_limit: int, ttl: float | None = None) -> None:
+    """Remember the org as exhausted until the window ends, or for `ttl` seconds if sooner."""
+    window_ttl = (get_next_window(period_start) - datetime.now(timezone.utc)).total_seconds()
+    ttl = window_ttl if ttl is None else min(ttl, window_ttl)
+    if ttl > 0:
+        exhausted_cache.set(org_id, (period_start, plan_limit), ttl=ttl)
+
+
+def refuse_exhausted(org_id: int, period_start: datetime, plan_limit: int, ttl: float | None = None) -> None:
+    """Raise the quota 429, remembering the org as exhausted (see mark_exhausted)."""
+    mark_exhausted(org_id, period_start, plan_limit, ttl)
+    raise_limit_exceeded(period_start)
+
+
+# --- Leased quota (METERING_MODE="leased") ---------------------------------
+#
+# Instead of one contended reservation per request, a worker reserves a chunk
+# of the remaining quota from the backend and admits requests from it in
+# memory. Reserved units are already counted by the backend, so every worker's
+# admissions together can never exceed monthly_quota; unused units are handed
+# back on plan changes, on shutdown, and once their window has closed: by the
+# org's next request or, if it sends none, by a background sweep every
+# QUOTA_LEASE_SWEEP_INTERVAL_SECONDS. A worker that dies without releasing its
+# lease leaves at most one chunk counted as used for that window.
+
+class _Lease:
+    __slots__ = ("period_start", "plan_limit", "remaining", "count", "lock")
+
+    def __init__(self, period_start: datetime, plan_limit: int):
+        self.period_start = period_start
+        self.plan_limit = plan_limit
+        self.remaining = 0  # units reserved in the backend but not yet admitted here
+        self.count = 0  # backend counter right after our last reservation
+        self.lock = asyncio.Lock()
+
+
+_leases: dict[int, _Lease] = {}
+
+
+def lease_chunk_size(plan_limit: int, last_count: int) -> int:
+    """
+    QUOTA_LEASE_MAX_CHUNK or QUOTA_LEASE_PLAN_FRACTION of the plan, whichever is
+    smaller, shrinking as the quota runs out so that one worker cannot sit on
+    the last units while the others are refused.
+    """
+    chunk = min(settings.QUOTA_LEASE_MAX_CHUNK, int(plan_limit * settings.QUOTA_LEASE_PLAN_FRACTION))
+    chunk = min(chunk, (plan_limit - last_count) // settings.QUOTA_LEASE_SHARE_DIVISOR)
+    return max(chunk, 1)
+
+
+async def _return_lease(org_id: int, lease: _Lease) -> None:
+    # Taken before the await: late requests for the old window must not admit units being released
+    units, lease.remaining = lease.remaining, 0
+    if units > 0:
+        try:
+            await get_backend().release(org_id, lease.period_start, units)
+        except BaseException:
+            lease.remaining += units
+            raise
+
+
+async def _admit_from_lease(
+    org_id: int, period_start: datetime, plan_limit: int, slots: int, units: int
+) -> tuple[int, int]:
+    lease = _leases.get(org_id)
+    if lease is None:
+        lease = _leases[org_id] = _Lease(period_start, plan_limit)
+
+    while True:
+        # Fast path: no await between the check and the decrement, so no lock is needed
+        if lease.period_start == period_start and lease.plan_limit == plan_limit and lease.remaining >= units:
+            lease.remaining -= units
+            return lease.count - lease.remaining, plan_limit
+
+        async with lease.lock:
+            if lease.period_start == period_start and lease.plan_limit == plan_limit and lease.remaining >= units:
+                continue  # another request refilled the lease while we waited
+
+            if lease.period_start != period_start or lease.plan_limit != plan_limit:
+                # Window rollover or plan change: give back what the old lease still holds
+                await _return_lease(org_id, lease)
+                lease.period_start, lease.plan_limit, lease.count = period_start, plan_limit, 0
+
+            chunk = max(lease_chunk_size(plan_limit, lease.count), units - lease.remaining)
+            granted, lease.count = await get_backend().reserve(
+                org_id, period_start, chunk, plan_limit, partial=True, slots=slots
+            )
+            if granted == 0:
+                if lease.remaining == 0:
+                    # Other workers' leases may still hand units back (rollover, plan change,
+                    # shutdown): only remember the exhaustion briefly
+                    refuse_exhausted(org_id, period_start, plan_limit, ttl=settings.QUOTA_LEASE_EXHAUSTED_TTL_SECONDS)
+                # What the lease still holds is left for cheaper requests
+                raise_limit_exceeded(period_start)
+            lease.remaining += granted
+
+
+async def release_expired_leases(now: datetime | None = None) -> int:
+    """Return the unused units of leases whose window has closed. Returns how many leases held some."""
+    current = get_period_start(now)
+    returned = 0
+    for org_id, lease in list(_leases.items()):
+        if lease.period_start >= current or lease.remaining == 0:
+            continue
+        async with lease.lock:
+            # Re-checked under the lock: a request may have rolled the lease over meanwhile.
+            # The lease stays in _leases: a request may already hold it.
+            if lease.period_start < current and lease.remaining > 0:
+                await _return_lease(org_id, lease)
+                returned += 1
+    return returned
+
+
+async def _sweep_leases_forever() -> None:
+    while True:
+        await asyncio.sleep(settings.QUOTA_LEASE_SWEEP_INTERVAL_SECONDS)
+        try:
+            await release_expired_leases()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # What was not returned stays on the lease for the next sweep
+            logger.warning("lease_sweep_error", error=str(exc))
+
+
+_lease_sweep_task: asyncio.Task | None = None
+
+
+def start_lease_sweeper() -> None:
+    global _lease_sweep_task
+    if _lease_sweep_task is None:
+        _lease_sweep_task = asyncio.create_task(_sweep_leases_forever())
+
+
+async def stop_lease_sweeper() -> None:
+    global _lease_sweep_task
+    if _lease_sweep_task is not None:
+        _lease_sweep_task.cancel()
+        try:
+            await _lease_sweep_task
+        except asyncio.CancelledError:
+            pass
+        _lease_sweep_task = None
+
+
+async def release_all_leases() -> None:
+    """Return every unused leased unit. Called on shutdown."""
+    for org_id, lease in list(_leases.items()):
+        async with lease.lock:
+            await _return_lease(org_id, lease)
+    _leases.clear()
+
+
+# --- Coalesced increments (METERING_MODE="coalesced") -----------------------
+#
+# Requests for the same (org, period) that arrive within COALESCE_WINDOW_MS of
+# each other (or until COALESCE_MAX_BATCH have queued) share one partial
+# reservation of their total cost instead of one contended reservation each.
+# Waiters are admitted in arrival order; when the batch straddles the limit a
+# waiter gets in only if its whole cost still fits, and whatever was granted
+# but not used is released.
+
+class _Batch:
+    __slots__ = ("waiters", "full")
+
+    def __init__(self):
+        self.waiters: list[tuple[asyncio.Future, int]] = []  # (future, units)
+        self.full = asyncio.Event()
+
+
+_batches: dict[tuple[int, datetime], _Batch] = {}
+_flush_tasks: set[asyncio.Task] = set()
+
+
+async def _flush_batch(org_id: int, period_start: datetime, plan_limit: int, slots: int, batch: _Batch) -> None:
+    try:
+        await asyncio.wait_for(batch.full.wait(), settings.COALESCE_WINDOW_MS / 1000)
+    except asyncio.TimeoutError:
+        pass
+    # Close the batch: later arrivals open a new one while this one is in flight
+    del _batches[(org_id, period_start)]
+
+    # Requests abandoned while the batch was open do not consume quota
+    waiters = [(waiter, units) for waiter, units in batch.waiters if not waiter.done()]
+    if not waiters:
+        return
+    try:
+        granted, count = await get_backend().reserve(
+            org_id, period_start, sum(units for _, units in waiters), plan_limit, partial=True, slots=slots
         )
-        record = (await db.execute(check_stmt)).scalars().first()
-        
-        if record and record.request_count >= plan_limit:
-             if settings.DEMO_MODE:
-                 next_window = period_start + timedelta(minutes=5)
-             elif period_start.month == 12:
-                 next_window = period_start.replace(year=period_start.year + 1, month=1)
-             else:
-                 next_window = period_start.replace(month=period_start.month + 1)
-             
-             seconds_left = int((next_window - datetime.now(timezone.utc)).total_seconds())
-             raise HTTPException(status_code=429, detail=f"Rate limit exceeded. Try again in {seconds_left} seconds.")
-        
-        # Fallback if something really weird happened
-        raise HTTPException(status_code=500, detail="Metering error.")
-    
-    await db.commit()
+    except Exception as exc:
+        for waiter, _ in waiters:
+            if not waiter.done():
+                waiter.set_exception(exc)
+        return
+
+    used = count - granted
+    left = granted
+    for waiter, units in waiters:
+        if units <= left and not waiter.done():
+            left -= units
+            used += units
+            waiter.set_result(used)
+        elif not waiter.done():
+            waiter.set_result(None)
+    if left:
+        await get_backend().release(org_id, period_start, left)
+
+
+async def _admit_coalesced(
+    org_id: int, period_start: datetime, plan_limit: int, slots: int, units: int
+) -> tuple[int, int]:
+    key = (org_id, period_start)
+    batch = _batches.get(key)
+    if batch is None:
+        batch = _batches[key] = _Batch()
+        task = asyncio.create_task(_flush_batch(org_id, period_start, plan_limit, slots, batch))
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+
+    waiter = asyncio.get_running_loop().create_future()
+    batch.waiters.append((waiter, units))
+    if len(batch.waiters) >= settings.COALESCE_MAX_BATCH:
+        batch.full.set()
+
+    new_count = await waiter
+    if new_count is None:
+        _refuse(org_id, period_start, plan_limit, units)
     return new_count, plan_limit
 
+
+def _refuse(org_id: int, period_start: datetime, plan_limit: int, units: int) -> None:
+    """
+    A refused single unit means the quota is used up; a refused multi-unit
+    request only that too little is left for it, so cheaper ones may still fit.
+    """
+    if units == 1:
+        refuse_exhausted(org_id, period_start, plan_limit)
+    raise_limit_exceeded(period_start)
+
+
+async def track_and_enforce_usage(db: AsyncSession, org_id: int, units: int = 1) -> tuple[int, int]:
+    """
+    Charge `units` to the org's quota for the current window, all or nothing.
+    Returns (units used after this request, monthly_quota); raises 429 when
+    they do not fit, 413 when they exceed the whole quota.
+    """
+    # 1. Get Limits (cached, see get_plan_limits)
+    limits = await get_plan_limits(db, org_id)
+
+    if not limits:
+        # Default policy: No active sub -> Block or Free Tier?
+        # Assuming we need a plan to operate.
+        raise HTTPException(status_code=403, detail="No active subscription found.")
+
+    plan_limit = limits.monthly_quota
+    period_start = get_period_start()
+
+    if plan_limit <= 0:
+        raise_limit_exceeded(period_start)
+    if units > plan_limit:
+        # Could not fit in any window: a 429 with Retry-After would be retried forever
+        raise HTTPException(
+            status_code=413,
+            detail=f"Request cost of {units} units exceeds the plan's monthly quota of {plan_limit}.",
+        )
+
+    # Quota already used up in this window: refuse before any backend call
+    if exhausted_cache.get(org_id) == (period_start, plan_limit):
+        metrics.EXHAUSTED_CACHE_HITS.inc()
+        raise_limit_exceeded(period_start)
+
+    # The backend uses its own connections: don't pin ours (e.g. from a plan
+    # cache miss) while it waits for one, or a burst could drain the pool.
+    if db.in_transaction():
+        await db.commit()
+
+    if settings.METERING_MODE == "leased":
+        return await _admit_from_lease(org_id, period_start, plan_limit, limits.counter_slots, units)
+
+    if settings.METERING_MODE == "coalesced":
+        return await _admit_coalesced(org_id, period_start, plan_limit, limits.counter_slots, units)
+
+    # 2. Guarded check-and-increment of `units` (see the backend's reserve()).
+    granted, new_count = await get_backend().reserve(
+        org_id, period_start, units, plan_limit, slots=limits.counter_slots
+    )
+    if not granted:
+        _refuse(org_id, period_start, plan_limit, units)
+    return new_count, plan_limit
@@ -0,0 +1,266 @@
+"""
+Minimal Prometheus metrics, rendered in the text exposition format by /metrics.
+
+Recording is what runs on the request path, so it is kept to a couple of
+list/float updates: label children are created once at import time and bound
+to module constants, observe() is a bisect plus two in-place additions, and
+nothing takes a lock (every caller runs on the event loop). All the
+formatting work happens when the endpoint is scraped.
+"""
+import abc
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# Seconds; covers a cache hit (tens of µs) up to a pool timeout
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_registry: list["_Metric"] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple[str, ...], object] = {}
+        _registry.append(self)
+
+    def labels(self, *values: str):
+        """The child for these label values. Bind it once, outside the hot path."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """A fresh child for one combination of label values."""
+
+    @abc.abstractmethod
+    def _samples(self) -> Iterable[str]:
+        """Exposition lines for every child, without HELP/TYPE."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: int = 1) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket); None if empty."""
+        total = sum(self.counts)
+        if not total:
+            return None
+        rank, cumulative = q * total, 0
+        for bound, count in zip((*self.bounds, float("inf")), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackGauge(_Metric):
+    """Gauge whose samples are read when scraped: callback() -> {label values: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str], callback: Callable[[], dict]):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _new_child(self):
+        raise TypeError(f"{self.name} is read from its callback; it has no children to record into")
+
+    def _samples(self):
+        for values, value in self.callback().items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {value}"
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# --- Request path ------------------------------------------------------------
+
+STAGE_SECONDS = Histogram(
+    "metering_stage_seconds", "Time spent in each stage of an authenticated, metered request.", ["stage"]
+)
+JWT_DECODE = STAGE_SECONDS.labels("jwt_decode")
+USER_LOOKUP = STAGE_SECONDS.labels("user_lookup")
+PLAN_LOOKUP = STAGE_SECONDS.labels("plan_lookup")
+UPSERT = STAGE_SECONDS.labels("upsert")
+GUARDED_UPDATE = STAGE_SECONDS.labels("guarded_update")
+BATCH_UPDATE = STAGE_SECONDS.labels("batch_update")
+COMMIT = STAGE_SECONDS.labels("commit")
+
+EXHAUSTED_CACHE_HITS = Counter(
+    "metering_exhausted_cache_hits_total", "Quota 429s answered from the exhausted-tenant cache, without a backend call."
+).labels()
+
+INGESTED_UNITS = Counter(
+    "metering_ingested_units_total", "Units reported through bulk usage ingestion, by outcome.", ["outcome"]
+)
+INGEST_ACCEPTED = INGESTED_UNITS.labels("accepted")
+INGEST_REJECTED = INGESTED_UNITS.labels("rejected")
+
+RESPONSES = Counter("metering_http_responses_total", "HTTP responses by outcome.", ["code"])
+_OUTCOMES = {code: RESPONSES.labels(str(code)) for code in (403, 429, 500)}
+_SUCCESS = RESPONSES.labels("2xx")
+_OTHER = RESPONSES.labels("other")
+
+
+def record_response(status_code: int) -> None:
+    if 200 <= status_code < 300:
+        _SUCCESS.inc()
+    else:
+        _OUTCOMES.get(status_code, _OTHER).inc()
+
+
+LOG_RECORDS_DROPPED = Counter(
+    "metering_log_records_dropped_total", "Request log records dropped because the log queue was full."
+).labels()
+
+
+# --- Database pool -----------------------------------------------------------
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    "metering_db_pool_checkout_seconds", "Time spent waiting for a connection from the SQLAlchemy pool."
+)
+POOL_CHECKOUT = POOL_CHECKOUT_SECONDS.labels()
+
+
+def _pool_connections() -> dict:
+    from app.core.db import pool_stats
+
+    stats = pool_stats()
+    return {(state,): stats[state] for state in ("size", "checked_out", "checked_in", "overflow", "waiting")}
+
+
+CallbackGauge("metering_db_pool_connections", "SQLAlchemy pool connections by state.", ["state"], _pool_connections)
+
+
+# --- Admission control -------------------------------------------------------
+
+ADMISSION_SHED = Counter(
+    "metering_admission_shed_total", "Requests refused by admission control with a 503, by priority.", ["priority"]
+)
+SHED_NORMAL = ADMISSION_SHED.labels("normal")
+SHED_PRIORITY = ADMISSION_SHED.labels("priority")
+
+
+def _admission_state() -> dict:
+    from app.core.admission import limiter
+
+    return {("limit",): int(limiter.limit), ("in_flight",): limiter.in_flight}
+
+
+CallbackGauge(
+    "metering_admission_requests", "Admission control: current concurrency limit and requests in flight.",
+    ["state"], _admission_state,
+)
+
+
+# --- Event loop --------------------------------------------------------------
+
+LOOP_LAG_SECONDS = Histogram(
+    "metering_event_loop_lag_seconds", "How late the event loop woke a periodic timer: time other tasks held it."
+)
+LOOP_LAG = LOOP_LAG_SECONDS.labels()
+
+_lag_task: asyncio.Task | None = None
+
+
+async def _monitor_loop_lag(interval: float) -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(time.perf_counter() - started - interval, 0.0))
+
+
+def start_loop_lag_monitor(interval: float) -> None:
+    global _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(_monitor_loop_lag(interval))
+
+
+async def stop_loop_lag_monitor() -> None:
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        try:
+            await _lag_task
+        except asyncio.CancelledError:
+            pass
+        _lag_task = None
@@ -0,0 +1,132 @@
+"""
+Hot-path statements as explicitly prepared asyncpg statements.
+
+Running a SQLAlchemy Core construct costs Python CPU on every call: building
+the construct, looking up (or producing) its compiled form, processing the
+bind parameters, and the dialect's own prepared-statement cache lookup. The
+handful of statements every metered request runs are instead written out
+once here and prepared on each pooled connection as soon as it is opened,
+so a call is a dict lookup plus asyncpg's bind and execute.
+
+The statements run on the session's connection but outside SQLAlchemy's
+transaction handling, i.e. each one in its own implicit transaction: fine
+for these single-statement operations, and it also saves the BEGIN/COMMIT
+round trips. Disabled in DB_PGBOUNCER_MODE, where named prepared statements
+do not survive from one transaction to the next. SQLAlchemy's cursor events
+never see these calls, so they report to the query tracer themselves.
+"""
+import time
+import weakref
+from typing import Any, Callable, NamedTuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import query_trace
+from app.core.config import settings
+
+
+class Statement(NamedTuple):
+    name: str
+    sql: str
+
+
+# Same semantics as postgres.build_metering_statement: $1 org, $2 period, $3 units, $4 limit
+METER_UPSERT = Statement("meter_upsert", """
+    INSERT INTO usage_records (organization_id, period_start, request_count)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (organization_id, period_start) DO UPDATE
+    SET request_count = usage_records.request_count + $3, last_updated = now()
+    WHERE usage_records.request_count + $3 <= $4
+    RETURNING usage_records.request_count
+""")
+
+# postgres.build_update_statement
+METER_UPDATE = Statement("meter_update", """
+    UPDATE usage_records SET request_count = request_count + $3, last_updated = now()
+    WHERE organization_id = $1 AND period_start = $2 AND request_count + $3 <= $4
+    RETURNING request_count
+""")
+
+# metering.get_plan_limits: $1 org
+PLAN_LIMITS = Statement("plan_limits", """
+    SELECT subscription_plans.id, subscription_plans.monthly_quota,
+           subscription_plans.rate_limit_per_minute, subscription_plans.counter_slots
+    FROM subscription_plans JOIN subscriptions ON subscriptions.plan_id = subscription_plans.id
+    WHERE subscriptions.organization_id = $1 AND subscriptions.is_active = true
+    LIMIT 1
+""")
+
+# deps.get_current_principal: $1 user id
+USER_PRINCIPAL = Statement("user_principal", """
+    SELECT id, organization_id, role, is_active FROM users WHERE id = $1
+""")
+
+STATEMENTS = (METER_UPSERT, METER_UPDATE, PLAN_LIMITS, USER_PRINCIPAL)
+
+# asyncpg connection -> {statement name: PreparedStatement}
+_prepared: "weakref.WeakKeyDictionary[Any, dict[str, Any]]" = weakref.WeakKeyDictionary()
+
+
+def enabled() -> bool:
+    return settings.PREPARED_STATEMENTS_ENABLED and not settings.DB_PGBOUNCER_MODE
+
+
+async def warm(connection) -> None:
+    """Prepare every statement on a new asyncpg connection."""
+    statements = _prepared.setdefault(connection, {})
+    for statement in STATEMENTS:
+        statements[statement.name] = await connection.prepare(statement.sql)
+
+
+def _on_connect(dbapi_connection, _connection_record) -> None:
+    dbapi_connection.run_async(warm)
+
+
+def install(sync_engine) -> None:
+    """Warm each connection the engine opens from now on."""
+    event.listen(sync_engine, "connect", _on_connect)
+
+
+async def _statement(db: AsyncSession, statement: Statement):
+    connection = await db.connection()
+    driver_connection = (await connection.get_raw_connection()).driver_connection
+    statements = _prepared.setdefault(driver_connection, {})
+    prepared = statements.get(statement.name)
+    if prepared is None:
+        # A connection opened before install(), or by another engine
+        prepared = statements[statement.name] = await driver_connection.prepare(statement.sql)
+    return prepared
+
+
+# Called as observer(sql, seconds) after every statement; see add_observer()
+_observers: list[Callable[[str, float], None]] = []
+
+
+def add_observer(observer: Callable[[str, float], None]) -> None:
+    """Also report every prepared statement's duration to `observer` (e.g. a benchmark's timer)."""
+    _observers.append(observer)
+
+
+def _trace(statement: Statement, started: float, found: bool) -> None:
+    duration = time.perf_counter() - started
+    if settings.QUERY_TRACING_ENABLED:
+        query_trace.tracer.record(statement.sql, duration, int(found))
+    for observer in _observers:
+        observer(statement.sql, duration)
+
+
+async def fetchrow(db: AsyncSession, statement: Statement, *args):
+    prepared = await _statement(db, statement)
+    started = time.perf_counter()
+    row = await prepared.fetchrow(*args)
+    _trace(statement, started, row is not None)
+    return row
+
+
+async def fetchval(db: AsyncSession, statement: Statement, *args):
+    prepared = await _statement(db, statement)
+    started = time.perf_counter()
+    value = await prepared.fetchval(*args)
+    _trace(statement, started, value is not None)
+    return value
@@ -0,0 +1,135 @@
+"""
+Cache of authenticated principals, keyed by a hash of the bearer token.
+
+A hit skips both the JWT decode and the `users` lookup. Entries never outlive
+the token's own `exp`, and `invalidate_user()` (also reachable through
+`invalidation.publish(db, "user", user_id)`) drops every cached token of a
+user whose role or active flag changed.
+
+Also holds the token-version table used for revocation: every token carries
+the user's `token_version` at issue time ("ver"), and `revoke_tokens()` bumps
+it. Only users who ever revoked are kept in memory, so checking a token is a
+dict lookup.
+"""
+import asyncio
+import hashlib
+import time
+from typing import NamedTuple
+
+import structlog
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core import invalidation
+from app.core.cache import MISSING, TTLCache
+from app.core.config import settings
+from app.core.db import AsyncSessionLocal
+from app.models import all_models
+
+logger = structlog.get_logger()
+
+
+class Principal(NamedTuple):
+    id: int
+    organization_id: int | None
+    role: str
+    is_active: bool
+
+
+_cache = TTLCache(maxsize=settings.PRINCIPAL_CACHE_MAXSIZE, ttl=settings.PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+def _token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def get(token: str) -> Principal | None:
+    principal = _cache.get(_token_key(token))
+    return None if principal is MISSING else principal
+
+
+def put(token: str, principal: Principal, expires_at: float | None) -> None:
+    ttl = settings.PRINCIPAL_CACHE_TTL_SECONDS
+    if expires_at is not None:
+        ttl = min(ttl, expires_at - time.time())
+    if ttl > 0:
+        _cache.set(_token_key(token), principal, ttl=ttl)
+
+
+def invalidate_user(user_id: int | str) -> None:
+    if user_id == invalidation.ALL:
+        _cache.clear()
+    else:
+        user_id = int(user_id)
+        _cache.evict_where(lambda _, principal: principal.id == user_id)
+
+
+invalidation.register("user", invalidate_user)
+
+
+# user_id -> lowest token version still accepted (only users with token_version > 0)
+_token_versions: dict[int, int] = {}
+_reload_task: asyncio.Task | None = None
+
+
+def token_version_ok(user_id: int, version: int | None) -> bool:
+    """Tokens issued before versions existed count as version 0."""
+    return (version or 0) >= _token_versions.get(user_id, 0)
+
+
+def set_token_version(user_id: int, version: int) -> None:
+    if version > _token_versions.get(user_id, 0):
+        _token_versions[user_id] = version
+    invalidate_user(user_id)
+
+
+async def load_token_versions(session_factory=AsyncSessionLocal) -> None:
+    async with session_factory() as db:
+        result = await db.execute(
+            select(all_models.User.id, all_models.User.token_version).where(all_models.User.token_version > 0)
+        )
+        _token_versions.clear()
+        _token_versions.update(result.tuples().all())
+    _cache.clear()
+
+
+def _reload_in_background() -> None:
+    global _reload_task
+    if _reload_task is not None and not _reload_task.done():
+        return
+    try:
+        _reload_task = asyncio.get_running_loop().create_task(load_token_versions())
+    except RuntimeError:
+        return  # no loop: nothing is being served, the next startup loads the table
+    _reload_task.add_done_callback(_log_reload_failure)
+
+
+def _log_reload_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("token_version_reload_failed", error=str(task.exception()))
+
+
+def _on_token_version(key: str) -> None:
+    if key == invalidation.ALL:
+        # Revocations may have been missed: re-read them; cached principals go too
+        _cache.clear()
+        _reload_in_background()
+    else:
+        user_id, _, version = key.partition(".")
+        set_token_version(int(user_id), int(version))
+
+
+invalidation.register("token_version", _on_token_version)
+
+
+async def revoke_tokens(db: AsyncSession, user_id: int) -> int:
+    """Invalidate every token issued to the user so far. Takes effect everywhere once `db` commits."""
+    result = await db.execute(
+        update(all_models.User)
+        .where(all_models.User.id == user_id)
+        .values(token_version=all_models.User.token_version + 1)
+        .returning(all_models.User.token_version)
+    )
+    version = result.scalar_one()
+    await invalidation.publish(db, "token_version", f"{user_id}.{version}")
+    return version
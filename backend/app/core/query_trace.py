@@ -0,0 +1,123 @@
+"""
+Slow-query tracing on SQLAlchemy cursor events, replacing echo=True.
+
+Every statement is timed and folded into a per-fingerprint aggregate (count,
+total/max time, rows), served as a top-N table by the admin endpoint.
+Statements slower than SLOW_QUERY_THRESHOLD_MS are always logged, the rest
+are logged at QUERY_SAMPLE_RATE. Records go through the background log
+writer, so tracing never formats or writes a log line on the event loop.
+"""
+import random
+import re
+import time
+from typing import NamedTuple
+
+from sqlalchemy import event
+
+from app.core.config import settings
+from app.core.logging import current_route, log_writer
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\$\d+|%\(\w+\)s|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """Statement shape with literals and bind parameters replaced by `?`."""
+    shape = _LITERALS.sub("?", statement)
+    shape = _IN_LISTS.sub("(?, ...)", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+
+class QueryStat(NamedTuple):
+    fingerprint: str
+    calls: int
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    rows: int
+    last_route: str | None
+
+
+class _Aggregate:
+    __slots__ = ("calls", "total", "max", "rows", "last_route")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.last_route: str | None = None
+
+
+class QueryTracer:
+    def __init__(self, threshold_ms: float, sample_rate: float, max_fingerprints: int):
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.max_fingerprints = max_fingerprints
+        self._stats: dict[str, _Aggregate] = {}
+        # SQLAlchemy's compiled cache hands us the same few statement strings
+        # over and over, so fingerprinting is a dict hit after warm-up.
+        self._fingerprints: dict[str, str] = {}
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_started"] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.record(statement, time.perf_counter() - conn.info["query_started"], cursor.rowcount)
+
+    def record(self, statement: str, duration: float, rowcount: int) -> None:
+        shape = self._fingerprints.get(statement)
+        if shape is None:
+            if len(self._fingerprints) >= self.max_fingerprints * 4:
+                self._fingerprints.clear()
+            shape = self._fingerprints[statement] = fingerprint(statement)
+
+        route = current_route.get()
+        rows = max(rowcount, 0)  # -1 when the driver does not know
+        stat = self._stats.get(shape)
+        if stat is None and len(self._stats) < self.max_fingerprints:
+            stat = self._stats[shape] = _Aggregate()
+        if stat is not None:
+            stat.calls += 1
+            stat.total += duration
+            stat.rows += rows
+            stat.last_route = route
+            if duration > stat.max:
+                stat.max = duration
+
+        slow = duration >= self.threshold
+        if slow or random.random() < self.sample_rate:
+            log_writer.submit(
+                "warning" if slow else "info",
+                "slow_query" if slow else "sampled_query",
+                {
+                    "fingerprint": shape,
+                    "duration_ms": round(duration * 1000, 3),
+                    "rowcount": rowcount,
+                    "route": route,
+                },
+            )
+
+    def top(self, n: int = 20, order_by: str = "total_ms") -> list[QueryStat]:
+        stats = [
+            QueryStat(shape, s.calls, s.total * 1000, s.total * 1000 / s.calls, s.max * 1000, s.rows, s.last_route)
+            for shape, s in self._stats.items()
+        ]
+        stats.sort(key=lambda stat: getattr(stat, order_by), reverse=True)
+        return stats[:n]
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+
+tracer = QueryTracer(
+    threshold_ms=settings.SLOW_QUERY_THRESHOLD_MS,
+    sample_rate=settings.QUERY_SAMPLE_RATE,
+    max_fingerprints=settings.QUERY_STATS_MAX_FINGERPRINTS,
+)
+
+
+def install(sync_engine) -> None:
+    event.listen(sync_engine, "before_cursor_execute", tracer.before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", tracer.after_cursor_execute)
@@ -0,0 +1,62 @@
+"""
+Per-organization short-window rate limiting (SubscriptionPlan.rate_limit_per_minute).
+
+GCRA (generic cell rate algorithm): the only state per org is one float, the
+"theoretical arrival time" of the next request. A request conforms when that
+time is no further ahead of now than the burst allowance. No database access,
+no background task; entries whose arrival time has passed carry no
+information and are swept lazily.
+"""
+import math
+import time
+from typing import Callable, Hashable, NamedTuple
+
+
+class RateLimitDecision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float  # seconds until the next request would conform (0 when allowed)
+
+
+class GCRALimiter:
+    def __init__(self, sweep_interval: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self._tat: dict[Hashable, float] = {}
+        self._clock = clock
+        self._sweep_interval = sweep_interval
+        self._next_sweep = clock() + sweep_interval
+
+    def check(self, key: Hashable, rate_per_minute: int, burst: int | None = None) -> RateLimitDecision:
+        """Admit one request for `key` if it conforms, recording it; otherwise leave the state untouched."""
+        now = self._clock()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        burst = max(burst or rate_per_minute, 1)
+        interval = 60.0 / rate_per_minute
+        window = burst * interval
+
+        new_tat = max(self._tat.get(key, now), now) + interval
+        ahead = new_tat - now
+        if ahead > window:
+            return RateLimitDecision(False, rate_per_minute, 0, ahead - window)
+
+        self._tat[key] = new_tat
+        return RateLimitDecision(True, rate_per_minute, int((window - ahead) // interval), 0.0)
+
+    def reset(self, key: Hashable) -> None:
+        self._tat.pop(key, None)
+
+    def _sweep(self, now: float) -> None:
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+        self._next_sweep = now + self._sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._tat)
+
+
+limiter = GCRALimiter()
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(math.ceil(seconds), 1))
@@ -0,0 +1,99 @@
+"""
+Period rollover: create next window's usage counters before it starts.
+
+Without this, the first request of every active org in a new window inserts
+its counter row, so the window boundary (00:00 UTC on the 1st, or every five
+minutes in DEMO_MODE) turns into a burst of inserts on uq_usage_org_period
+right when traffic is heaviest. A background task wakes up
+PERIOD_ROLLOVER_LEAD_SECONDS before each boundary and creates the rows of
+every org with an active subscription, PERIOD_ROLLOVER_BATCH_SIZE orgs per
+multi-row insert. Inserts skip existing rows, so every worker can run it.
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import structlog
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.core import metering
+from app.core.backends import get_backend
+from app.core.config import settings
+from app.core.db import AsyncSessionLocal
+from app.models import all_models
+
+logger = structlog.get_logger()
+
+_rollover_task: asyncio.Task | None = None
+
+
+async def prepare_period(
+    period_start: datetime, session_factory: async_sessionmaker = AsyncSessionLocal, batch_size: int | None = None
+) -> int:
+    """Create `period_start`'s counters for every org with an active subscription. Returns the number of orgs."""
+    batch_size = batch_size or settings.PERIOD_ROLLOVER_BATCH_SIZE
+    backend = get_backend()
+    prepared = 0
+    after = 0
+    while True:
+        # Keyset pagination: each batch is one short read, then one insert
+        async with session_factory() as db:
+            result = await db.execute(
+                select(all_models.Subscription.organization_id, all_models.SubscriptionPlan.counter_slots)
+                .join(all_models.SubscriptionPlan, all_models.Subscription.plan_id == all_models.SubscriptionPlan.id)
+                .where(all_models.Subscription.is_active == True)
+                .where(all_models.Subscription.organization_id > after)
+                .order_by(all_models.Subscription.organization_id)
+                .distinct(all_models.Subscription.organization_id)
+                .limit(batch_size)
+            )
+            orgs = [tuple(row) for row in result.all()]
+        if not orgs:
+            return prepared
+        await backend.prepare_period(period_start, orgs)
+        prepared += len(orgs)
+        after = orgs[-1][0]
+
+
+def seconds_until_prepare(now: datetime | None = None) -> float:
+    """Seconds until next window's counters should be created (0 if already due)."""
+    now = now or datetime.now(timezone.utc)
+    period_start = metering.get_period_start(now)
+    next_window = metering.get_next_window(period_start)
+    # Never earlier than halfway through the window: DEMO_MODE windows are only five minutes
+    lead = min(settings.PERIOD_ROLLOVER_LEAD_SECONDS, (next_window - period_start).total_seconds() / 2)
+    return max((next_window - now).total_seconds() - lead, 0.0)
+
+
+async def _run_forever() -> None:
+    while True:
+        await asyncio.sleep(seconds_until_prepare())
+        next_window = metering.get_next_window(metering.get_period_start())
+        try:
+            prepared = await prepare_period(next_window)
+            logger.info("period_rollover_prepared", period_start=next_window.isoformat(), organizations=prepared)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("period_rollover_error", period_start=next_window.isoformat(), error=str(exc))
+            await asyncio.sleep(settings.PERIOD_ROLLOVER_RETRY_SECONDS)
+            continue
+        # Sleep past the boundary before looking for the window after it
+        await asyncio.sleep(max((next_window - datetime.now(timezone.utc)).total_seconds(), 0.0) + 1.0)
+
+
+def start() -> None:
+    global _rollover_task
+    if _rollover_task is None:
+        _rollover_task = asyncio.create_task(_run_forever())
+
+
+async def stop() -> None:
+    global _rollover_task
+    if _rollover_task is not None:
+        _rollover_task.cancel()
+        try:
+            await _rollover_task
+        except asyncio.CancelledError:
+            pass
+        _rollover_task = None
@@ -1,23 +1,52 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Union
+from typing import Any, Callable, TypeVar, Union
+from fastapi import HTTPException
 from jose import jwt
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 from app.core.config import settings
 
-ph = PasswordHasher()
+ph = PasswordHasher(
+    time_cost=settings.ARGON2_TIME_COST,
+    memory_cost=settings.ARGON2_MEMORY_COST,
+    parallelism=settings.ARGON2_PARALLELISM,
+)
 
 ALGORITHM = "HS256"
 
-def create_access_token(subject: Union[str, Any], expires_delta: timedelta = None) -> str:
+T = TypeVar("T")
+
+# Argon2 is deliberately slow (tens of ms per call). argon2-cffi releases the
+# GIL while hashing, so a small thread pool keeps it off the event loop.
+_hash_executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="argon2"
+)
+_hash_pending = 0  # running + queued; only touched from the event loop
+
+def create_access_token(
+    subject: Union[str, Any], expires_delta: timedelta = None, claims: dict[str, Any] | None = None
+) -> str:
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode = {"exp": expire, "sub": str(subject)}
+    to_encode = {**(claims or {}), "exp": expire, "sub": str(subject)}
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=ALGORITHM)
 
+def access_token_claims(user: Any) -> dict[str, Any]:
+    """
+    Extra claims for a user's token: always the token version (for revocation),
+    and with STATELESS_AUTH the organization and role, so that requests can be
+    authorized without reading the users table.
+    """
+    claims = {"ver": user.token_version}
+    if settings.STATELESS_AUTH:
+        claims.update(org=user.organization_id, role=user.role)
+    return claims
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     try:
         ph.verify(hashed_password, plain_password)
@@ -27,3 +56,32 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 
 def get_password_hash(password: str) -> str:
     return ph.hash(password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True when the hash was made with other cost parameters than the current settings."""
+    return ph.check_needs_rehash(hashed_password)
+
+async def _run_hasher(fn: Callable[..., T], *args: Any) -> T:
+    """
+    Run an Argon2 call in the bounded executor.
+    Fails fast with 503 once PASSWORD_HASH_MAX_PENDING calls are in flight, so a
+    login storm queues here instead of stalling metered requests.
+    """
+    global _hash_pending
+    if _hash_pending >= settings.PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication is temporarily overloaded. Please retry.",
+            headers={"Retry-After": "1"},
+        )
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, fn, *args)
+    finally:
+        _hash_pending -= 1
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_hasher(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_hasher(get_password_hash, password)
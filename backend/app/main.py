@@ -1,18 +1,42 @@
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-import structlog
-import time
 
 from app.core.config import settings
 from app.api.api_v1.api import api_router
-from app.core.logging import setup_logging
+from app.core.logging import RequestLoggingMiddleware, log_writer, setup_logging
+from app.api import metrics as metrics_endpoint
+from app.core import backends, health, invalidation, metering, metrics, principals, rollover
 
 # Setup Logging
 setup_logging()
-logger = structlog.get_logger()
 
-app = FastAPI(title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await principals.load_token_versions()
+    if settings.CACHE_INVALIDATION_LISTENER:
+        invalidation.start_listener()
+    if settings.METRICS_ENABLED:
+        metrics.start_loop_lag_monitor(settings.LOOP_LAG_INTERVAL_SECONDS)
+    if settings.PERIOD_ROLLOVER_ENABLED and settings.METERING_BACKEND != "memory":
+        rollover.start()
+    if settings.METERING_MODE == "leased":
+        metering.start_lease_sweeper()
+    health.start()
+    yield
+    await health.stop()
+    await rollover.stop()
+    await metering.stop_lease_sweeper()
+    await metrics.stop_loop_lag_monitor()
+    await metering.release_all_leases()
+    await backends.get_backend().close()
+    await invalidation.stop_listener()
+    log_writer.stop()
+
+
+app = FastAPI(title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json", lifespan=lifespan)
 
 # Middleware
 app.add_middleware(
@@ -23,25 +47,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
-
-@app.middleware("http")
-async def logging_middleware(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    
-    # structlog is synchronous — do NOT await it
-    logger.info(
-        "request_processed",
-        path=request.url.path,
-        method=request.method,
-        status_code=response.status_code,
-        process_time_ms=round(process_time * 1000, 2),
-    )
-    response.headers["X-Process-Time"] = str(round(process_time * 1000, 2))
-    return response
+app.add_middleware(RequestLoggingMiddleware)
 
 app.include_router(api_router, prefix=settings.API_V1_STR)
+if settings.METRICS_ENABLED:
+    app.include_router(metrics_endpoint.router, tags=["metrics"])
 
 @app.get("/")
 async def root():
@@ -30,6 +30,7 @@ class User(Base):
     full_name = Column(String)
     role = Column(String, default=UserRole.USER) # Using String for simplicity in DB, validated by Enum in App
     is_active = Column(Boolean, default=True)
+    token_version = Column(Integer, default=0, server_default="0", nullable=False) # Bumped to revoke stateless tokens
     
     organization_id = Column(Integer, ForeignKey("organizations.id"))
     organization = relationship("Organization", back_populates="users")
@@ -42,6 +43,7 @@ class SubscriptionPlan(Base):
     description = Column(String)
     monthly_quota = Column(Integer, nullable=False) # Total requests allowed per month
     rate_limit_per_minute = Column(Integer, nullable=True) # Optional rate limit
+    counter_slots = Column(Integer, default=1, server_default="1", nullable=False) # Usage counter rows per org (postgres_sharded backend)
     
     subscriptions = relationship("Subscription", back_populates="plan")
 
@@ -72,3 +74,19 @@ class UsageRecord(Base):
     )
 
     organization = relationship("Organization", back_populates="usage_records")
+
+# One of the K counters of an (organization, period) under the postgres_sharded
+# metering backend. The period's usage is the sum of its slots.
+class UsageRecordSlot(Base):
+    __tablename__ = "usage_record_slots"
+
+    id = Column(Integer, primary_key=True)
+    organization_id = Column(Integer, ForeignKey("organizations.id"), nullable=False)
+    period_start = Column(DateTime(timezone=True), nullable=False)
+    slot = Column(Integer, nullable=False)
+    request_count = Column(Integer, default=0, nullable=False)
+    last_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('organization_id', 'period_start', 'slot', name='uq_usage_slot_org_period_slot'),
+    )
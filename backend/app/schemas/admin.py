@@ -0,0 +1,12 @@
+from typing import Optional
+from pydantic import BaseModel
+
+
+class QueryStat(BaseModel):
+    fingerprint: str
+    calls: int
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    rows: int
+    last_route: Optional[str] = None
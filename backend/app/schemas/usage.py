@@ -0,0 +1,20 @@
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class OrgUsage(BaseModel):
+    org_id: int
+    period_start: datetime
+    reported: int
+    accepted: int
+    rejected: int
+    used: Optional[int] = None
+    monthly_quota: Optional[int] = None
+
+
+class UsageIngestResult(BaseModel):
+    events: int
+    accepted: int
+    rejected: int
+    organizations: List[OrgUsage]
@@ -25,3 +25,8 @@ class Token(BaseModel):
 
 class TokenPayload(BaseModel):
     sub: Optional[str] = None
+    exp: Optional[int] = None
+    ver: Optional[int] = None # users.token_version when issued
+    # Stateless tokens only (STATELESS_AUTH)
+    org: Optional[int] = None
+    role: Optional[str] = None
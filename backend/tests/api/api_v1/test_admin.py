@@ -0,0 +1,19 @@
+import pytest
+from httpx import AsyncClient
+from app.core.config import settings
+
+
+@pytest.mark.anyio
+async def test_query_stats_require_a_platform_admin(client: AsyncClient):
+    response = await client.get(f"{settings.API_V1_STR}/admin/queries")
+    assert response.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_usage_ingestion_requires_a_platform_admin(client: AsyncClient):
+    response = await client.post(
+        f"{settings.API_V1_STR}/usage/events",
+        content=b'{"org_id": 1, "timestamp": "2026-01-01T00:00:00Z"}\n',
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 401
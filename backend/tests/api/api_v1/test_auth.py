@@ -0,0 +1,54 @@
+import uuid
+import pytest
+from httpx import AsyncClient
+from jose import jwt
+from app.core import principals, security
+from app.core.config import settings
+
+
+async def signup_and_login(client: AsyncClient) -> str:
+    suffix = uuid.uuid4().hex[:10]
+    email = f"stateless-{suffix}@example.com"
+    response = await client.post(
+        f"{settings.API_V1_STR}/users/",
+        json={"email": email, "password": "password123", "organization_name": f"Stateless Org {suffix}"},
+    )
+    assert response.status_code == 200
+    response = await client.post(
+        f"{settings.API_V1_STR}/login/access-token", data={"username": email, "password": "password123"}
+    )
+    assert response.status_code == 200
+    return response.json()["access_token"]
+
+
+@pytest.mark.anyio
+async def test_stateless_token_authorizes_without_users_lookup(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(settings, "STATELESS_AUTH", True)
+    token = await signup_and_login(client)
+
+    claims = jwt.decode(token, settings.SECRET_KEY, algorithms=[security.ALGORITHM])
+    assert claims["role"] == "org_admin" and claims["org"] and claims["ver"] == 0
+
+    lookups = []
+    monkeypatch.setattr(principals, "put", lambda *args: lookups.append(args))
+    response = await client.get(f"{settings.API_V1_STR}/widgets/", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200
+    # Principal built from the claims alone
+    (_, principal, _), = lookups
+    assert principal.organization_id == claims["org"] and principal.role == "org_admin"
+
+
+@pytest.mark.anyio
+async def test_revoking_tokens_rejects_them_everywhere(client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(settings, "STATELESS_AUTH", True)
+    token = await signup_and_login(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert (await client.get(f"{settings.API_V1_STR}/widgets/", headers=headers)).status_code == 200
+
+    response = await client.post(f"{settings.API_V1_STR}/users/me/revoke-tokens", headers=headers)
+    assert response.status_code == 204
+
+    response = await client.get(f"{settings.API_V1_STR}/widgets/", headers=headers)
+    assert response.status_code == 403
+    assert response.json()["detail"] == "Token has been revoked"
@@ -0,0 +1,34 @@
+import pytest
+from httpx import AsyncClient
+from app.core import admission, metrics
+from app.core.admission import AdaptiveLimiter
+from app.core.config import settings
+
+
+@pytest.fixture
+def saturated(monkeypatch):
+    limiter = AdaptiveLimiter(initial_limit=5, min_limit=5, priority_headroom=1)
+    limiter.in_flight = 5
+    monkeypatch.setattr(admission, "limiter", limiter)
+    monkeypatch.setattr(settings, "ADMISSION_CONTROL_ENABLED", True)
+    return limiter
+
+
+@pytest.mark.anyio
+async def test_metered_requests_over_the_limit_are_shed(client: AsyncClient, saturated):
+    shed = metrics.SHED_NORMAL.value
+
+    response = await client.get(f"{settings.API_V1_STR}/widgets/", headers={"Authorization": "Bearer not-a-jwt"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert metrics.SHED_NORMAL.value == shed + 1
+    assert saturated.in_flight == 5
+
+
+@pytest.mark.anyio
+async def test_admin_and_health_routes_have_priority(client: AsyncClient, saturated):
+    # Admitted through the headroom, then refused for lack of credentials
+    assert (await client.get(f"{settings.API_V1_STR}/admin/queries")).status_code == 401
+    assert (await client.get(f"{settings.API_V1_STR}/health/live")).status_code == 200
+    assert saturated.in_flight == 5
@@ -0,0 +1,39 @@
+import pytest
+from httpx import AsyncClient
+from app.core import metrics
+from app.core.config import settings
+
+
+@pytest.mark.anyio
+async def test_liveness_touches_nothing(client: AsyncClient):
+    checkouts = sum(metrics.POOL_CHECKOUT.counts)
+
+    response = await client.get(f"{settings.API_V1_STR}/health/live")
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+    assert sum(metrics.POOL_CHECKOUT.counts) == checkouts
+
+
+@pytest.mark.anyio
+async def test_readiness_reports_pool_stats_without_a_pool_connection(client: AsyncClient):
+    checkouts = sum(metrics.POOL_CHECKOUT.counts)
+
+    response = await client.get(f"{settings.API_V1_STR}/health/ready")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "ok" and body["reasons"] == []
+    assert body["database"]["connected"] and body["database"]["latency_ms"] >= 0
+    pool = body["pool"]
+    assert pool["size"] >= 0 and pool["checked_out"] == 0
+    assert pool["max_overflow"] == settings.DB_MAX_OVERFLOW
+    assert sum(metrics.POOL_CHECKOUT.counts) == checkouts
+
+
+@pytest.mark.anyio
+async def test_health_is_readiness(client: AsyncClient):
+    response = await client.get(f"{settings.API_V1_STR}/health")
+
+    assert response.status_code == 200
+    assert set(response.json()) == {"status", "reasons", "database", "event_loop_lag_ms", "pool"}
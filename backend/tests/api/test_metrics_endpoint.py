@@ -0,0 +1,21 @@
+import pytest
+from httpx import AsyncClient
+from app.core.config import settings
+
+
+@pytest.mark.anyio
+async def test_metrics_endpoint_exposes_stages_outcomes_and_pool(client: AsyncClient):
+    await client.get(f"{settings.API_V1_STR}/health")
+    await client.get(f"{settings.API_V1_STR}/widgets/", headers={"Authorization": "Bearer not-a-jwt"})
+
+    response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'metering_stage_seconds_count{stage="jwt_decode"}' in body
+    assert 'metering_http_responses_total{code="403"}' in body
+    assert "metering_db_pool_checkout_seconds_count" in body
+    assert 'metering_db_pool_connections{state="size"}' in body
+    assert "# TYPE metering_event_loop_lag_seconds histogram" in body
+
@@ -5,6 +5,7 @@ from httpx import AsyncClient, ASGITransport
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 from app.main import app
+from app.core.db import engine
 from app.core.config import settings
 from app.models import all_models
 
@@ -58,3 +59,16 @@ async def client() -> AsyncGenerator:
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as c:
         yield c
+    # Pooled connections belong to this test's loop: don't hand them to the next one
+    await engine.dispose()
+
+
+@pytest.fixture(scope="function")
+async def session_factory() -> AsyncGenerator:
+    """
+    Session factory bound to a private engine on the test's own event loop,
+    for tests that drive the metering engine directly against PostgreSQL.
+    """
+    engine = create_async_engine(settings.get_database_url(), echo=False, pool_size=20)
+    yield async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
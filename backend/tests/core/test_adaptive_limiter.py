@@ -0,0 +1,65 @@
+from app.core.admission import AdaptiveLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_limiter(**kwargs):
+    options = dict(initial_limit=10, min_limit=2, max_limit=20, latency_target=0.1, backoff=0.5, priority_headroom=2)
+    return AdaptiveLimiter(**{**options, **kwargs}, clock=FakeClock())
+
+
+def test_requests_over_the_limit_are_refused():
+    limiter = make_limiter()
+
+    assert all(limiter.try_acquire() for _ in range(10))
+    assert not limiter.try_acquire()
+    # Priority requests go past the limit, up to the headroom
+    assert limiter.try_acquire(priority=True) and limiter.try_acquire(priority=True)
+    assert not limiter.try_acquire(priority=True)
+
+    limiter.release(0.01)
+    assert limiter.in_flight == 11
+
+
+def test_fast_requests_grow_a_busy_limit_additively():
+    limiter = make_limiter()
+    for _ in range(10):
+        limiter.try_acquire()
+
+    for _ in range(10):
+        limiter.release(0.01)
+
+    # About one more slot per limit's worth of fast requests, while at least half used
+    assert 10.4 < limiter.limit < 10.6
+
+
+def test_idle_limit_does_not_grow():
+    limiter = make_limiter()
+    for _ in range(100):
+        limiter.try_acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 10
+
+
+def test_slow_or_failed_requests_cut_the_limit_once_per_target_latency():
+    limiter = make_limiter()
+    for _ in range(4):
+        limiter.try_acquire()
+
+    limiter.release(0.5)
+    limiter.release(0.5)
+    assert limiter.limit == 5
+
+    limiter._clock.now += 0.1
+    limiter.release(0.01, overloaded=True)
+    assert limiter.limit == 2.5
+
+    limiter._clock.now += 0.1
+    limiter.release(0.5)
+    assert limiter.limit == 2  # never below min_limit
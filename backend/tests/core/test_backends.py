@@ -0,0 +1,255 @@
+import asyncio
+import subprocess
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.core import backends
+from app.core.backends.base import BatchItem
+from app.core.backends.memory import MemoryMeteringBackend
+from app.core.backends.postgres import build_batch_reserve_statement, build_metering_statement, build_update_statement
+from app.core.backends.shared import FLUSHER, INFLIGHT, PENDING, SharedCounterTable, SharedMemoryMeteringBackend
+from app.core.backends.sharded import build_slot_reserve_statement
+
+PERIOD = datetime(2026, 1, 1, tzinfo=timezone.utc)
+NEXT_PERIOD = datetime(2026, 2, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.anyio
+async def test_memory_reserve_is_all_or_nothing_by_default():
+    backend = MemoryMeteringBackend()
+
+    assert await backend.reserve(1, PERIOD, 8, 10) == (8, 8)
+    assert await backend.reserve(1, PERIOD, 3, 10) == (0, 8)
+    assert await backend.reserve(1, PERIOD, 2, 10) == (2, 10)
+    assert await backend.reserve(1, PERIOD, 1, 10) == (0, 10)
+
+
+@pytest.mark.anyio
+async def test_memory_partial_reserve_grants_what_is_left():
+    backend = MemoryMeteringBackend()
+
+    assert await backend.reserve(1, PERIOD, 8, 10, partial=True) == (8, 8)
+    assert await backend.reserve(1, PERIOD, 5, 10, partial=True) == (2, 10)
+    assert await backend.reserve(1, PERIOD, 5, 10, partial=True) == (0, 10)
+
+
+@pytest.mark.anyio
+async def test_memory_release_peek_and_reset():
+    backend = MemoryMeteringBackend()
+    await backend.reserve(1, PERIOD, 6, 10)
+
+    await backend.release(1, PERIOD, 4)
+    assert await backend.peek(1, PERIOD) == 2
+    await backend.release(1, PERIOD, 5)
+    assert await backend.peek(1, PERIOD) == 0
+
+    await backend.reserve(1, PERIOD, 3, 10)
+    await backend.reset(1, PERIOD)
+    assert await backend.peek(1, PERIOD) == 0
+    assert await backend.peek(2, PERIOD) == 0
+
+
+@pytest.mark.anyio
+async def test_memory_new_period_reuses_the_org_slot():
+    """Only the current period is kept: rollover starts at 0 and stale releases are ignored."""
+    backend = MemoryMeteringBackend(shards=1)
+    await backend.reserve(1, PERIOD, 10, 10)
+
+    assert await backend.reserve(1, NEXT_PERIOD, 1, 10) == (1, 1)
+    await backend.release(1, PERIOD, 10)
+    assert await backend.peek(1, NEXT_PERIOD) == 1
+    assert await backend.peek(1, PERIOD) == 0
+    assert len(backend) == 1
+
+
+@pytest.mark.anyio
+async def test_memory_backend_keeps_orgs_apart_across_shards():
+    backend = MemoryMeteringBackend(shards=8)
+    for org_id in range(1000):
+        await backend.reserve(org_id, PERIOD, org_id % 7 + 1, 10)
+
+    assert len(backend) == 1000
+    assert [await backend.peek(org_id, PERIOD) for org_id in (0, 6, 7, 999)] == [1, 7, 1, 6]
+
+
+def test_backend_selected_by_settings(monkeypatch):
+    monkeypatch.setattr(backends.settings, "METERING_BACKEND", "memory")
+    backends.set_backend(None)
+    try:
+        assert isinstance(backends.get_backend(), MemoryMeteringBackend)
+        assert backends.get_backend() is backends.get_backend()
+    finally:
+        backends.set_backend(None)
+
+    with pytest.raises(ValueError):
+        backends.create_backend("cassandra")
+
+
+def test_postgres_statement_is_single_upsert():
+    """The check-and-increment compiles to one INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement."""
+    stmt = build_metering_statement(1, PERIOD, 1, 100)
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("INSERT INTO usage_records")
+    assert "ON CONFLICT (organization_id, period_start) DO UPDATE" in sql
+    assert "WHERE usage_records.request_count +" in sql
+    assert "RETURNING usage_records.request_count" in sql
+
+
+def test_sharded_statement_picks_one_unlocked_slot():
+    """A slot reservation is one statement: pick a slot with room, skip locked ones, update it."""
+    stmt = build_slot_reserve_statement(1, PERIOD, 3, 100, need=1, preferred=2, skip_locked=True)
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("WITH k AS")
+    assert "FOR UPDATE OF usage_record_slots SKIP LOCKED" in sql
+    assert "UPDATE usage_record_slots SET request_count=" in sql
+    assert "LIMIT" in sql
+
+
+def test_postgres_batch_statement_locks_rows_in_id_order():
+    stmt = build_batch_reserve_statement([BatchItem(1, PERIOD, 5, 100), BatchItem(2, PERIOD, 3, 10)])
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+
+    assert "(VALUES" in sql
+    assert "ORDER BY usage_records.id FOR UPDATE OF usage_records" in sql
+    assert "UPDATE usage_records SET request_count=(usage_records.request_count + least(" in sql
+
+
+def test_postgres_known_row_statement_is_a_plain_update():
+    sql = str(build_update_statement(1, PERIOD, 1, 100).compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("UPDATE usage_records SET")
+    assert "INSERT" not in sql
+    assert "RETURNING usage_records.request_count" in sql
+
+
+@pytest.fixture
+def shared_tables():
+    """Tables attached to one fresh shared block, as the workers of a host would."""
+    name = f"test_counters_{uuid.uuid4().hex[:12]}"
+
+    def attach(capacity=64):
+        return SharedCounterTable(name, capacity)
+
+    yield attach
+    # Tests close their backends (and so the tables); the block itself outlives them
+    SharedCounterTable(name, 1).close(unlink=True)
+
+
+@pytest.mark.anyio
+async def test_shared_backend_absorbs_increments_until_flushed(shared_tables):
+    inner = MemoryMeteringBackend(shards=1)
+    await inner.reserve(1, PERIOD, 3, 10)
+    backend = SharedMemoryMeteringBackend(inner, shared_tables(), flush_interval=3600, flush_threshold=100)
+
+    assert await backend.reserve(1, PERIOD, 2, 10) == (2, 5)
+    assert await backend.reserve(1, PERIOD, 4, 10) == (4, 9)
+    assert await inner.peek(1, PERIOD) == 3
+
+    await backend.flush()
+    assert await inner.peek(1, PERIOD) == 9
+    assert await backend.peek(1, PERIOD) == 9
+    await backend.close()
+
+
+@pytest.mark.anyio
+async def test_shared_backend_workers_share_one_quota(shared_tables):
+    """Two workers attached to the same block never admit more than the quota between them."""
+    inner = MemoryMeteringBackend(shards=1)
+    first = SharedMemoryMeteringBackend(inner, shared_tables(), flush_interval=3600)
+    second = SharedMemoryMeteringBackend(inner, shared_tables(), flush_interval=3600)
+
+    granted = [
+        (await worker.reserve(1, PERIOD, 1, 10)).granted
+        for _ in range(8)
+        for worker in (first, second)
+    ]
+    assert sum(granted) == 10
+    await second.flush()
+    assert await inner.peek(1, PERIOD) == 10
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.anyio
+async def test_shared_backend_flushes_at_the_threshold_and_evicts_old_periods(shared_tables):
+    inner = MemoryMeteringBackend(shards=1)
+    table = shared_tables()
+    backend = SharedMemoryMeteringBackend(inner, table, flush_interval=3600, flush_threshold=3)
+
+    for _ in range(3):
+        await backend.reserve(1, PERIOD, 1, 10)
+    await asyncio.sleep(0)  # let the threshold flush run
+    assert await inner.peek(1, PERIOD) == 3
+
+    await backend.release(1, PERIOD, 2)
+    await backend.flush(evict_before=int(NEXT_PERIOD.timestamp()))
+    assert await inner.peek(1, PERIOD) == 1
+    assert table.scan() == []
+    await backend.close()
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def leave_in_flight(table, flusher: int) -> None:
+    """What a worker killed mid-flush leaves behind: the row's delta in flight, under its pid."""
+    (index, _, _), = table.scan()
+    with table.locked():
+        table.set(index, INFLIGHT, table.get(index, PENDING))
+        table.set(index, PENDING, 0)
+        table.set(index, FLUSHER, flusher)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("landed", [False, True])
+async def test_shared_backend_reclaims_a_delta_left_in_flight_by_a_dead_worker(shared_tables, landed):
+    inner = MemoryMeteringBackend(shards=1)
+    table = shared_tables()
+    backend = SharedMemoryMeteringBackend(inner, table, flush_interval=3600, flush_threshold=100)
+    await backend.reserve(1, PERIOD, 4, 10)
+    leave_in_flight(table, dead_pid())
+    if landed:
+        await inner.reserve(1, PERIOD, 4, 10)  # it died after its write
+    await backend.reserve(1, PERIOD, 1, 10)
+
+    await backend.flush(evict_before=int(NEXT_PERIOD.timestamp()))
+    assert await inner.peek(1, PERIOD) == 5
+    assert table.scan() == []
+    await backend.close()
+
+
+@pytest.mark.anyio
+async def test_shared_backend_leaves_a_live_workers_flush_alone(shared_tables):
+    inner = MemoryMeteringBackend(shards=1)
+    table = shared_tables()
+    backend = SharedMemoryMeteringBackend(inner, table, flush_interval=3600, flush_threshold=100)
+    await backend.reserve(1, PERIOD, 4, 10)
+    leave_in_flight(table, 1)  # init never dies
+
+    await backend.flush(evict_before=int(NEXT_PERIOD.timestamp()))
+    assert await inner.peek(1, PERIOD) == 0
+    assert len(table.scan()) == 1
+    with table.locked():
+        table.set(table.scan()[0][0], INFLIGHT, 0)
+    await backend.close()
+
+
+@pytest.mark.anyio
+async def test_shared_backend_falls_back_to_inner_when_full(shared_tables):
+    inner = MemoryMeteringBackend(shards=1)
+    backend = SharedMemoryMeteringBackend(inner, shared_tables(capacity=1), flush_interval=3600)
+
+    assert await backend.reserve(1, PERIOD, 1, 10) == (1, 1)
+    assert await backend.reserve(2, PERIOD, 1, 10) == (1, 1)
+    assert await inner.peek(2, PERIOD) == 1  # no room: written through
+    assert await inner.peek(1, PERIOD) == 0
+    await backend.close()
@@ -0,0 +1,52 @@
+from app.core.cache import MISSING, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=5, clock=clock)
+    cache.set("a", 1)
+
+    clock.now = 4.9
+    assert cache.get("a") == 1
+    clock.now = 5.0
+    assert cache.get("a") is MISSING
+    assert len(cache) == 0
+
+
+def test_per_entry_ttl_overrides_default():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+    cache.set("short", None, ttl=1)
+
+    assert cache.get("short") is None
+    clock.now = 1
+    assert cache.get("short") is MISSING
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_evict_where():
+    cache = TTLCache(maxsize=10, ttl=60)
+    for key in range(5):
+        cache.set(key, key % 2)
+
+    assert cache.evict_where(lambda _, value: value == 1) == 2
+    assert sorted(cache) == [0, 2, 4]
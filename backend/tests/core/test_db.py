@@ -0,0 +1,13 @@
+from app.core import db
+
+
+def test_pgbouncer_mode_disables_statement_caches(monkeypatch):
+    monkeypatch.setattr(db.settings, "DB_PGBOUNCER_MODE", False)
+    assert db._connect_args() == {}
+
+    monkeypatch.setattr(db.settings, "DB_PGBOUNCER_MODE", True)
+    args = db._connect_args()
+    assert args["statement_cache_size"] == 0
+    assert args["prepared_statement_cache_size"] == 0
+    name = args["prepared_statement_name_func"]
+    assert name() != name()
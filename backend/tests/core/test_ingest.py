@@ -0,0 +1,102 @@
+import json
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+from fastapi import HTTPException
+from app.core import backends, ingest, metering
+from app.core.backends.memory import MemoryMeteringBackend
+
+NOW = datetime(2026, 3, 15, 12, 0, tzinfo=timezone.utc)
+MARCH = datetime(2026, 3, 1, tzinfo=timezone.utc)
+FEBRUARY = datetime(2026, 2, 1, tzinfo=timezone.utc)
+
+
+def ndjson(*events) -> bytes:
+    return b"".join(json.dumps(event).encode() + b"\n" for event in events)
+
+
+async def stream(body: bytes, chunk_size: int):
+    for start in range(0, len(body), chunk_size):
+        yield body[start:start + chunk_size]
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    metering.plan_cache.clear()
+    metering.exhausted_cache.clear()
+    yield
+    metering.plan_cache.clear()
+    metering.exhausted_cache.clear()
+
+
+@pytest.fixture
+def monthly_windows(monkeypatch):
+    """MARCH and FEBRUARY are monthly period starts: CI runs with DEMO_MODE's 5-minute windows."""
+    monkeypatch.setattr(metering.settings, "DEMO_MODE", False)
+
+
+@pytest.fixture
+def backend():
+    backend = MemoryMeteringBackend(shards=4)
+    backends.set_backend(backend)
+    yield backend
+    backends.set_backend(None)
+
+
+@pytest.mark.anyio
+async def test_events_are_aggregated_per_org_and_period_across_chunks(monthly_windows):
+    body = ndjson(
+        {"org_id": 1, "units": 3, "timestamp": "2026-03-10T08:00:00Z"},
+        {"org_id": 1, "timestamp": "2026-03-14T08:00:00"},
+        {"org_id": 1, "units": 2, "timestamp": "2026-02-28T23:59:59Z"},
+        {"org_id": 2, "units": 5, "timestamp": "2026-03-01T00:00:00Z"},
+    )
+    # 7-byte chunks split every line, and some chunks hold the end of one line and the start of the next
+    aggregate = await ingest.read_events(stream(body, 7), max_events=10, max_line_bytes=200)
+
+    assert aggregate.events == 4
+    assert aggregate.totals == {(1, MARCH): 4, (1, FEBRUARY): 2, (2, MARCH): 5}
+
+
+@pytest.mark.anyio
+async def test_a_last_line_without_newline_is_read(monthly_windows):
+    body = ndjson({"org_id": 1, "timestamp": "2026-03-10T08:00:00Z"}) + b'{"org_id": 1, "timestamp": "2026-03-11T08:00:00Z"}'
+    aggregate = await ingest.read_events(stream(body, 64), max_events=10, max_line_bytes=200)
+    assert aggregate.totals == {(1, MARCH): 2}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("body, status_code", [
+    (b'{"org_id": 1, "timestamp": "2026-03-10T08:00:00Z"}\n{"org_id": 1}\n', 422),
+    (b'{"org_id": 1, "units": 0, "timestamp": "2026-03-10T08:00:00Z"}\n', 422),
+    (b'{"org_id": 1, "timestamp": "2999-01-01T00:00:00Z"}\n', 422),
+    (b'not json\n', 422),
+    (b'{"org_id": 1, "timestamp": "2026-03-10T08:00:00Z"}\n' * 3, 413),
+    (b'{"org_id": 1, "timestamp": "2026-03-10T08:00:00Z", "pad": "' + b"x" * 300 + b'"}\n', 413),
+])
+async def test_invalid_bodies_are_refused(body, status_code):
+    with pytest.raises(HTTPException) as exc:
+        await ingest.read_events(stream(body, 16), max_events=2, max_line_bytes=200)
+    assert exc.value.status_code == status_code
+
+
+@pytest.mark.anyio
+async def test_apply_charges_each_org_up_to_its_quota(backend):
+    period_start = metering.get_period_start()
+    metering.plan_cache.set(1, metering.PlanLimits(1, 10, None))
+    metering.plan_cache.set(2, metering.PlanLimits(2, 100, None))
+    metering.plan_cache.set(3, None)
+    await backend.reserve(1, period_start, 6, 10)
+    db = AsyncMock()
+    db.in_transaction = MagicMock(return_value=False)
+
+    results = await ingest.apply_usage(db, {(1, period_start): 7, (2, period_start): 7, (3, period_start): 2})
+
+    assert results == [
+        ingest.OrgUsage(1, period_start, 7, 4, 3, 10, 10),
+        ingest.OrgUsage(2, period_start, 7, 7, 0, 7, 100),
+        ingest.OrgUsage(3, period_start, 2, 0, 2, None, None),
+    ]
+    db.execute.assert_not_awaited()  # every plan came from the cache
+    # Org 1 is now refused without touching the backend
+    assert metering.exhausted_cache.get(1) == (period_start, 10)
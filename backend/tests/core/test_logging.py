@@ -0,0 +1,57 @@
+import pytest
+from httpx import AsyncClient, ASGITransport
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from app.core import metrics
+from app.core.logging import BackgroundLogWriter, RequestLoggingMiddleware
+
+
+def make_client(writer: BackgroundLogWriter, sample_rate: float) -> AsyncClient:
+    async def endpoint(request):
+        return PlainTextResponse("x", status_code=int(request.path_params["status"]))
+
+    async def boom(request):
+        raise RuntimeError("boom")
+
+    app = Starlette(routes=[Route("/status/{status}", endpoint), Route("/boom", boom)])
+    app.add_middleware(RequestLoggingMiddleware, writer=writer, sample_rate=sample_rate)
+    return AsyncClient(transport=ASGITransport(app=app, raise_app_exceptions=False), base_url="http://test")
+
+
+def queued(writer: BackgroundLogWriter) -> list[tuple[str, int]]:
+    return [(level, fields["status_code"]) for level, _, fields in writer._records]
+
+
+@pytest.mark.anyio
+async def test_successes_are_sampled_but_errors_and_429s_are_always_logged():
+    writer = BackgroundLogWriter(maxsize=100)
+    async with make_client(writer, sample_rate=0.0) as client:
+        for status in (200, 201, 403, 429):
+            response = await client.get(f"/status/{status}")
+            assert float(response.headers["X-Process-Time"]) >= 0
+        assert (await client.get("/boom")).status_code == 500
+
+    assert queued(writer) == [("info", 403), ("info", 429), ("error", 500)]
+
+
+@pytest.mark.anyio
+async def test_full_sample_rate_logs_every_request():
+    writer = BackgroundLogWriter(maxsize=100)
+    async with make_client(writer, sample_rate=1.0) as client:
+        await client.get("/status/200")
+
+    (_, event, fields), = writer._records
+    assert event == "request_processed"
+    assert fields["path"] == "/status/200" and fields["method"] == "GET"
+
+
+def test_full_queue_drops_and_counts():
+    writer = BackgroundLogWriter(maxsize=2)
+    dropped = metrics.LOG_RECORDS_DROPPED.value
+
+    assert [writer.submit("info", "e", {}) for _ in range(3)] == [True, True, False]
+    assert metrics.LOG_RECORDS_DROPPED.value == dropped + 1
+    assert writer.drain() == 2
+    assert writer.submit("info", "e", {})
@@ -1,132 +1,359 @@
+import asyncio
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
 from fastapi import HTTPException
-from app.core import metering
-from app.models import all_models
+from app.core import backends, invalidation, metering
+from app.core.backends.memory import MemoryMeteringBackend
+from app.core.cache import MISSING, TTLCache
 
 
-def make_mock_subscription(org_id, limit=1000):
-    plan = MagicMock(spec=all_models.SubscriptionPlan)
-    plan.monthly_quota = limit
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
 
-    sub = MagicMock(spec=all_models.Subscription)
-    sub.organization_id = org_id
-    sub.plan = plan
-    return sub
+    def __call__(self):
+        return self.now
+
+
+def make_limits(limit=1000, plan_id=1):
+    return metering.PlanLimits(plan_id=plan_id, monthly_quota=limit, rate_limit_per_minute=None)
+
+
+def make_db(in_transaction=False):
+    db = AsyncMock()
+    db.in_transaction = MagicMock(return_value=in_transaction)
+    return db
+
+
+def make_result(value):
+    result = MagicMock()
+    result.scalar_one_or_none.return_value = value
+    result.first.return_value = value
+    return result
+
+
+@pytest.fixture(autouse=True)
+def empty_plan_cache():
+    metering.plan_cache.clear()
+    metering.exhausted_cache.clear()
+    yield
+    metering.plan_cache.clear()
+    metering.exhausted_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def core_statements(monkeypatch):
+    """The mocked sessions here stand in for the SQLAlchemy path, not for prepared statements."""
+    monkeypatch.setattr(metering.settings, "PREPARED_STATEMENTS_ENABLED", False)
+
+
+@pytest.fixture
+def backend():
+    backend = MemoryMeteringBackend(shards=4)
+    backends.set_backend(backend)
+    yield backend
+    backends.set_backend(None)
 
 
 @pytest.mark.anyio
-async def test_track_usage_no_subscription():
+async def test_track_usage_no_subscription(backend):
     """If no active subscription exists, the request must be blocked with 403."""
     db = AsyncMock()
     org_id = 99
 
-    with patch("app.core.metering.get_current_subscription", new_callable=AsyncMock) as mock_get_sub:
-        mock_get_sub.return_value = None
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = None
 
         with pytest.raises(HTTPException) as exc:
             await metering.track_and_enforce_usage(db, org_id)
 
         assert exc.value.status_code == 403
         assert "No active subscription" in exc.value.detail
+        assert len(backend) == 0
 
 
 @pytest.mark.anyio
-async def test_track_usage_increment_success():
-    """
-    Happy path: record exists, limit not reached.
-    The new architecture executes 3 statements in order:
-      1. INSERT ON CONFLICT DO NOTHING  (ensure record exists)
-      2. UPDATE ... WHERE count < limit RETURNING count  (atomic increment)
-      3. commit
-    """
-    db = AsyncMock()
+async def test_track_usage_increment_success(backend):
+    """Happy path: limit not reached, one unit is counted and the new count returned."""
+    db = make_db()
     org_id = 1
+    period_start = metering.get_period_start()
+    await backend.reserve(org_id, period_start, 54, 100)
 
-    sub = make_mock_subscription(org_id, limit=100)
-
-    with patch("app.core.metering.get_current_subscription", new_callable=AsyncMock) as mock_get_sub:
-        mock_get_sub.return_value = sub
-
-        # 1st execute = INSERT ON CONFLICT (return value not used)
-        mock_insert_result = MagicMock()
-
-        # 2nd execute = UPDATE RETURNING new count
-        mock_update_result = MagicMock()
-        mock_update_result.scalars().first.return_value = 55
-
-        db.execute.side_effect = [mock_insert_result, mock_update_result]
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
 
         used, limit = await metering.track_and_enforce_usage(db, org_id)
 
         assert used == 55
         assert limit == 100
-        db.commit.assert_called_once()
-        # Exactly 2 SQL statements fired
-        assert db.execute.call_count == 2
+        assert await backend.peek(org_id, period_start) == 55
+        db.execute.assert_not_called()
 
 
 @pytest.mark.anyio
-async def test_track_usage_limit_reached():
-    """
-    Limit reached: UPDATE returns None (WHERE count < limit fails).
-    A follow-up SELECT confirms the record is at the limit → 429.
-    Sequence: INSERT ON CONFLICT, UPDATE (None), SELECT (record at limit)
-    """
-    db = AsyncMock()
+async def test_track_usage_limit_reached(backend):
+    """Limit reached: 429 with Retry-After, and the counter stays at the limit."""
+    db = make_db()
     org_id = 1
-    limit = 100
-    sub = make_mock_subscription(org_id, limit=limit)
-
-    with patch("app.core.metering.get_current_subscription", new_callable=AsyncMock) as mock_get_sub:
-        mock_get_sub.return_value = sub
-
-        mock_insert_result = MagicMock()
-
-        # UPDATE returns None → limit reached
-        mock_update_result = MagicMock()
-        mock_update_result.scalars().first.return_value = None
-
-        # SELECT returns existing record at max usage
-        mock_record = MagicMock(spec=all_models.UsageRecord)
-        mock_record.request_count = limit
-        mock_select_result = MagicMock()
-        mock_select_result.scalars().first.return_value = mock_record
+    period_start = metering.get_period_start()
+    await backend.reserve(org_id, period_start, 100, 100)
 
-        db.execute.side_effect = [mock_insert_result, mock_update_result, mock_select_result]
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
 
         with pytest.raises(HTTPException) as exc:
             await metering.track_and_enforce_usage(db, org_id)
 
         assert exc.value.status_code == 429
         assert "Rate limit exceeded" in exc.value.detail
+        assert int(exc.value.headers["Retry-After"]) >= 0
+        assert await backend.peek(org_id, period_start) == 100
+
+
+@pytest.mark.anyio
+async def test_exhausted_org_is_refused_without_a_backend_call(backend, monkeypatch):
+    """After the first quota 429, the org is refused from memory with the same Retry-After."""
+    db = make_db()
+    await backend.reserve(1, metering.get_period_start(), 100, 100)
+    reserve = AsyncMock(wraps=backend.reserve)
+    monkeypatch.setattr(backend, "reserve", reserve)
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
+        for _ in range(3):
+            with pytest.raises(HTTPException) as exc:
+                await metering.track_and_enforce_usage(db, 1)
+            assert exc.value.status_code == 429
+            assert int(exc.value.headers["Retry-After"]) > 0
+
+    assert reserve.await_count == 1
+
+
+@pytest.mark.anyio
+async def test_exhausted_entry_cleared_by_upgrade_and_rollover(backend):
+    db = make_db()
+    period_start = metering.get_period_start()
+    await backend.reserve(1, period_start, 100, 100)
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
+        with pytest.raises(HTTPException):
+            await metering.track_and_enforce_usage(db, 1)
+        assert metering.exhausted_cache.get(1) == (period_start, 100)
+
+        # A bigger quota no longer matches the cached (period, limit)
+        mock_get_limits.return_value = make_limits(limit=200)
+        used, _ = await metering.track_and_enforce_usage(db, 1)
+        assert used == 101
+
+    # Window rollover: a different period_start does not match either
+    metering.exhausted_cache.set(1, (period_start, 200), ttl=60)
+    with patch("app.core.metering.get_period_start", return_value=metering.get_next_window(period_start)), \
+            patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=200)
+        used, _ = await metering.track_and_enforce_usage(db, 1)
+        assert used == 1
+
+    # Subscription changes published for the org drop the entry outright
+    metering.exhausted_cache.set(1, (period_start, 200), ttl=60)
+    invalidation.dispatch("organization", "1")
+    assert metering.exhausted_cache.get(1) is MISSING
+
+
+@pytest.mark.anyio
+async def test_track_usage_releases_request_transaction(backend):
+    """A transaction left open by the plan lookup is committed before the backend is called."""
+    db = make_db(in_transaction=True)
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
+        await metering.track_and_enforce_usage(db, 1)
+
+    db.commit.assert_called_once()
 
 
 @pytest.mark.anyio
-async def test_track_usage_metering_error_fallback():
-    """
-    UPDATE returns None AND the follow-up SELECT also returns None.
-    This is an unexpected edge case → should raise 500.
-    """
+async def test_leased_mode_on_memory_backend(backend, monkeypatch):
+    """Leases work on any backend: exactly the quota is admitted and unused units go back."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 4)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_PLAN_FRACTION", 0.5)
+    metering._leases.clear()
+    db = make_db()
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=10)
+        admitted = []
+        for _ in range(12):
+            try:
+                admitted.append((await metering.track_and_enforce_usage(db, 1))[0])
+            except HTTPException as exc:
+                assert exc.status_code == 429
+
+    assert admitted == list(range(1, 11))
+    await metering.release_all_leases()
+    assert await backend.peek(1, metering.get_period_start()) == 10
+
+
+@pytest.mark.anyio
+async def test_leases_of_closed_windows_are_swept_back(backend, monkeypatch):
+    """An org whose last request fell in the old window must not keep a chunk of phantom usage there."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 4)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_PLAN_FRACTION", 0.5)
+    metering._leases.clear()
+    period_start = metering.get_period_start()
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
+        await metering.track_and_enforce_usage(make_db(), 1)
+    assert await backend.peek(1, period_start) == 4
+
+    assert await metering.release_expired_leases() == 0  # its window is still open
+    assert await metering.release_expired_leases(metering.get_next_window(period_start)) == 1
+    assert await backend.peek(1, period_start) == 1
+    await metering.release_all_leases()
+    assert await backend.peek(1, period_start) == 1
+
+
+@pytest.mark.anyio
+async def test_plan_limits_are_cached():
+    """A second lookup for the same org is served without touching the database."""
     db = AsyncMock()
-    org_id = 1
-    sub = make_mock_subscription(org_id, limit=100)
+    db.execute.return_value = make_result((7, 100, 10))
+
+    first = await metering.get_plan_limits(db, 1)
+    second = await metering.get_plan_limits(db, 1)
+
+    assert first == second == metering.PlanLimits(7, 100, 10)
+    assert db.execute.call_count == 1
+
+
+@pytest.mark.anyio
+async def test_no_subscription_is_negatively_cached():
+    db = AsyncMock()
+    db.execute.return_value = make_result(None)
+
+    assert await metering.get_plan_limits(db, 1) is None
+    assert await metering.get_plan_limits(db, 1) is None
+    assert db.execute.call_count == 1
+
+
+@pytest.mark.anyio
+async def test_plan_invalidation_evicts_every_org_on_that_plan():
+    db = AsyncMock()
+    db.execute.side_effect = [make_result((7, 100, 10)), make_result((8, 100, 10)), make_result((7, 5, 10))]
+    await metering.get_plan_limits(db, 1)
+    await metering.get_plan_limits(db, 2)
 
-    with patch("app.core.metering.get_current_subscription", new_callable=AsyncMock) as mock_get_sub:
-        mock_get_sub.return_value = sub
+    invalidation.dispatch("plan", "7")
 
-        mock_insert_result = MagicMock()
+    assert metering.plan_cache.get(2) == metering.PlanLimits(8, 100, 10)
+    assert (await metering.get_plan_limits(db, 1)).monthly_quota == 5
+    assert db.execute.call_count == 3
 
-        mock_update_result = MagicMock()
-        mock_update_result.scalars().first.return_value = None
 
-        mock_select_result = MagicMock()
-        mock_select_result.scalars().first.return_value = None
+@pytest.mark.anyio
+async def test_weighted_request_is_charged_all_at_once(backend):
+    """A 5-unit request takes 5 units, and is refused outright when they do not all fit."""
+    db = make_db()
+    period_start = metering.get_period_start()
+    await backend.reserve(1, period_start, 92, 100)
 
-        db.execute.side_effect = [mock_insert_result, mock_update_result, mock_select_result]
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=100)
+        assert await metering.track_and_enforce_usage(db, 1, units=5) == (97, 100)
 
         with pytest.raises(HTTPException) as exc:
-            await metering.track_and_enforce_usage(db, org_id)
+            await metering.track_and_enforce_usage(db, 1, units=5)
+        assert exc.value.status_code == 429
+        assert await backend.peek(1, period_start) == 97
+
+        # Too little left for 5 units is not exhaustion: single units still get in
+        assert metering.exhausted_cache.get(1) is MISSING
+        assert await metering.track_and_enforce_usage(db, 1) == (98, 100)
+
+
+@pytest.mark.anyio
+async def test_cost_above_the_whole_quota_is_not_retryable(backend):
+    """A request that could never fit gets a 413 without Retry-After, and charges nothing."""
+    db = make_db()
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=10)
+        with pytest.raises(HTTPException) as exc:
+            await metering.track_and_enforce_usage(db, 1, units=11)
 
-        assert exc.value.status_code == 500
-        assert "Metering error" in exc.value.detail
+    assert exc.value.status_code == 413
+    assert "Retry-After" not in (exc.value.headers or {})
+    assert await backend.peek(1, metering.get_period_start()) == 0
+    assert metering.exhausted_cache.get(1) is MISSING
+
+
+@pytest.mark.anyio
+async def test_weighted_requests_in_leased_mode(backend, monkeypatch):
+    """A request costing more than a chunk grows the reservation; a leftover too small for it stays for cheaper ones."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 2)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_PLAN_FRACTION", 0.5)
+    metering._leases.clear()
+    db = make_db()
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=10)
+        assert await metering.track_and_enforce_usage(db, 1, units=6) == (6, 10)
+        assert await metering.track_and_enforce_usage(db, 1, units=3) == (9, 10)
+        with pytest.raises(HTTPException):
+            await metering.track_and_enforce_usage(db, 1, units=3)
+        assert await metering.track_and_enforce_usage(db, 1) == (10, 10)
+
+    await metering.release_all_leases()
+    assert await backend.peek(1, metering.get_period_start()) == 10
+
+
+@pytest.mark.anyio
+async def test_leased_exhaustion_is_remembered_briefly(backend, monkeypatch):
+    """Units other workers' leases hand back later must become usable again before the window ends."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_EXHAUSTED_TTL_SECONDS", 5.0)
+    clock = FakeClock()
+    monkeypatch.setattr(metering, "exhausted_cache", TTLCache(maxsize=10, ttl=0, clock=clock))
+    metering._leases.clear()
+    db = make_db()
+    period_start = metering.get_period_start()
+    await backend.reserve(1, period_start, 10, 10)  # another worker's lease holds everything
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=10)
+        with pytest.raises(HTTPException):
+            await metering.track_and_enforce_usage(db, 1)
+        assert metering.exhausted_cache.get(1) == (period_start, 10)
+
+        await backend.release(1, period_start, 4)  # ...and returns part of it
+        clock.now += 6
+        assert metering.exhausted_cache.get(1) is MISSING
+        assert (await metering.track_and_enforce_usage(db, 1))[0] >= 7
+
+    await metering.release_all_leases()
+
+
+@pytest.mark.anyio
+async def test_weighted_requests_in_coalesced_mode(backend, monkeypatch):
+    """A batch admits every waiter whose whole cost still fits, in order, and gives back the rest."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "coalesced")
+    monkeypatch.setattr(metering.settings, "COALESCE_WINDOW_MS", 50)
+    db = make_db()
+
+    async def one_request(units):
+        try:
+            return (await metering.track_and_enforce_usage(db, 1, units=units))[0]
+        except HTTPException as exc:
+            return exc.status_code
+
+    with patch("app.core.metering.get_plan_limits", new_callable=AsyncMock) as mock_get_limits:
+        mock_get_limits.return_value = make_limits(limit=10)
+        results = await asyncio.gather(*(one_request(units) for units in (4, 5, 3, 1)))
+
+    assert results == [4, 9, 429, 10]
+    assert await backend.peek(1, metering.get_period_start()) == 10
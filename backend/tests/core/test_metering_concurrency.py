@@ -0,0 +1,274 @@
+import asyncio
+import uuid
+from unittest.mock import AsyncMock
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+from app.core import backends, metering, metrics, rollover
+from app.core.backends.base import BatchItem
+from app.core.backends.postgres import PostgresMeteringBackend
+from app.core.backends.sharded import ShardedPostgresMeteringBackend
+from app.models import all_models
+
+
+@pytest.fixture
+def backend(session_factory):
+    """PostgreSQL backend on the test's private engine."""
+    backend = PostgresMeteringBackend(session_factory)
+    backends.set_backend(backend)
+    yield backend
+    backends.set_backend(None)
+
+
+async def create_org_with_quota(session_factory, quota: int, counter_slots: int = 1) -> int:
+    """Create a throwaway org on a dedicated plan so concurrent runs never share a counter."""
+    suffix = uuid.uuid4().hex[:12]
+    async with session_factory() as db:
+        plan = all_models.SubscriptionPlan(name=f"concurrency-{suffix}", monthly_quota=quota, counter_slots=counter_slots)
+        org = all_models.Organization(name=f"concurrency-org-{suffix}")
+        db.add_all([plan, org])
+        await db.flush()
+        db.add(all_models.Subscription(organization_id=org.id, plan_id=plan.id, is_active=True))
+        await db.commit()
+        return org.id
+
+
+async def read_count(session_factory, org_id: int) -> int:
+    async with session_factory() as db:
+        result = await db.execute(
+            select(all_models.UsageRecord.request_count).where(
+                all_models.UsageRecord.organization_id == org_id,
+                all_models.UsageRecord.period_start == metering.get_period_start(),
+            )
+        )
+        return result.scalar_one()
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_never_overcount(session_factory, backend):
+    """50 simultaneous requests against a quota of 20: exactly 20 admitted, the rest get 429."""
+    quota = 20
+    org_id = await create_org_with_quota(session_factory, quota)
+
+    async def one_request():
+        async with session_factory() as db:
+            try:
+                await metering.track_and_enforce_usage(db, org_id)
+                return 200
+            except HTTPException as exc:
+                return exc.status_code
+
+    statuses = await asyncio.gather(*(one_request() for _ in range(50)))
+
+    assert statuses.count(200) == quota
+    assert statuses.count(429) == 50 - quota
+    assert await read_count(session_factory, org_id) == quota
+
+
+@pytest.mark.anyio
+async def test_leased_mode_never_overadmits_and_returns_unused_units(session_factory, backend, monkeypatch):
+    """Leases admit exactly the quota in memory, and handing them back leaves the true count."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 8)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_PLAN_FRACTION", 0.5)
+
+    quota = 20
+    org_id = await create_org_with_quota(session_factory, quota)
+
+    async def one_request():
+        async with session_factory() as db:
+            try:
+                await metering.track_and_enforce_usage(db, org_id)
+                return 200
+            except HTTPException as exc:
+                return exc.status_code
+
+    statuses = await asyncio.gather(*(one_request() for _ in range(50)))
+    await metering.release_all_leases()
+
+    assert statuses.count(200) == quota
+    assert statuses.count(429) == 50 - quota
+    assert await read_count(session_factory, org_id) == quota
+
+
+@pytest.mark.anyio
+async def test_leased_mode_hands_back_unspent_units(session_factory, backend, monkeypatch):
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "leased")
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 10)
+
+    org_id = await create_org_with_quota(session_factory, 1000)
+    async with session_factory() as db:
+        used, limit = await metering.track_and_enforce_usage(db, org_id)
+
+    assert (used, limit) == (1, 1000)
+    # The whole chunk is counted while leased...
+    assert await read_count(session_factory, org_id) == 10
+    await metering.release_all_leases()
+    # ...and only what was admitted remains once it is returned
+    assert await read_count(session_factory, org_id) == 1
+
+
+def test_lease_chunk_shrinks_near_exhaustion(monkeypatch):
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_MAX_CHUNK", 50)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_PLAN_FRACTION", 0.01)
+    monkeypatch.setattr(metering.settings, "QUOTA_LEASE_SHARE_DIVISOR", 4)
+
+    assert metering.lease_chunk_size(100000, 0) == 50
+    assert metering.lease_chunk_size(1000, 0) == 10
+    assert metering.lease_chunk_size(1000, 980) == 5
+    assert metering.lease_chunk_size(1000, 999) == 1
+
+
+@pytest.mark.anyio
+async def test_coalesced_mode_batches_and_admits_exactly_the_quota(session_factory, backend, monkeypatch):
+    """50 simultaneous requests fold into a few `+ k` updates; the straddling batch is partially admitted."""
+    monkeypatch.setattr(metering.settings, "METERING_MODE", "coalesced")
+    monkeypatch.setattr(metering.settings, "COALESCE_MAX_BATCH", 16)
+
+    reservations = []
+    reserve = backend.reserve
+
+    async def counting_reserve(org_id, period_start, units, limit, *, partial=False, slots=1):
+        reservations.append(units)
+        return await reserve(org_id, period_start, units, limit, partial=partial, slots=slots)
+
+    monkeypatch.setattr(backend, "reserve", counting_reserve)
+
+    quota = 20
+    org_id = await create_org_with_quota(session_factory, quota)
+
+    async def one_request():
+        async with session_factory() as db:
+            try:
+                used, _ = await metering.track_and_enforce_usage(db, org_id)
+                return used
+            except HTTPException as exc:
+                return exc.status_code
+
+    results = await asyncio.gather(*(one_request() for _ in range(50)))
+
+    admitted = sorted(r for r in results if r != 429)
+    # Every admitted request saw its own, distinct usage count
+    assert admitted == list(range(1, quota + 1))
+    assert results.count(429) == 50 - quota
+    assert sum(reservations) == 50
+    assert len(reservations) < 50
+    assert await read_count(session_factory, org_id) == quota
+
+
+@pytest.fixture
+def sharded_backend(session_factory):
+    backend = ShardedPostgresMeteringBackend(session_factory)
+    backends.set_backend(backend)
+    yield backend
+    backends.set_backend(None)
+
+
+async def read_slots(session_factory, org_id: int) -> list[int]:
+    async with session_factory() as db:
+        result = await db.execute(
+            select(all_models.UsageRecordSlot.request_count)
+            .where(all_models.UsageRecordSlot.organization_id == org_id)
+            .order_by(all_models.UsageRecordSlot.slot)
+        )
+        return list(result.scalars())
+
+
+@pytest.mark.anyio
+async def test_sharded_counters_admit_exactly_the_quota(session_factory, sharded_backend):
+    """50 simultaneous requests over 4 slots with a quota of 22: every share is used, none exceeded."""
+    quota = 22
+    org_id = await create_org_with_quota(session_factory, quota, counter_slots=4)
+
+    async def one_request():
+        async with session_factory() as db:
+            try:
+                await metering.track_and_enforce_usage(db, org_id)
+                return 200
+            except HTTPException as exc:
+                return exc.status_code
+
+    statuses = await asyncio.gather(*(one_request() for _ in range(50)))
+
+    assert statuses.count(200) == quota
+    assert statuses.count(429) == 50 - quota
+    # Shares are 6, 6, 5, 5: requests borrowed from other slots once theirs filled up
+    assert await read_slots(session_factory, org_id) == [6, 6, 5, 5]
+
+
+@pytest.mark.anyio
+async def test_sharded_multi_unit_reservations_span_slots(session_factory, sharded_backend):
+    org_id = await create_org_with_quota(session_factory, 10, counter_slots=4)
+    period_start = metering.get_period_start()
+
+    # Shares are 3, 3, 2, 2: 5 units fit in no single slot, so they are gathered from several
+    granted, count = await sharded_backend.reserve(org_id, period_start, 5, 10, slots=4)
+    assert (granted, count) == (5, 5)
+    # All-or-nothing: 6 more would exceed the quota, nothing is kept
+    assert (await sharded_backend.reserve(org_id, period_start, 6, 10, slots=4)).granted == 0
+    assert await sharded_backend.peek(org_id, period_start) == 5
+    # Partial takes what is left
+    assert await sharded_backend.reserve(org_id, period_start, 6, 10, partial=True, slots=4) == (5, 10)
+
+    await sharded_backend.release(org_id, period_start, 4)
+    assert await sharded_backend.peek(org_id, period_start) == 6
+
+
+@pytest.mark.anyio
+async def test_refused_multi_unit_reservation_never_takes_units_it_gives_back(session_factory, sharded_backend, monkeypatch):
+    """Units gathered from several slots are committed together or not at all, never taken and released."""
+    org_id = await create_org_with_quota(session_factory, 10, counter_slots=4)
+    period_start = metering.get_period_start()
+    assert (await sharded_backend.reserve(org_id, period_start, 5, 10, slots=4)).granted == 5
+    monkeypatch.setattr(sharded_backend, "release", AsyncMock(side_effect=AssertionError("compensating release")))
+
+    assert await sharded_backend.reserve(org_id, period_start, 6, 10, slots=4) == (0, None)
+    assert await sharded_backend.reserve(org_id, period_start, 5, 10, slots=4) == (5, 10)
+    assert await read_slots(session_factory, org_id) == [3, 3, 2, 2]
+
+
+@pytest.mark.anyio
+async def test_concurrent_batches_never_exceed_any_quota(session_factory, backend):
+    """Overlapping bulk batches lock rows in the same order: no deadlock, no over-admission."""
+    quotas = [5, 20, 40]
+    org_ids = [await create_org_with_quota(session_factory, quota) for quota in quotas]
+    period_start = metering.get_period_start()
+    await backend.reserve(org_ids[1], period_start, 15, 20)  # only this one has a row already
+
+    async def one_batch(order):
+        return await backend.reserve_batch([BatchItem(org_ids[i], period_start, 4, quotas[i]) for i in order])
+
+    results = await asyncio.gather(*(one_batch([0, 1, 2] if n % 2 else [2, 1, 0]) for n in range(8)))
+
+    granted = [sum(result[i if n % 2 else 2 - i].granted for n, result in enumerate(results)) for i in range(3)]
+    assert granted == [5, 5, 32]
+    assert [await read_count(session_factory, org_id) for org_id in org_ids] == [5, 20, 32]
+
+
+@pytest.mark.anyio
+async def test_rollover_prepares_next_period_rows(session_factory, backend):
+    """
+    The job creates next window's row up front; the first request then skips
+    the upsert, and requests for the current window keep skipping it meanwhile.
+    """
+    org_id = await create_org_with_quota(session_factory, 10)
+    current_window = metering.get_period_start()
+    next_window = metering.get_next_window(current_window)
+    assert await backend.reserve(org_id, current_window, 1, 10) == (1, 1)
+
+    assert await rollover.prepare_period(next_window, session_factory, batch_size=2) >= 1
+    async with session_factory() as db:
+        result = await db.execute(
+            select(all_models.UsageRecord.request_count).where(
+                all_models.UsageRecord.organization_id == org_id,
+                all_models.UsageRecord.period_start == next_window,
+            )
+        )
+        assert result.scalar_one() == 0
+
+    assert backend._knows_row(org_id, next_window)
+    upserts = sum(metrics.UPSERT.counts)
+    assert await backend.reserve(org_id, current_window, 1, 10) == (1, 2)
+    assert sum(metrics.UPSERT.counts) == upserts
+    assert await backend.reserve(org_id, next_window, 10, 10) == (10, 10)
+    assert await backend.reserve(org_id, next_window, 1, 10) == (0, None)
@@ -0,0 +1,56 @@
+import pytest
+
+from app.core import metrics
+
+
+def test_histogram_buckets_are_cumulative_in_exposition():
+    histogram = metrics.Histogram("test_histogram_seconds", "Test.", ["stage"], buckets=(0.1, 1.0))
+    child = histogram.labels("a")
+    for value in (0.05, 0.1, 0.5, 3.0):
+        child.observe(value)
+
+    lines = histogram.render().splitlines()
+
+    assert lines[:2] == ["# HELP test_histogram_seconds Test.", "# TYPE test_histogram_seconds histogram"]
+    assert 'test_histogram_seconds_bucket{stage="a",le="0.1"} 2' in lines
+    assert 'test_histogram_seconds_bucket{stage="a",le="1.0"} 3' in lines
+    assert 'test_histogram_seconds_bucket{stage="a",le="+Inf"} 4' in lines
+    assert 'test_histogram_seconds_count{stage="a"} 4' in lines
+    assert 'test_histogram_seconds_sum{stage="a"} 3.65' in lines
+
+
+def test_labels_return_the_same_child():
+    counter = metrics.Counter("test_counter_total", "Test.", ["code"])
+    assert counter.labels("x") is counter.labels("x")
+
+
+def test_record_response_buckets_outcomes():
+    before = {code: child.value for code, child in metrics.RESPONSES._children.items()}
+
+    for status_code in (200, 201, 403, 429, 500, 404):
+        metrics.record_response(status_code)
+
+    after = {code: child.value for code, child in metrics.RESPONSES._children.items()}
+    assert {code: after[code] - before[code] for code in after} == {
+        ("2xx",): 2, ("403",): 1, ("429",): 1, ("500",): 1, ("other",): 1,
+    }
+
+
+def test_histogram_quantile_is_the_bucket_upper_bound():
+    child = metrics.Histogram("test_quantile_seconds", "Test.", buckets=(0.1, 1.0)).labels()
+    assert child.quantile(0.5) is None
+
+    for value in (0.05,) * 98 + (0.5, 3.0):
+        child.observe(value)
+
+    assert child.quantile(0.5) == 0.1
+    assert child.quantile(0.99) == 1.0
+    assert child.quantile(1.0) == float("inf")
+
+
+def test_metric_kinds_must_implement_children_and_samples():
+    class Incomplete(metrics._Metric):
+        kind = "gauge"
+
+    with pytest.raises(TypeError):
+        Incomplete("test_incomplete", "Test.")
@@ -0,0 +1,85 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from app.core import prepared, query_trace
+
+
+class FakeConnection:
+    """Stands in for an asyncpg connection: records what it was asked to prepare."""
+
+    def __init__(self):
+        self.prepared = []
+
+    async def prepare(self, sql):
+        self.prepared.append(sql)
+        statement = MagicMock()
+        statement.fetchval = AsyncMock(return_value=len(self.prepared))
+        return statement
+
+
+def make_session(driver_connection):
+    raw = MagicMock()
+    raw.driver_connection = driver_connection
+    connection = MagicMock()
+    connection.get_raw_connection = AsyncMock(return_value=raw)
+    db = MagicMock()
+    db.connection = AsyncMock(return_value=connection)
+    return db
+
+
+def test_disabled_behind_pgbouncer(monkeypatch):
+    monkeypatch.setattr(prepared.settings, "PREPARED_STATEMENTS_ENABLED", True)
+    monkeypatch.setattr(prepared.settings, "DB_PGBOUNCER_MODE", False)
+    assert prepared.enabled()
+
+    monkeypatch.setattr(prepared.settings, "DB_PGBOUNCER_MODE", True)
+    assert not prepared.enabled()
+
+
+@pytest.mark.anyio
+async def test_warm_connection_prepares_nothing_per_call():
+    connection = FakeConnection()
+    await prepared.warm(connection)
+    assert connection.prepared == [statement.sql for statement in prepared.STATEMENTS]
+
+    db = make_session(connection)
+    await prepared.fetchval(db, prepared.METER_UPDATE, 1, None, 1, 10)
+    await prepared.fetchval(db, prepared.METER_UPDATE, 1, None, 1, 10)
+    assert len(connection.prepared) == len(prepared.STATEMENTS)
+
+
+@pytest.mark.anyio
+async def test_cold_connection_prepares_once_on_first_use():
+    connection = FakeConnection()
+    db = make_session(connection)
+
+    assert await prepared.fetchval(db, prepared.PLAN_LIMITS, 1) == 1
+    assert await prepared.fetchval(db, prepared.PLAN_LIMITS, 2) == 1
+    assert connection.prepared == [prepared.PLAN_LIMITS.sql]
+
+
+@pytest.mark.anyio
+async def test_calls_are_reported_to_the_query_tracer(monkeypatch):
+    tracer = query_trace.QueryTracer(threshold_ms=1000, sample_rate=0.0, max_fingerprints=10)
+    monkeypatch.setattr(query_trace, "tracer", tracer)
+    monkeypatch.setattr(prepared.settings, "QUERY_TRACING_ENABLED", True)
+    db = make_session(FakeConnection())
+
+    await prepared.fetchval(db, prepared.METER_UPDATE, 1, None, 1, 10)
+    await prepared.fetchval(db, prepared.METER_UPDATE, 1, None, 1, 10)
+
+    (stat,) = tracer.top()
+    assert stat.fingerprint == query_trace.fingerprint(prepared.METER_UPDATE.sql)
+    assert stat.calls == 2 and stat.rows == 2
+
+
+@pytest.mark.anyio
+async def test_calls_are_reported_to_observers(monkeypatch):
+    seen = []
+    monkeypatch.setattr(prepared, "_observers", [])
+    prepared.add_observer(lambda sql, seconds: seen.append((sql, seconds >= 0)))
+    db = make_session(FakeConnection())
+
+    await prepared.fetchval(db, prepared.PLAN_LIMITS, 1)
+
+    assert seen == [(prepared.PLAN_LIMITS.sql, True)]
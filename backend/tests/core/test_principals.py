@@ -0,0 +1,60 @@
+import time
+from app.core import invalidation, principals
+from app.core.principals import Principal
+
+
+def setup_function():
+    principals.invalidate_user(invalidation.ALL)
+
+
+def test_cached_principal_is_returned_by_token():
+    principal = Principal(id=1, organization_id=10, role="user", is_active=True)
+    principals.put("token-a", principal, time.time() + 600)
+
+    assert principals.get("token-a") == principal
+    assert principals.get("token-b") is None
+
+
+def test_expired_token_is_never_cached():
+    principals.put("stale", Principal(1, 10, "user", True), time.time() - 1)
+
+    assert principals.get("stale") is None
+
+
+def test_ttl_never_outlives_token_expiry(monkeypatch):
+    principals.put("short", Principal(1, 10, "user", True), time.time() + 30)
+    now = time.monotonic()
+
+    monkeypatch.setattr(principals._cache, "_clock", lambda: now + 31)
+    assert principals.get("short") is None
+
+
+def test_invalidate_user_purges_all_of_their_tokens():
+    expires_at = time.time() + 600
+    principals.put("a1", Principal(1, 10, "user", True), expires_at)
+    principals.put("a2", Principal(1, 10, "user", True), expires_at)
+    principals.put("b1", Principal(2, 10, "user", True), expires_at)
+
+    invalidation.dispatch("user", "1")
+
+    assert principals.get("a1") is None
+    assert principals.get("a2") is None
+    assert principals.get("b1") is not None
+
+
+def test_published_token_version_revokes_older_tokens_and_evicts_cache():
+    principals._token_versions.clear()
+    principals.put("old", Principal(7, 10, "user", True), time.time() + 600)
+    assert principals.token_version_ok(7, None)
+
+    invalidation.dispatch("token_version", "7.2")
+
+    assert principals.get("old") is None
+    assert not principals.token_version_ok(7, None)
+    assert not principals.token_version_ok(7, 1)
+    assert principals.token_version_ok(7, 2)
+    assert principals.token_version_ok(8, 0)
+    # A late, lower version never un-revokes
+    invalidation.dispatch("token_version", "7.1")
+    assert not principals.token_version_ok(7, 1)
+    principals._token_versions.clear()
@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import event, text
+
+from app.core import query_trace
+from app.core.logging import BackgroundLogWriter, current_route
+
+
+def test_fingerprint_replaces_literals_and_parameters():
+    statement = """SELECT users.id FROM users
+        WHERE users.email = 'a@b.c' AND users.id IN ($1, $2, $3) LIMIT 10"""
+
+    assert query_trace.fingerprint(statement) == (
+        "SELECT users.id FROM users WHERE users.email = ? AND users.id IN (?, ...) LIMIT ?"
+    )
+
+
+def test_aggregates_by_fingerprint_and_logs_only_slow_queries(monkeypatch):
+    writer = BackgroundLogWriter(maxsize=10)
+    monkeypatch.setattr(query_trace, "log_writer", writer)
+    tracer = query_trace.QueryTracer(threshold_ms=50, sample_rate=0.0, max_fingerprints=10)
+
+    token = current_route.set("GET /api/v1/widgets/")
+    try:
+        tracer.record("SELECT 1 FROM t WHERE id = $1", 0.010, 1)
+        tracer.record("SELECT 1 FROM t WHERE id = $1", 0.080, 1)
+        tracer.record("UPDATE t SET n = n + 1", 0.005, -1)
+    finally:
+        current_route.reset(token)
+
+    top = tracer.top(order_by="total_ms")
+    assert [stat.fingerprint for stat in top] == ["SELECT ? FROM t WHERE id = ?", "UPDATE t SET n = n + ?"]
+    assert top[0].calls == 2 and top[0].rows == 2
+    assert top[0].max_ms == pytest.approx(80) and top[0].mean_ms == pytest.approx(45)
+    assert top[0].last_route == "GET /api/v1/widgets/"
+
+    (level, event_name, fields), = writer._records
+    assert (level, event_name, fields["route"]) == ("warning", "slow_query", "GET /api/v1/widgets/")
+
+
+def test_fingerprint_table_is_bounded():
+    tracer = query_trace.QueryTracer(threshold_ms=1000, sample_rate=0.0, max_fingerprints=2)
+    for table in ("a", "b", "c"):
+        tracer.record(f"SELECT * FROM {table}", 0.001, 0)
+
+    assert len(tracer.top(10)) == 2
+
+
+@pytest.mark.anyio
+async def test_traces_statements_through_engine_events(session_factory):
+    tracer = query_trace.QueryTracer(threshold_ms=1000, sample_rate=0.0, max_fingerprints=10)
+    sync_engine = session_factory.kw["bind"].sync_engine
+    event.listen(sync_engine, "before_cursor_execute", tracer.before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", tracer.after_cursor_execute)
+
+    token = current_route.set("GET /traced")
+    try:
+        async with session_factory() as db:
+            await db.execute(text("SELECT 42"))
+    finally:
+        current_route.reset(token)
+
+    stat = next(stat for stat in tracer.top(10) if stat.fingerprint == "SELECT ?")
+    assert stat.calls == 1 and stat.last_route == "GET /traced"
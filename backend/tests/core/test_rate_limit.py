@@ -0,0 +1,55 @@
+from app.core.rate_limit import GCRALimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_up_to_rate_then_reject():
+    clock = FakeClock()
+    limiter = GCRALimiter(clock=clock)
+
+    decisions = [limiter.check("org", 10) for _ in range(11)]
+
+    assert all(d.allowed for d in decisions[:10])
+    assert [d.remaining for d in decisions[:3]] == [9, 8, 7]
+    assert decisions[-1].allowed is False
+    # One slot frees up every 60 / 10 = 6 seconds
+    assert abs(decisions[-1].retry_after - 6.0) < 1e-6
+
+
+def test_rejection_does_not_consume_capacity():
+    clock = FakeClock()
+    limiter = GCRALimiter(clock=clock)
+    for _ in range(10):
+        limiter.check("org", 10)
+    for _ in range(100):
+        assert not limiter.check("org", 10).allowed
+
+    clock.now += 6
+    assert limiter.check("org", 10).allowed
+
+
+def test_orgs_are_isolated():
+    limiter = GCRALimiter(clock=FakeClock())
+    for _ in range(10):
+        limiter.check("a", 10)
+
+    assert not limiter.check("a", 10).allowed
+    assert limiter.check("b", 10).allowed
+
+
+def test_idle_entries_are_swept():
+    clock = FakeClock()
+    limiter = GCRALimiter(sweep_interval=30, clock=clock)
+    limiter.check("idle", 60)
+    assert len(limiter) == 1
+
+    clock.now += 31
+    limiter.check("active", 60)
+
+    assert len(limiter) == 1
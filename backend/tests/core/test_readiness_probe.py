@@ -0,0 +1,51 @@
+import pytest
+from app.core import health
+
+
+def make_stats(checked_out=0, waiting=0, size=20, max_overflow=10):
+    return {
+        "size": size, "checked_out": checked_out, "checked_in": size - checked_out,
+        "overflow": 0, "max_overflow": max_overflow, "waiting": waiting,
+    }
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(health.settings, "HEALTH_MAX_DB_LATENCY_MS", 500.0)
+    monkeypatch.setattr(health.settings, "HEALTH_MAX_LOOP_LAG_MS", 200.0)
+    monkeypatch.setattr(health.settings, "HEALTH_MAX_POOL_SATURATION", 1.0)
+
+
+def test_ready_within_limits():
+    readiness = health.evaluate(3.0, 10.0, make_stats(checked_out=15), 0.0)
+
+    assert readiness.ready and readiness.reasons == []
+    assert readiness.pool["saturation"] == 0.5
+
+
+def test_saturated_pool_is_not_ready():
+    readiness = health.evaluate(3.0, 10.0, make_stats(checked_out=30, waiting=12), 0.0)
+
+    assert not readiness.ready
+    assert readiness.reasons == ["connection pool saturated (30 checked out, 12 waiting)"]
+
+
+def test_slow_database_and_loop_lag_are_not_ready():
+    assert health.evaluate(None, 0.0, make_stats(), 0.0).reasons == ["database unreachable"]
+    assert health.evaluate(900.0, 350.0, make_stats(), 0.0).reasons == [
+        "database latency 900ms", "event loop lag 350ms",
+    ]
+
+
+@pytest.mark.anyio
+async def test_stalled_background_probe_is_not_ready(monkeypatch):
+    monkeypatch.setattr(health.settings, "HEALTH_PROBE_INTERVAL_SECONDS", 1.0)
+    monkeypatch.setattr(health, "_latest", health.evaluate(3.0, 0.0, make_stats(), 0.0))
+    monkeypatch.setattr(health, "_probe_task", object())
+    monkeypatch.setattr(health.time, "monotonic", lambda: 2.0)
+
+    assert (await health.current()).ready  # cached, not re-probed
+
+    monkeypatch.setattr(health.time, "monotonic", lambda: 10.0)
+    readiness = await health.current()
+    assert not readiness.ready and readiness.reasons == ["health probe stalled"]
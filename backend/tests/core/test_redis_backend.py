@@ -0,0 +1,178 @@
+"""
+RedisMeteringBackend against an in-process Redis stand-in (fakeredis runs the
+Lua scripts with lupa). Set REDIS_TEST_URL to run against a real redis-server.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from app.core import metering
+from app.core.backends.memory import MemoryMeteringBackend
+from app.core.backends.redis_store import RedisMeteringBackend
+
+# Counters expire with their window: use the current one
+PERIOD = metering.get_period_start()
+
+
+class DurableStandIn(MemoryMeteringBackend):
+    """usage_records stand-in: store_counts only raises counters, like the PostgreSQL upsert."""
+
+    async def store_counts(self, counts, released=()):
+        for org_id, period_start, units in released:
+            await self.release(org_id, period_start, units)
+        for org_id, period_start, count in counts:
+            current = await self.peek(org_id, period_start)
+            if count > current:
+                await self.reserve(org_id, period_start, count - current, count)
+
+
+@pytest.fixture
+async def client():
+    if os.environ.get("REDIS_TEST_URL"):
+        from redis import asyncio as aioredis
+        client = aioredis.Redis.from_url(os.environ["REDIS_TEST_URL"])
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        client = fakeredis.FakeAsyncRedis()
+    await client.flushdb()
+    yield client
+    await client.flushdb()
+
+
+@pytest.fixture
+def durable():
+    return DurableStandIn(shards=1)
+
+
+@pytest.fixture
+async def backend(client, durable):
+    backend = RedisMeteringBackend(client, durable, prefix="test", sync_interval=3600)
+    yield backend
+    await backend.close()
+
+
+@pytest.mark.anyio
+async def test_reserve_is_atomic_check_and_increment(backend):
+    assert await backend.reserve(1, PERIOD, 8, 10) == (8, 8)
+    assert await backend.reserve(1, PERIOD, 3, 10) == (0, None)
+    assert await backend.reserve(1, PERIOD, 3, 10, partial=True) == (2, 10)
+    await backend.release(1, PERIOD, 4)
+    assert await backend.peek(1, PERIOD) == 6
+
+
+@pytest.mark.anyio
+async def test_counter_expires_after_its_window(backend, client):
+    await backend.reserve(1, PERIOD, 1, 10)
+    ttl = await client.ttl(f"test:1:{int(PERIOD.timestamp())}")
+    expected = metering.get_next_window(PERIOD).timestamp() + backend.grace_seconds - time.time()
+    assert expected - 5 <= ttl <= expected + 1
+
+
+@pytest.mark.anyio
+async def test_closed_windows_go_straight_to_the_durable_store(backend, client, durable):
+    old_period = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    assert await backend.reserve(1, old_period, 3, 10) == (3, 3)
+    assert await durable.peek(1, old_period) == 3
+    assert await client.dbsize() == 0
+
+
+@pytest.mark.anyio
+async def test_sync_writes_changed_counters_to_the_durable_store(backend, durable):
+    await backend.reserve(1, PERIOD, 4, 10)
+    await backend.reserve(2, PERIOD, 7, 10)
+
+    assert await backend.sync() == 2
+    assert [await durable.peek(org_id, PERIOD) for org_id in (1, 2)] == [4, 7]
+    assert await backend.sync() == 0  # nothing changed since
+
+
+@pytest.mark.anyio
+async def test_a_stale_sync_never_lowers_the_durable_count(backend, durable):
+    """A worker whose sync outlived its lock writes an older value after a newer one."""
+    await durable.store_counts([(1, PERIOD, 105)])
+    await durable.store_counts([(1, PERIOD, 100)])
+    assert await durable.peek(1, PERIOD) == 105
+
+
+@pytest.mark.anyio
+async def test_one_worker_syncs_at_a_time(backend, client, durable):
+    await backend.reserve(1, PERIOD, 4, 10)
+    await client.set(backend.lock_key, "another-worker")
+
+    assert await backend.sync() == 0
+    assert await durable.peek(1, PERIOD) == 0
+
+    await client.delete(backend.lock_key)
+    assert await backend.sync() == 1
+    assert await durable.peek(1, PERIOD) == 4
+    assert not await client.exists(backend.lock_key)
+
+
+@pytest.mark.anyio
+async def test_release_lowers_the_durable_count(backend, durable):
+    await backend.reserve(1, PERIOD, 8, 10)
+    await backend.sync()
+
+    await backend.release(1, PERIOD, 3)
+    await backend.sync()
+    assert await backend.peek(1, PERIOD) == 5
+    assert await durable.peek(1, PERIOD) == 5
+
+
+@pytest.mark.anyio
+async def test_release_during_a_sync_lands_exactly_once(backend, durable, monkeypatch):
+    """A release between a sync's read of the counters and its write must still reach usage_records."""
+    await backend.reserve(1, PERIOD, 8, 10)
+    await backend.sync()
+    await backend.reserve(1, PERIOD, 2, 10)
+
+    read, resume = asyncio.Event(), asyncio.Event()
+    store_counts = durable.store_counts
+
+    async def paused_store_counts(counts, released=()):
+        read.set()
+        await resume.wait()
+        await store_counts(counts, released)
+
+    monkeypatch.setattr(durable, "store_counts", paused_store_counts)
+    sync = asyncio.create_task(backend.sync())
+    await read.wait()
+    await backend.release(1, PERIOD, 3)
+    resume.set()
+    await sync  # wrote the 10 it read, then the release it marked dirty
+    assert await backend.peek(1, PERIOD) == 7
+    assert await durable.peek(1, PERIOD) == 7
+
+
+@pytest.mark.anyio
+async def test_a_failed_sync_keeps_its_released_units(backend, durable, monkeypatch):
+    await backend.reserve(1, PERIOD, 8, 10)
+    await backend.sync()
+    await backend.release(1, PERIOD, 3)
+
+    store_counts = durable.store_counts
+
+    async def failing_store_counts(counts, released=()):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(durable, "store_counts", failing_store_counts)
+    with pytest.raises(ConnectionError):
+        await backend.sync()
+
+    monkeypatch.setattr(durable, "store_counts", store_counts)
+    assert await backend.sync() == 1
+    assert await durable.peek(1, PERIOD) == 5
+
+
+@pytest.mark.anyio
+async def test_store_restart_reconciles_from_the_durable_counts(backend, client, durable):
+    """After the store loses its data, counting resumes from the last synced value, not from zero."""
+    await backend.reserve(1, PERIOD, 9, 10)
+    await backend.sync()
+    await client.flushdb()
+
+    assert await backend.reserve(1, PERIOD, 2, 10) == (0, None)
+    assert await backend.reserve(1, PERIOD, 1, 10) == (1, 10)
@@ -0,0 +1,18 @@
+from datetime import datetime, timezone
+from app.core import rollover
+
+
+def test_rows_are_prepared_lead_seconds_before_a_monthly_boundary(monkeypatch):
+    monkeypatch.setattr(rollover.settings, "DEMO_MODE", False)
+    monkeypatch.setattr(rollover.settings, "PERIOD_ROLLOVER_LEAD_SECONDS", 600)
+
+    assert rollover.seconds_until_prepare(datetime(2026, 1, 31, 23, 0, tzinfo=timezone.utc)) == 3000
+    assert rollover.seconds_until_prepare(datetime(2026, 1, 31, 23, 55, tzinfo=timezone.utc)) == 0
+
+
+def test_lead_is_capped_at_half_a_demo_window(monkeypatch):
+    monkeypatch.setattr(rollover.settings, "DEMO_MODE", True)
+    monkeypatch.setattr(rollover.settings, "PERIOD_ROLLOVER_LEAD_SECONDS", 600)
+
+    # 12:01 in the 12:00-12:05 window: prepare at 12:02:30
+    assert rollover.seconds_until_prepare(datetime(2026, 1, 1, 12, 1, tzinfo=timezone.utc)) == 90
@@ -0,0 +1,39 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.core import security
+
+
+@pytest.mark.anyio
+async def test_async_hash_and_verify_roundtrip():
+    hashed = await security.get_password_hash_async("s3cret")
+
+    assert await security.verify_password_async("s3cret", hashed)
+    assert not await security.verify_password_async("wrong", hashed)
+
+
+@pytest.mark.anyio
+async def test_saturated_hasher_fails_fast_with_503(monkeypatch):
+    monkeypatch.setattr(security.settings, "PASSWORD_HASH_MAX_PENDING", 2)
+    hashed = security.get_password_hash("s3cret")
+
+    results = await asyncio.gather(
+        *(security.verify_password_async("s3cret", hashed) for _ in range(5)),
+        return_exceptions=True,
+    )
+
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert results[:2] == [True, True]
+    assert len(rejected) == 3
+    assert all(r.status_code == 503 and r.headers["Retry-After"] for r in rejected)
+    # Capacity is released once the in-flight hashes finish
+    assert await security.verify_password_async("s3cret", hashed)
+
+
+def test_rehash_needed_when_cost_changes():
+    from argon2 import PasswordHasher
+
+    old_hash = PasswordHasher(time_cost=1, memory_cost=8192, parallelism=1).hash("s3cret")
+
+    assert security.password_needs_rehash(old_hash)
+    assert not security.password_needs_rehash(security.get_password_hash("s3cret"))
@@ -0,0 +1,223 @@
+"""
+In-process metering microbenchmark: drives metering.track_and_enforce_usage
+directly with asyncio tasks against PostgreSQL, without uvicorn, httpx or
+FastAPI dependency resolution in the way.
+
+    PYTHONPATH=backend python scripts/bench_metering.py --tenants 1,10,100 --concurrency 10,50,200
+    PYTHONPATH=backend python scripts/bench_metering.py --mode leased --quota 500 --output metering.json
+
+For every (tenants, concurrency) combination it reports:
+  - ops/sec and end-to-end latency percentiles of track_and_enforce_usage
+  - per-statement latency (INSERT / UPDATE / SELECT / WITH ... as sent to the driver)
+  - lock-wait time, sampled from pg_stat_activity (backends waiting on a Lock)
+and checks that the metering backend's final counters equal the admitted requests.
+Each combination runs on freshly provisioned orgs so runs never share counters.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+from fastapi import HTTPException
+from sqlalchemy import event, text
+
+from app.core import metering, prepared
+from app.core.backends import get_backend
+from app.core.config import settings
+from app.core.db import AsyncSessionLocal, engine
+from app.models import all_models
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * pct / 100.0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def latency_summary(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50": round(percentile(ordered, 50), 3),
+        "p99": round(percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3) if ordered else 0.0,
+    }
+
+
+SAMPLER_MARKER = "/* bench_metering lock sampler */"
+
+
+class StatementTimer:
+    """
+    Times every statement sent to the database, grouped by its leading keyword:
+    through the engine's cursor events, and the prepared hot-path statements
+    (PREPARED_STATEMENTS_ENABLED), which bypass them, through prepared.add_observer.
+    """
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        event.listen(engine.sync_engine, "before_cursor_execute", self._before)
+        event.listen(engine.sync_engine, "after_cursor_execute", self._after)
+        prepared.add_observer(self._prepared)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("bench_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["bench_started"].pop()) * 1000
+        if SAMPLER_MARKER in statement:
+            return
+        self._add(statement, elapsed_ms)
+
+    def _prepared(self, statement, seconds):
+        self._add(statement, seconds * 1000)
+
+    def _add(self, statement, elapsed_ms):
+        self.samples[statement.lstrip().split(None, 1)[0].upper()].append(elapsed_ms)
+
+    def reset(self):
+        self.samples.clear()
+
+    def summary(self) -> dict:
+        return {kind: latency_summary(samples) for kind, samples in sorted(self.samples.items())}
+
+
+async def sample_lock_waits(stop: asyncio.Event, interval: float) -> float:
+    """Approximate total seconds spent waiting on locks: waiting backends x sampling interval."""
+    waited = 0.0
+    async with AsyncSessionLocal() as db:
+        while not stop.is_set():
+            result = await db.execute(text(
+                f"{SAMPLER_MARKER} SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND wait_event_type = 'Lock'"
+            ))
+            waited += result.scalar_one() * interval
+            await db.rollback()
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    return waited
+
+
+async def provision(tenants: int, quota: int) -> list[int]:
+    suffix = uuid.uuid4().hex[:10]
+    async with AsyncSessionLocal() as db:
+        plan = all_models.SubscriptionPlan(name=f"bench-{suffix}", monthly_quota=quota)
+        orgs = [all_models.Organization(name=f"bench-{suffix}-{i}") for i in range(tenants)]
+        db.add(plan)
+        db.add_all(orgs)
+        await db.flush()
+        db.add_all(
+            all_models.Subscription(organization_id=org.id, plan_id=plan.id, is_active=True) for org in orgs
+        )
+        await db.commit()
+        return [org.id for org in orgs]
+
+
+async def final_counts(org_ids: list[int], periods: set) -> dict[int, int]:
+    # Through the configured backend: the counters it enforces quotas with,
+    # which usage_records only trails for the memory/redis/shared_memory stores
+    backend = get_backend()
+    return {org_id: sum([await backend.peek(org_id, period) for period in periods]) for org_id in org_ids}
+
+
+async def run_combination(tenants: int, concurrency: int, requests: int, quota: int, timer: StatementTimer) -> dict:
+    org_ids = await provision(tenants, quota)
+    admitted: Counter[int] = Counter()
+    outcomes: Counter[str] = Counter()
+    latencies: list[float] = []
+    queue = iter(range(requests))
+
+    async def worker(worker_id: int):
+        for n in queue:
+            # Round-robin over the tenants: with 1 tenant every task contends on one row
+            org_id = org_ids[(n + worker_id) % tenants]
+            started = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                try:
+                    await metering.track_and_enforce_usage(db, org_id)
+                    admitted[org_id] += 1
+                    outcomes["admitted"] += 1
+                except HTTPException as exc:
+                    outcomes[str(exc.status_code)] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    timer.reset()
+    # A DEMO_MODE window may roll over mid-run: count every period it touched
+    periods = {metering.get_period_start()}
+    stop = asyncio.Event()
+    lock_sampler = asyncio.create_task(sample_lock_waits(stop, 0.01))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    lock_wait_s = await lock_sampler
+
+    await metering.release_all_leases()
+    periods.add(metering.get_period_start())
+    counts = await final_counts(org_ids, periods)
+    mismatches = {org_id: (counts.get(org_id, 0), admitted[org_id]) for org_id in org_ids
+                  if counts.get(org_id, 0) != admitted[org_id]}
+    overcount = [org_id for org_id in org_ids if counts.get(org_id, 0) > quota]
+
+    return {
+        "tenants": tenants,
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "ops_per_sec": round(requests / elapsed, 1),
+        "outcomes": dict(outcomes),
+        "latency_ms": latency_summary(latencies),
+        "statements_ms": timer.summary(),
+        "lock_wait_s": round(lock_wait_s, 3),
+        "counts_match": not mismatches,
+        "count_mismatches": {str(k): v for k, v in mismatches.items()},
+        "over_quota_orgs": overcount,
+    }
+
+
+async def main(args) -> int:
+    settings.METERING_MODE = args.mode
+    engine.echo = False  # per-statement logging would dominate the measurement
+    timer = StatementTimer()
+    results = []
+    for tenants in args.tenants:
+        for concurrency in args.concurrency:
+            result = await run_combination(tenants, concurrency, args.requests, args.quota, timer)
+            results.append(result)
+            print(
+                f"tenants={tenants:<5} concurrency={concurrency:<5} {result['ops_per_sec']:>9} ops/s  "
+                f"p50={result['latency_ms']['p50']}ms p99={result['latency_ms']['p99']}ms  "
+                f"lock_wait={result['lock_wait_s']}s  counts_match={result['counts_match']}"
+            )
+            for kind, stats in result["statements_ms"].items():
+                print(f"    {kind:<8} n={stats['count']:<7} p50={stats['p50']}ms p99={stats['p99']}ms")
+    await engine.dispose()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"mode": args.mode, "quota": args.quota, "prepared_statements": prepared.enabled(), "results": results}, f, indent=2)
+
+    ok = all(r["counts_match"] and not r["over_quota_orgs"] for r in results)
+    if not ok:
+        print("FAILED: backend counters do not match admitted requests", file=sys.stderr)
+    return 0 if ok else 1
+
+
+def int_list(value: str) -> list[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", default=settings.METERING_MODE, choices=["direct", "leased", "coalesced"])
+    parser.add_argument("--tenants", type=int_list, default=[1, 10, 100], help="comma-separated tenant counts")
+    parser.add_argument("--concurrency", type=int_list, default=[10, 50], help="comma-separated task counts")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per combination")
+    parser.add_argument("--quota", type=int, default=1_000_000, help="monthly_quota of the benchmark plan")
+    parser.add_argument("--output", help="write the JSON results here")
+    sys.exit(asyncio.run(main(parser.parse_args())))
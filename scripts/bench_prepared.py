@@ -0,0 +1,149 @@
+"""
+Per-request Python CPU of the hot-path queries: SQLAlchemy Core vs prepared
+asyncpg statements (app/core/prepared.py), against PostgreSQL.
+
+    PYTHONPATH=backend python scripts/bench_prepared.py
+    PYTHONPATH=backend python scripts/bench_prepared.py --requests 20000 --output prepared.json
+
+One "request" is what an authenticated, metered call sends to the database
+with every cache missed: the user lookup, the plan lookup and the counter
+reservation, each on its own session like the request's dependencies. They
+run one after another on a single task, so process CPU time per request is
+this process' own work (the server is another process) and wall latency is
+not queue time. Both paths run in alternating rounds on the same org, and
+the counter is checked against the number of reservations at the end.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+from sqlalchemy import select
+
+from app.core import metering, prepared
+from app.core.backends.postgres import PostgresMeteringBackend
+from app.core.config import settings
+from app.core.db import AsyncSessionLocal, engine
+from app.models import all_models
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * pct / 100.0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def provision() -> tuple[int, int]:
+    suffix = uuid.uuid4().hex[:10]
+    async with AsyncSessionLocal() as db:
+        plan = all_models.SubscriptionPlan(name=f"bench-prepared-{suffix}", monthly_quota=10**9)
+        org = all_models.Organization(name=f"bench-prepared-{suffix}")
+        db.add_all([plan, org])
+        await db.flush()
+        user = all_models.User(
+            email=f"bench-prepared-{suffix}@example.com", hashed_password="!", organization_id=org.id, is_active=True
+        )
+        db.add_all([all_models.Subscription(organization_id=org.id, plan_id=plan.id, is_active=True), user])
+        await db.commit()
+        return org.id, user.id
+
+
+async def lookup_user(user_id: int):
+    async with AsyncSessionLocal() as db:
+        if prepared.enabled():
+            return await prepared.fetchrow(db, prepared.USER_PRINCIPAL, user_id)
+        result = await db.execute(
+            select(
+                all_models.User.id,
+                all_models.User.organization_id,
+                all_models.User.role,
+                all_models.User.is_active,
+            ).where(all_models.User.id == user_id)
+        )
+        return result.first()
+
+
+async def one_request(backend: PostgresMeteringBackend, org_id: int, user_id: int) -> None:
+    await lookup_user(user_id)
+    metering.plan_cache.clear()
+    async with AsyncSessionLocal() as db:
+        limits = await metering.get_plan_limits(db, org_id)
+    reservation = await backend.reserve(org_id, metering.get_period_start(), 1, limits.monthly_quota)
+    assert reservation.granted == 1
+
+
+async def run_round(backend, org_id: int, user_id: int, requests: int, use_prepared: bool) -> tuple[list[float], list[float]]:
+    settings.PREPARED_STATEMENTS_ENABLED = use_prepared
+    cpu_us, wall_ms = [], []
+    for _ in range(requests):
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        await one_request(backend, org_id, user_id)
+        cpu_us.append((time.process_time() - cpu_started) * 1e6)
+        wall_ms.append((time.perf_counter() - wall_started) * 1000)
+    return cpu_us, wall_ms
+
+
+def summary(cpu_us: list[float], wall_ms: list[float]) -> dict:
+    cpu, wall = sorted(cpu_us), sorted(wall_ms)
+    return {
+        "requests": len(cpu),
+        "cpu_us_mean": round(sum(cpu) / len(cpu), 1),
+        "cpu_us_p50": round(percentile(cpu, 50), 1),
+        "wall_ms_p50": round(percentile(wall, 50), 3),
+        "wall_ms_p99": round(percentile(wall, 99), 3),
+    }
+
+
+async def main(args) -> int:
+    if settings.DB_PGBOUNCER_MODE:
+        print("DB_PGBOUNCER_MODE is set: prepared statements are disabled", file=sys.stderr)
+        return 1
+    engine.echo = False
+    org_id, user_id = await provision()
+    backend = PostgresMeteringBackend()
+
+    # Warm-up: pool connections, compiled-statement caches, the usage row
+    for use_prepared in (False, True):
+        await run_round(backend, org_id, user_id, args.warmup, use_prepared)
+
+    samples = {"core": ([], []), "prepared": ([], [])}
+    per_round = max(args.requests // args.rounds, 1)
+    for _ in range(args.rounds):
+        for name, use_prepared in (("core", False), ("prepared", True)):
+            cpu_us, wall_ms = await run_round(backend, org_id, user_id, per_round, use_prepared)
+            samples[name][0].extend(cpu_us)
+            samples[name][1].extend(wall_ms)
+
+    results = {name: summary(*values) for name, values in samples.items()}
+    saved = results["core"]["cpu_us_mean"] - results["prepared"]["cpu_us_mean"]
+    for name, result in results.items():
+        print(
+            f"{name:<9} cpu/request mean={result['cpu_us_mean']}us p50={result['cpu_us_p50']}us  "
+            f"wall p50={result['wall_ms_p50']}ms p99={result['wall_ms_p99']}ms"
+        )
+    print(f"saved     {saved:.1f}us CPU per request ({saved / results['core']['cpu_us_mean']:.0%})")
+
+    count = await backend.peek(org_id, metering.get_period_start())
+    expected = 2 * args.warmup + 2 * per_round * args.rounds
+    await engine.dispose()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "cpu_us_saved": round(saved, 1)}, f, indent=2)
+
+    if count != expected:
+        print(f"FAILED: counter is {count}, expected {expected}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per path")
+    parser.add_argument("--rounds", type=int, default=10, help="alternating rounds the requests are split into")
+    parser.add_argument("--warmup", type=int, default=200, help="untimed requests per path first")
+    parser.add_argument("--output", help="write the JSON results here")
+    sys.exit(asyncio.run(main(parser.parse_args())))
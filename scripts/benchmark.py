@@ -1,83 +1,344 @@
+"""
+HTTP load-testing suite for the metering API.
+
+    python scripts/benchmark.py run --scenario hot-tenant --tenants 20 --duration 30 --output run.json
+    python scripts/benchmark.py run --scenario mixed --open-loop --rate 400 --output run.json
+    python scripts/benchmark.py compare baseline.json run.json --tolerance 0.10
+
+Scenarios (all provision their own tenants through the public signup endpoint,
+because the platform admin bypasses metering):
+
+    steady       traffic spread evenly over all tenants
+    hot-tenant   --hot-share of the traffic goes to tenant 0, the rest is spread evenly
+    exhaustion   every request targets one tenant until it is far past its quota (429 storm)
+    login-storm  only POST /login/access-token (Argon2 + token issuance)
+    mixed        metered reads with hot-tenant skew, plus /users/me and logins
+
+Closed loop (default): --concurrency workers each send the next request as soon
+as the previous one returns. Open loop (--open-loop): requests are started at a
+fixed --rate regardless of how fast the server answers, and latency is measured
+from the scheduled start so that queueing is not hidden (no coordinated omission).
+
+Start the API with RATE_LIMIT_ENABLED=false to measure the monthly-quota path
+rather than the per-minute burst limiter.
+"""
+import argparse
 import asyncio
+import json
+import math
+import random
+import sys
 import time
-import httpx
-import statistics
+import uuid
 from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
 
-# --- Configuration ---
-BASE_URL = "http://localhost:8000"
-CONCURRENT_REQUESTS = 50   # True simultaneous requests in flight at once
-TOTAL_REQUESTS = 500        # Total to fire
-EMAIL = "admin@example.com"
-PASSWORD = "admin"
+API = "/api/v1"
+PASSWORD = "benchmark-password"
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
 
-async def get_token(client: httpx.AsyncClient) -> str | None:
-    try:
-        response = await client.post(
-            f"{BASE_URL}/api/v1/login/access-token",
-            data={"username": EMAIL, "password": PASSWORD},
-            timeout=10,
+
+# --- Latency histogram -------------------------------------------------------
+
+class LatencyHistogram:
+    """
+    Log-bucketed histogram: every bucket spans 1% of its value, so any
+    percentile is accurate to ~1% whatever the number of samples, in constant memory.
+    """
+
+    GROWTH = 1.01
+
+    def __init__(self):
+        self.counts: Counter[int] = Counter()
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms: float) -> None:
+        latency_us = max(latency_ms * 1000.0, 1.0)
+        self.counts[math.ceil(math.log(latency_us, self.GROWTH))] += 1
+        self.total += 1
+        self.sum_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, pct: float) -> float:
+        if not self.total:
+            return 0.0
+        rank = math.ceil(self.total * pct / 100.0)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.GROWTH ** bucket / 1000.0, self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        result = {f"p{pct:g}".replace(".", "_"): round(self.percentile(pct), 2) for pct in PERCENTILES}
+        result["mean"] = round(self.sum_ms / self.total, 2) if self.total else 0.0
+        result["max"] = round(self.max_ms, 2)
+        return result
+
+
+class Stats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.by_operation: dict[str, LatencyHistogram] = {}
+        self.statuses: Counter[str] = Counter()
+
+    def record(self, operation: str, status: int, latency_ms: float) -> None:
+        self.latency.record(latency_ms)
+        self.by_operation.setdefault(operation, LatencyHistogram()).record(latency_ms)
+        self.statuses[str(status)] += 1
+
+
+# --- Tenants -----------------------------------------------------------------
+
+class Tenant:
+    def __init__(self, email: str, token: str):
+        self.email = email
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+
+async def _retry_on_overload(send):
+    """Signup and login answer 503 while the password hasher is saturated: back off and retry."""
+    for attempt in range(20):
+        response = await send()
+        if response.status_code != 503:
+            return response
+        await asyncio.sleep(min(0.05 * 2 ** attempt, 2.0))
+    return response
+
+
+async def provision_tenant(client: httpx.AsyncClient, run_id: str, index: int) -> Tenant:
+    email = f"bench-{run_id}-{index}@example.com"
+    response = await _retry_on_overload(lambda: client.post(
+        f"{API}/users/",
+        json={"email": email, "password": PASSWORD, "organization_name": f"Benchmark {run_id} #{index}"},
+    ))
+    response.raise_for_status()
+    response = await _retry_on_overload(lambda: client.post(
+        f"{API}/login/access-token", data={"username": email, "password": PASSWORD}
+    ))
+    response.raise_for_status()
+    return Tenant(email, response.json()["access_token"])
+
+
+async def provision_tenants(client: httpx.AsyncClient, count: int) -> list[Tenant]:
+    run_id = uuid.uuid4().hex[:8]
+    sem = asyncio.Semaphore(8)  # signup hashes passwords; don't turn provisioning into a login storm
+
+    async def one(index: int) -> Tenant:
+        async with sem:
+            return await provision_tenant(client, run_id, index)
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+# --- Scenarios ---------------------------------------------------------------
+
+def pick_tenant(tenants: list[Tenant], hot_share: float) -> Tenant:
+    if len(tenants) > 1 and random.random() >= hot_share:
+        return random.choice(tenants[1:])
+    return tenants[0]
+
+
+def build_operation(scenario: str, tenants: list[Tenant], hot_share: float):
+    """Return a zero-argument factory producing (operation name, request coroutine factory)."""
+
+    def widgets(tenant: Tenant):
+        return "widgets", lambda client: client.get(f"{API}/widgets/", headers=tenant.headers)
+
+    def me(tenant: Tenant):
+        return "users_me", lambda client: client.get(f"{API}/users/me", headers=tenant.headers)
+
+    def login(tenant: Tenant):
+        return "login", lambda client: client.post(
+            f"{API}/login/access-token", data={"username": tenant.email, "password": PASSWORD}
         )
-        response.raise_for_status()
-        return response.json()["access_token"]
-    except Exception as e:
-        print(f"[ERROR] Login failed: {e}")
-        return None
-
-
-async def single_request(sem: asyncio.Semaphore, client: httpx.AsyncClient, headers: dict) -> tuple[float, int]:
-    """Fire one request, gated by semaphore for concurrency control."""
-    async with sem:
-        start = time.perf_counter()
-        try:
-            resp = await client.get(f"{BASE_URL}/api/v1/widgets/", headers=headers, timeout=10)
-            status = resp.status_code
-        except Exception:
-            status = 0
-        elapsed_ms = (time.perf_counter() - start) * 1000
-        return elapsed_ms, status
-
-
-async def main():
-    print(f"--- Starting Benchmark ---")
-    print(f"Target:           {BASE_URL}")
-    print(f"Total Requests:   {TOTAL_REQUESTS}")
-    print(f"Concurrency:      {CONCURRENT_REQUESTS} simultaneous")
-    print()
-
-    async with httpx.AsyncClient() as client:
-        token = await get_token(client)
-        if not token:
-            print("Aborting: could not authenticate.")
-            return
-
-        headers = {"Authorization": f"Bearer {token}"}
-        sem = asyncio.Semaphore(CONCURRENT_REQUESTS)
-
-        # Fire all requests concurrently, gated by semaphore
-        start_total = time.perf_counter()
-        tasks = [single_request(sem, client, headers) for _ in range(TOTAL_REQUESTS)]
-        results = await asyncio.gather(*tasks)
-        total_time = time.perf_counter() - start_total
-
-    latencies = [r[0] for r in results]
-    statuses  = [r[1] for r in results]
-
-    print(f"--- Results ---")
-    print(f"Total Time:       {total_time:.2f}s")
-    print(f"Throughput:       {TOTAL_REQUESTS / total_time:.1f} req/s")
-    print()
-    print(f"Latency (ms):")
-    print(f"  Min:            {min(latencies):.1f}")
-    print(f"  Mean:           {statistics.mean(latencies):.1f}")
-    p95_idx = int(len(latencies) * 0.95)
-    print(f"  P95:            {sorted(latencies)[p95_idx]:.1f}")
-    print(f"  Max:            {max(latencies):.1f}")
-    print()
-    print(f"Status Codes:")
-    for code, count in sorted(Counter(statuses).items()):
-        pct = count / TOTAL_REQUESTS * 100
-        print(f"  {code}: {count} ({pct:.1f}%)")
+
+    if scenario == "steady":
+        return lambda: widgets(random.choice(tenants))
+    if scenario == "hot-tenant":
+        return lambda: widgets(pick_tenant(tenants, hot_share))
+    if scenario == "exhaustion":
+        return lambda: widgets(tenants[0])
+    if scenario == "login-storm":
+        return lambda: login(random.choice(tenants))
+    if scenario == "mixed":
+        def mixed():
+            roll = random.random()
+            if roll < 0.90:
+                return widgets(pick_tenant(tenants, hot_share))
+            if roll < 0.95:
+                return me(random.choice(tenants))
+            return login(random.choice(tenants))
+        return mixed
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def timed_call(client: httpx.AsyncClient, stats: Stats, next_operation, started: float | None = None) -> None:
+    operation, send = next_operation()
+    started = time.perf_counter() if started is None else started
+    try:
+        status = (await send(client)).status_code
+    except httpx.HTTPError:
+        status = 0
+    stats.record(operation, status, (time.perf_counter() - started) * 1000)
+
+
+async def run_closed_loop(client, stats, next_operation, concurrency: int, deadline: float, max_requests: int | None):
+    issued = 0
+
+    async def worker():
+        nonlocal issued
+        while time.perf_counter() < deadline and (max_requests is None or issued < max_requests):
+            issued += 1
+            await timed_call(client, stats, next_operation)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def run_open_loop(client, stats, next_operation, rate: float, deadline: float, max_requests: int | None):
+    interval = 1.0 / rate
+    in_flight: set[asyncio.Task] = set()
+    scheduled = time.perf_counter()
+    issued = 0
+    while scheduled < deadline and (max_requests is None or issued < max_requests):
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(timed_call(client, stats, next_operation, started=scheduled))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        issued += 1
+        scheduled += interval
+    if in_flight:
+        await asyncio.gather(*in_flight)
+
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        tenant_count = 1 if args.scenario == "exhaustion" else args.tenants
+        print(f"Provisioning {tenant_count} tenant(s)...", file=sys.stderr)
+        tenants = await provision_tenants(client, tenant_count)
+        next_operation = build_operation(args.scenario, tenants, args.hot_share)
+
+        print(f"Running '{args.scenario}' for {args.duration}s...", file=sys.stderr)
+        stats = Stats()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        if args.open_loop:
+            await run_open_loop(client, stats, next_operation, args.rate, deadline, args.requests)
+        else:
+            await run_closed_loop(client, stats, next_operation, args.concurrency, deadline, args.requests)
+        elapsed = time.perf_counter() - started
+
+    total = stats.latency.total
+    errors = sum(count for status, count in stats.statuses.items() if status == "0" or status.startswith("5"))
+    return {
+        "scenario": args.scenario,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "base_url": args.base_url,
+            "loop": "open" if args.open_loop else "closed",
+            "rate": args.rate if args.open_loop else None,
+            "concurrency": None if args.open_loop else args.concurrency,
+            "tenants": tenant_count,
+            "hot_share": args.hot_share,
+            "duration_s": args.duration,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(errors / total, 5) if total else 0.0,
+        "status_codes": dict(sorted(stats.statuses.items())),
+        "latency_ms": stats.latency.summary(),
+        "operations": {name: {"requests": h.total, "latency_ms": h.summary()} for name, h in stats.by_operation.items()},
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"--- {report['scenario']} ({report['config']['loop']} loop) ---")
+    print(f"Requests:    {report['requests']} in {report['elapsed_s']}s  ->  {report['throughput_rps']} req/s")
+    print(f"Error rate:  {report['error_rate'] * 100:.2f}%")
+    latency = report["latency_ms"]
+    print(
+        f"Latency ms:  p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  "
+        f"p99.9 {latency['p99_9']}  max {latency['max']}"
+    )
+    for name, op in report["operations"].items():
+        print(f"  {name:<10} {op['requests']:>8}  p50 {op['latency_ms']['p50']}  p99 {op['latency_ms']['p99']}")
+    print("Status codes:", ", ".join(f"{code}: {count}" for code, count in report["status_codes"].items()))
+
+
+# --- Compare -----------------------------------------------------------------
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    """Regressions of `current` against `baseline`; empty when within tolerance."""
+    regressions = []
+    for key in ("p50", "p99", "p99_9"):
+        before, after = baseline["latency_ms"][key], current["latency_ms"][key]
+        if before and after > before * (1 + tolerance):
+            regressions.append(f"latency {key}: {before} -> {after} ms (+{(after / before - 1) * 100:.1f}%)")
+    before, after = baseline["throughput_rps"], current["throughput_rps"]
+    if before and after < before * (1 - tolerance):
+        regressions.append(f"throughput: {before} -> {after} req/s ({(after / before - 1) * 100:.1f}%)")
+    before, after = baseline["error_rate"], current["error_rate"]
+    if after > before + 0.001:
+        regressions.append(f"error rate: {before * 100:.2f}% -> {after * 100:.2f}%")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run a load scenario")
+    run_parser.add_argument("--base-url", default="http://localhost:8000")
+    run_parser.add_argument("--scenario", default="steady",
+                            choices=["steady", "hot-tenant", "exhaustion", "login-storm", "mixed"])
+    run_parser.add_argument("--tenants", type=int, default=10, help="orgs/users to provision")
+    run_parser.add_argument("--hot-share", type=float, default=0.8, help="share of traffic sent to the hot tenant")
+    run_parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    run_parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    run_parser.add_argument("--concurrency", type=int, default=50, help="closed-loop workers")
+    run_parser.add_argument("--open-loop", action="store_true", help="fixed arrival rate instead of closed loop")
+    run_parser.add_argument("--rate", type=float, default=200.0, help="open-loop arrivals per second")
+    run_parser.add_argument("--connections", type=int, default=100, help="HTTP connection pool size")
+    run_parser.add_argument("--timeout", type=float, default=10.0)
+    run_parser.add_argument("--output", help="write the JSON report here")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a stored baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative slowdown")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if baseline["scenario"] != current["scenario"] or baseline["config"]["loop"] != current["config"]["loop"]:
+            print("WARNING: comparing runs of different scenarios or loop modes", file=sys.stderr)
+        regressions = compare(baseline, current, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if not regressions:
+            print(f"OK: within {args.tolerance * 100:.0f}% of baseline")
+        return 1 if regressions else 0
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(main())
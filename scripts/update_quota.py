@@ -2,6 +2,7 @@ import asyncio
 from sqlalchemy import select, update
 from app.core.db import AsyncSessionLocal
 from app.models import all_models
+from app.core import invalidation
 
 async def lower_limit():
     async with AsyncSessionLocal() as db:
@@ -15,6 +16,8 @@ async def lower_limit():
             
             # Update quota to 5
             plan.monthly_quota = 5
+            # Running API workers evict cached limits for this plan on commit
+            await invalidation.publish(db, "plan", plan.id)
             await db.commit()
             print("New Quota: 5 (Effective immediately)")
             